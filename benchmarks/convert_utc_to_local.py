@@ -0,0 +1,90 @@
+"""UTC to local time conversion of a Home Assistant /api/states dump.
+
+Builds a synthetic dump of ``--entities`` states and converts it with the old
+dumps/regex/loads implementation and with ``homeassistant.ha_time``:
+
+    python benchmarks/convert_utc_to_local.py --entities 2000
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytz
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from homeassistant.ha_time import convert_utc_to_local, utc_to_local  # noqa: E402
+
+
+def old_convert_utc_to_local(json_data, local_tz='Asia/Shanghai'):
+    json_str = json.dumps(json_data)
+    utc_time_pattern = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?\+00:00')
+    local_timezone = pytz.timezone(local_tz)
+
+    def convert_time(match):
+        utc_dt = datetime.fromisoformat(match.group(0))
+        return utc_dt.astimezone(local_timezone).isoformat()
+
+    converted_json_str = utc_time_pattern.sub(convert_time, json_str)
+    return json.loads(json.loads(converted_json_str))
+
+
+def make_dump(count):
+    random.seed(0)
+    now = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    # 真实的 home assistant 里很多实体在同一时刻（启动、自动化）更新
+    moments = [(now - timedelta(seconds=random.randint(0, 86400))).isoformat() for _ in range(count // 4)]
+    states = []
+    for i in range(count):
+        changed = random.choice(moments)
+        states.append({
+            "entity_id": f"sensor.device_{i}",
+            "state": str(random.randint(0, 100)),
+            "attributes": {
+                "friendly_name": f"设备 {i}",
+                "unit_of_measurement": "%",
+                "device_class": "humidity",
+            },
+            "last_changed": changed,
+            "last_reported": random.choice(moments),
+            "last_updated": changed,
+            "context": {"id": f"{i:026d}", "parent_id": None, "user_id": None},
+        })
+    return json.dumps(states, ensure_ascii=False)
+
+
+def measure(func, text, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(text)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000, sum(timings) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    text = make_dump(args.entities)
+    assert old_convert_utc_to_local(text) == convert_utc_to_local(text)
+    print(f"{args.entities} entities, {len(text.encode()) / 1024:.0f} KiB")
+
+    for name, func in (
+        ("dumps/regex/loads", old_convert_utc_to_local),
+        ("single pass, cold cache", lambda t: (utc_to_local.cache_clear(), convert_utc_to_local(t))),
+        ("single pass, warm cache", convert_utc_to_local),
+    ):
+        best, mean = measure(func, text, args.rounds)
+        print(f"{name:<24} best {best:7.2f} ms  mean {mean:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Polling jitter while ha_agent reads Home Assistant states.
+
+A fake HA answers /api/states/<id> after ``--latency`` seconds. A ticker
+standing in for the Mi poller wakes every ``--tick`` seconds while the
+entities are read, once with blocking ``requests`` (the old helpers) and once
+with the async HaClient, and reports how late the ticker woke up:
+
+    python benchmarks/ha_client_jitter.py --entities 20 --latency 0.1
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+import requests
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from homeassistant.ha_client import HaClient  # noqa: E402
+
+TOKEN = "benchmark"
+
+
+def start_fake_ha(port, latency):
+    async def state(request):
+        await asyncio.sleep(latency)
+        return web.json_response({"entity_id": request.match_info["entity_id"], "state": "on"})
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get("/api/states/{entity_id}", state)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        started.set()
+        loop.run_forever()
+
+    started = threading.Event()
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+
+
+async def ticker(tick, lateness, stop):
+    expected = time.perf_counter() + tick
+    while not stop.is_set():
+        await asyncio.sleep(max(0.0, expected - time.perf_counter()))
+        lateness.append(time.perf_counter() - expected)
+        expected += tick
+
+
+async def read_blocking(port, entity_ids):
+    for entity_id in entity_ids:
+        requests.get(
+            f"http://127.0.0.1:{port}/api/states/{entity_id}",
+            headers={"Authorization": "Bearer " + TOKEN},
+        )
+        await asyncio.sleep(0)
+
+
+async def read_async(port, entity_ids):
+    client = HaClient.shared("127.0.0.1", port, TOKEN)
+    for entity_id in entity_ids:
+        await client.get("/api/states/" + entity_id)
+
+
+async def measure(name, reader, port, entity_ids, tick):
+    lateness = []
+    stop = asyncio.Event()
+    task = asyncio.create_task(ticker(tick, lateness, stop))
+    start = time.perf_counter()
+    await reader(port, entity_ids)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await task
+    print(
+        f"{name:>9}: reads {elapsed:6.2f}s  ticks {len(lateness):3d}  "
+        f"jitter mean {statistics.mean(lateness) * 1000:7.1f}ms  "
+        f"max {max(lateness) * 1000:7.1f}ms"
+    )
+
+
+async def main(options):
+    start_fake_ha(options.port, options.latency)
+    entity_ids = [f"sensor.bench_{i}" for i in range(options.entities)]
+    await measure("requests", read_blocking, options.port, entity_ids, options.tick)
+    await measure("HaClient", read_async, options.port, entity_ids, options.tick)
+    await HaClient.close_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--tick", type=float, default=0.05)
+    parser.add_argument("--port", type=int, default=8765)
+    asyncio.run(main(parser.parse_args()))
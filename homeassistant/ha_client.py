@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import math
+import time
+
+import aiohttp
+
+logger = logging.getLogger("xiaogpt")
+
+
+class HaClient:
+    """
+    异步的 home assistant REST API 客户端
+
+    同一个 home assistant 共用一个带长连接池的 ClientSession，请求带超时，
+    连接失败或 5xx 时重试，不会阻塞事件循环
+    """
+    _clients: dict = {}
+
+    def __init__(self, ha_address, ha_port, token, timeout=10, retries=2, limit=8):
+        self.base_url = "http://" + ha_address + ":" + str(ha_port)
+        self.headers = {
+            "Authorization": "Bearer " + token
+        }
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.limit = limit
+        self._session = None
+        # 通过 acquire 登记的使用者数，多个家可能连的是同一个 home assistant
+        self.refs = 0
+
+        # 读取代价模型：小请求的往返时间、大响应的下载速度和 /api/states 的大小
+        self.rtt = 0.05
+        self.bytes_per_second = 0.0
+        self.states_size = 0
+
+    @classmethod
+    def shared(cls, ha_address, ha_port, token) -> "HaClient":
+        """按地址和 token 返回进程内共用的客户端"""
+        key = (ha_address, str(ha_port), token)
+        client = cls._clients.get(key)
+        if client is None:
+            client = cls._clients[key] = cls(*key)
+        return client
+
+    @classmethod
+    def acquire(cls, ha_address, ha_port, token) -> "HaClient":
+        """和 shared 一样，另外登记一个使用者，用完调用 release"""
+        client = cls.shared(ha_address, ha_port, token)
+        client.refs += 1
+        return client
+
+    async def release(self):
+        """最后一个使用者释放时才关闭连接池"""
+        self.refs = max(self.refs - 1, 0)
+        if not self.refs:
+            await self.close()
+
+    @classmethod
+    async def close_all(cls):
+        for client in cls._clients.values():
+            await client.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector, headers=self.headers, timeout=self.timeout
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def request(self, method, path, idempotent=True, **kwargs) -> tuple[int, bytes]:
+        """返回 (status, body)，idempotent 为 False 时只在连接没建立时重试，避免服务被调用两次"""
+        url = self.base_url + path
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                start = time.perf_counter()
+                async with self.session.request(method, url, **kwargs) as response:
+                    status, body = response.status, await response.read()
+                self._observe(path, time.perf_counter() - start, len(body))
+            except aiohttp.ClientConnectorError as e:
+                if last:
+                    raise
+                logger.warning(f"ha request {url} error: {e}, retry")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last or not idempotent:
+                    raise
+                logger.warning(f"ha request {url} error: {e}, retry")
+            else:
+                if status < 500 or last or not idempotent:
+                    return status, body
+                logger.warning(f"ha request {url} status {status}, retry")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    def _observe(self, path, elapsed, size):
+        if path == "/api/states":
+            self.states_size = size
+        if size < 16 * 1024:
+            self.rtt += 0.2 * (elapsed - self.rtt)
+            return
+        # 扣除往返时间后的下载速度
+        speed = size / max(elapsed - self.rtt, 1e-3)
+        self.bytes_per_second = speed if not self.bytes_per_second else self.bytes_per_second + 0.2 * (speed - self.bytes_per_second)
+
+    def prefer_full_states(self, count, default_limit=30) -> bool:
+        """读取 count 个实体时，下载整个 /api/states 是否比并发逐个读取更快"""
+        if not self.states_size:
+            # 还没有下载过 /api/states，按数量判断
+            return count > default_limit
+        per_entity = math.ceil(count / self.limit) * self.rtt
+        full = self.rtt
+        if self.bytes_per_second:
+            full += self.states_size / self.bytes_per_second
+        return full < per_entity
+
+    async def get(self, path, **kwargs) -> tuple[int, bytes]:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs) -> tuple[int, bytes]:
+        return await self.request("POST", path, idempotent=False, **kwargs)
@@ -0,0 +1,290 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import time
+import urllib.parse
+from array import array
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from homeassistant.ha_client import HaClient
+from homeassistant.ha_time import parse_time, timestamp_to_local
+
+logger = logging.getLogger("xiaogpt")
+
+# 不是数值的状态，统计数值时跳过
+INVALID_STATES = {"unavailable", "unknown", ""}
+
+
+class EntityHistory:
+    """
+    一个实体的状态序列
+
+    时间和状态分两列存放，times 为按时间排序的时间戳，start 到 end 是已经从 home assistant 取回的时间范围
+    """
+
+    def __init__(self, entity_id, start=0.0, end=0.0, times=(), states=()):
+        self.entity_id = entity_id
+        self.start = start
+        self.end = end
+        self.times = array("d", times)
+        self.states = list(states)
+
+    @property
+    def empty(self):
+        return self.end <= self.start
+
+    def gaps(self, start, end):
+        """start 到 end 中还没有缓存的部分，都和已缓存的范围相连"""
+        if self.empty:
+            return [(start, end)]
+        gaps = []
+        if start < self.start:
+            gaps.append((start, self.start))
+        if end > self.end:
+            gaps.append((self.end, end))
+        return gaps
+
+    def merge(self, start, end, points, covered_end):
+        """用取回的 start 到 end 的数据替换缓存中同一范围的数据，covered_end 之后的数据下次还要重新获取"""
+        old = [(t, s) for t, s in zip(self.times, self.states) if t < start or t > end]
+        merged = []
+        for t, s in sorted(old + points, key=lambda point: point[0]):
+            # 取回的第一条是开始时刻的状态，和缓存的上一条相同时去掉
+            if merged and merged[-1][1] == s:
+                continue
+            merged.append((t, s))
+        self.times = array("d", (t for t, _ in merged))
+        self.states = [s for _, s in merged]
+        if self.empty:
+            self.start, self.end = start, covered_end
+        else:
+            self.start, self.end = min(self.start, start), max(self.end, covered_end)
+
+    def trim(self, cutoff):
+        """丢掉 cutoff 之前的数据，保留 cutoff 时刻的状态"""
+        if self.start >= cutoff:
+            return
+        index = bisect.bisect_right(self.times, cutoff)
+        if index > 1:
+            del self.times[:index - 1]
+            del self.states[:index - 1]
+        self.start = min(max(self.start, cutoff), self.end)
+
+    def window(self, start, end):
+        """start 到 end 的状态变化，第一条是 start 时刻的状态"""
+        lo = bisect.bisect_right(self.times, start)
+        hi = bisect.bisect_right(self.times, end)
+        points = list(zip(self.times[lo:hi], self.states[lo:hi]))
+        if lo > 0:
+            points.insert(0, (start, self.states[lo - 1]))
+        return points
+
+    def dump(self):
+        # 时间按毫秒差值存放，文件更小
+        millis = [round(t * 1000) for t in self.times]
+        deltas = [b - a for a, b in zip([0] + millis, millis)]
+        return {"entity_id": self.entity_id, "start": self.start, "end": self.end,
+                "times": deltas, "states": self.states}
+
+    @classmethod
+    def load(cls, data):
+        times, total = [], 0
+        for delta in data["times"]:
+            total += delta
+            times.append(total / 1000)
+        return cls(data["entity_id"], data["start"], data["end"], times, data["states"])
+
+
+class HaHistoryStore:
+    """
+    home assistant 历史状态的本地缓存
+
+    每个实体一个文件，保存已取回时间范围内的状态变化。查询时只向 home assistant 请求缓存范围之外的部分，
+    重叠的时间范围直接从缓存读取。时间范围较长、状态变化较多时，按时间分段汇总后再放进提示词
+    """
+    _stores: dict = {}
+
+    def __init__(self, ha_address, ha_port, token, directory, keep_days=10, max_points=48, settle=5):
+        self.client_key = (ha_address, str(ha_port), token)
+        self.directory = directory
+        # home assistant 默认保留 10 天的历史
+        self.keep_days = keep_days
+        self.max_points = max_points
+        # 最近几秒的数据可能还没有写入数据库，不算作已缓存
+        self.settle = settle
+
+        self.entities: dict = {}
+        self._lock = asyncio.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def shared(cls, ha_address, ha_port, token, directory="", **kwargs) -> "HaHistoryStore":
+        key = (ha_address, str(ha_port), token)
+        store = cls._stores.get(key)
+        if store is None:
+            directory = directory or os.path.join(os.path.dirname(os.path.abspath(__file__)), "history")
+            store = cls._stores[key] = cls(*key, directory, **kwargs)
+        return store
+
+    @classmethod
+    def find(cls, ha_address, ha_port, token):
+        """返回已创建的缓存，没有则返回 None，调用方直接请求 REST API"""
+        return cls._stores.get((ha_address, str(ha_port), token))
+
+    def _path(self, entity_id):
+        return os.path.join(self.directory, entity_id + ".json")
+
+    def _entity(self, entity_id) -> EntityHistory:
+        history = self.entities.get(entity_id)
+        if history is None:
+            history = EntityHistory(entity_id)
+            try:
+                with open(self._path(entity_id), encoding="utf-8") as f:
+                    history = EntityHistory.load(json.load(f))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"load history of {entity_id} error: {e}")
+            self.entities[entity_id] = history
+        return history
+
+    def _save(self, history_list):
+        for history in history_list:
+            path = self._path(history.entity_id)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(history.dump(), f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(path + ".tmp", path)
+
+    async def _fetch(self, entity_id_list, start, end):
+        """返回 {entity_id: [(时间戳, 状态)]}"""
+        path = "/api/history/period/" + datetime.fromtimestamp(start, timezone.utc).isoformat()
+        params = {
+            "end_time": datetime.fromtimestamp(end, timezone.utc).isoformat(),
+            "filter_entity_id": ",".join(entity_id_list)
+        }
+        path += f"?{urllib.parse.urlencode(params)}&minimal_response&no_attributes&significant_changes_only"
+        status, body = await HaClient.shared(*self.client_key).get(path)
+        if status != 200:
+            raise Exception(f"get history error, status code {status}")
+
+        result = {entity_id: [] for entity_id in entity_id_list}
+        for entity_list in json.loads(body):
+            if not entity_list:
+                continue
+            # minimal_response 只有第一条带 entity_id
+            entity_id = entity_list[0].get("entity_id")
+            if entity_id in result:
+                result[entity_id] = [(parse_time(item["last_changed"]), item["state"]) for item in entity_list]
+        return result
+
+    async def points(self, entity_id_list, start, end):
+        """返回 {entity_id: [(时间戳, 状态)]}，只请求没有缓存的时间范围"""
+        now = time.time()
+        start = max(start, now - self.keep_days * 86400)
+        end = min(end, now)
+        async with self._lock:
+            # 缺少的时间范围相同的实体合并成一个请求
+            groups = defaultdict(list)
+            for entity_id in entity_id_list:
+                for gap in self._entity(entity_id).gaps(start, end):
+                    if gap[1] > gap[0]:
+                        groups[gap].append(entity_id)
+
+            gaps = list(groups)
+            results = await asyncio.gather(*[self._fetch(groups[gap], *gap) for gap in gaps])
+
+            changed = {}
+            covered_end = now - self.settle
+            for (gap_start, gap_end), fetched in zip(gaps, results):
+                for entity_id, entity_points in fetched.items():
+                    history = self._entity(entity_id)
+                    history.merge(gap_start, gap_end, entity_points, min(gap_end, covered_end))
+                    history.trim(now - self.keep_days * 86400)
+                    changed[entity_id] = history
+            if changed:
+                logger.info(f"history fetched {len(gaps)} ranges for {len(changed)} entities")
+                await asyncio.to_thread(self._save, list(changed.values()))
+
+        return {entity_id: self._entity(entity_id).window(start, end) for entity_id in entity_id_list}
+
+    async def history(self, entity_id_list, start_time, end_time):
+        """和 /api/history/period 一样按实体返回历史，较长的历史汇总后返回"""
+        end = parse_time(end_time) if end_time else time.time()
+        start = parse_time(start_time) if start_time else end - 86400
+        points = await self.points(entity_id_list, start, end)
+
+        result = []
+        for entity_id in entity_id_list:
+            if points[entity_id]:
+                result.append({f"history of {entity_id}": self.render(points[entity_id], start, end)})
+        return result
+
+    def render(self, points, start, end):
+        if len(points) <= self.max_points:
+            return [{"state": state, "last_changed": timestamp_to_local(t)} for t, state in points]
+        values = []
+        for t, state in points:
+            try:
+                values.append((t, float(state)))
+            except ValueError:
+                if state not in INVALID_STATES:
+                    return self._summarize_states(points, end)
+        if not values:
+            return self._summarize_states(points, end)
+        return self._summarize_values(values, start, end)
+
+    def _summarize_values(self, values, start, end):
+        """数值状态按时间分段，每段给出按时间加权的平均值和最大最小值"""
+        # 每个值持续到下一次变化
+        segments = [(t, next_t, v) for (t, v), (next_t, _) in zip(values, values[1:] + [(end, None)])]
+        bucket_count = max(self.max_points // 2, 1)
+        step = (end - start) / bucket_count
+        samples = []
+        for i in range(bucket_count):
+            lo, hi = start + i * step, start + (i + 1) * step
+            stats = _segment_stats(segments, lo, hi)
+            if stats:
+                samples.append({"from": timestamp_to_local(lo), "to": timestamp_to_local(hi), **stats})
+        summary = _segment_stats(segments, start, end) or {}
+        summary.update({
+            "changes": len(values),
+            "first": values[0][1],
+            "last": values[-1][1],
+            "from": timestamp_to_local(start),
+            "to": timestamp_to_local(end),
+        })
+        return [{"summary": summary, "samples": samples}]
+
+    def _summarize_states(self, points, end):
+        """非数值状态统计每个状态的次数和总时长，只保留最后几次变化"""
+        durations = defaultdict(float)
+        counts = defaultdict(int)
+        for (t, state), (next_t, _) in zip(points, points[1:] + [(end, None)]):
+            durations[state] += next_t - t
+            counts[state] += 1
+        summary = {
+            state: {"count": counts[state], "minutes": round(durations[state] / 60, 1)} for state in durations
+        }
+        recent = [{"state": state, "last_changed": timestamp_to_local(t)}
+                  for t, state in points[-(self.max_points // 2):]]
+        return [{"summary": summary, "changes": len(points), "recent": recent}]
+
+
+def _segment_stats(segments, lo, hi):
+    total = weighted = 0.0
+    low = high = None
+    for start, end, value in segments:
+        overlap = min(end, hi) - max(start, lo)
+        if overlap <= 0:
+            continue
+        total += overlap
+        weighted += value * overlap
+        low = value if low is None else min(low, value)
+        high = value if high is None else max(high, value)
+    if low is None:
+        return None
+    avg = weighted / total if total else low
+    return {"min": round(low, 2), "avg": round(avg, 2), "max": round(high, 2)}
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+import aiohttp
+
+from homeassistant.ha_client import HaClient
+
+logger = logging.getLogger("xiaogpt")
+
+
+class HaStateMirror:
+    """
+    home assistant 实体状态的内存镜像
+
+    通过 WebSocket API 订阅 state_changed 事件，按实体 id 和 domain 索引所有实体的当前状态，
+    读取状态不需要访问网络。断线后按指数退避重连，并用 get_states 重新同步全部状态。
+    url 和 session 可以指定，方便连到本地的假 home assistant 测试
+    """
+    _mirrors: dict = {}
+
+    def __init__(self, ha_address, ha_port, token, url=None, session=None,
+                 reconnect_delay=1, max_reconnect_delay=60):
+        self.url = url or "ws://" + ha_address + ":" + str(ha_port) + "/api/websocket"
+        self.token = token
+        self.client_key = (ha_address, str(ha_port), token)
+        self.session = session
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.states: dict = {}
+        self.domains = defaultdict(set)
+        self.synced = asyncio.Event()
+        self._msg_id = 0
+        self._task = None
+        # 通过 acquire 登记的使用者数，最后一个释放时才停止
+        self.refs = 0
+        # 本次连接中快照到达之前收到的事件，快照之后创建或删除的实体以事件为准
+        self._events: dict = {}
+
+    @classmethod
+    def shared(cls, ha_address, ha_port, token) -> "HaStateMirror":
+        key = (ha_address, str(ha_port), token)
+        mirror = cls._mirrors.get(key)
+        if mirror is None:
+            mirror = cls._mirrors[key] = cls(*key)
+        return mirror
+
+    @classmethod
+    def acquire(cls, ha_address, ha_port, token) -> "HaStateMirror":
+        """和 shared 一样，另外登记一个使用者，用完调用 release"""
+        mirror = cls.shared(ha_address, ha_port, token)
+        mirror.refs += 1
+        return mirror
+
+    async def release(self):
+        self.refs = max(self.refs - 1, 0)
+        if not self.refs:
+            await self.stop()
+
+    @classmethod
+    def find(cls, ha_address, ha_port, token):
+        """返回已同步的镜像，没有则返回 None，调用方改用 REST API"""
+        mirror = cls._mirrors.get((ha_address, str(ha_port), token))
+        return mirror if mirror is not None and mirror.ready else None
+
+    @property
+    def ready(self) -> bool:
+        return self.synced.is_set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.synced.clear()
+
+    # 读取接口
+    def get(self, entity_id):
+        return self.states.get(entity_id)
+
+    def get_many(self, entity_id_list):
+        return [self.states[entity_id] for entity_id in entity_id_list if entity_id in self.states]
+
+    def has_all(self, entity_id_list):
+        return all(entity_id in self.states for entity_id in entity_id_list)
+
+    def entity_ids(self, domain):
+        return sorted(self.domains.get(domain, ()))
+
+    async def run(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                await self._listen()
+                # 连接正常结束，下一次从最短的间隔开始重连
+                delay = self.reconnect_delay
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ha websocket error: {e}")
+            self.synced.clear()
+            logger.info(f"ha websocket disconnected, reconnect in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _next_id(self):
+        self._msg_id += 1
+        return self._msg_id
+
+    async def _listen(self):
+        session = self.session or HaClient.shared(*self.client_key).session
+        async with session.ws_connect(self.url, heartbeat=30) as ws:
+            msg = await ws.receive_json()
+            if msg.get("type") != "auth_required":
+                raise Exception(f"unexpected ha websocket message: {msg}")
+            await ws.send_json({"type": "auth", "access_token": self.token})
+            msg = await ws.receive_json()
+            if msg.get("type") != "auth_ok":
+                raise Exception(f"ha websocket auth failed: {msg}")
+
+            # 先订阅再读取全部状态，同步期间的事件不会丢
+            self._events = {}
+            await ws.send_json({"id": self._next_id(), "type": "subscribe_events", "event_type": "state_changed"})
+            states_id = self._next_id()
+            await ws.send_json({"id": states_id, "type": "get_states"})
+
+            async for message in ws:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    break
+                data = message.json()
+                # home assistant 可能把多条消息合并成一个列表发送
+                for item in data if isinstance(data, list) else [data]:
+                    self._handle(item, states_id)
+
+    def _handle(self, msg, states_id):
+        if msg.get("type") == "event":
+            data = msg["event"]["data"]
+            self._apply(data["entity_id"], data.get("new_state"))
+        elif msg.get("type") == "result" and msg.get("id") == states_id:
+            if not msg.get("success"):
+                raise Exception(f"ha get_states failed: {msg}")
+            self._resync(msg["result"])
+        elif msg.get("type") == "result" and not msg.get("success"):
+            raise Exception(f"ha websocket command failed: {msg}")
+
+    def _apply(self, entity_id, state):
+        if not self.ready:
+            self._events[entity_id] = state
+        domain = entity_id.split(".")[0]
+        if state is None:
+            self.states.pop(entity_id, None)
+            self.domains[domain].discard(entity_id)
+            return
+        old = self.states.get(entity_id)
+        if old and old.get("last_updated", "") > state.get("last_updated", ""):
+            return
+        self.states[entity_id] = state
+        self.domains[domain].add(entity_id)
+
+    def _resync(self, states):
+        fresh = {state["entity_id"]: state for state in states}
+        # 同步期间收到的事件可能比快照新，包括快照之后新建和删除的实体
+        for entity_id, state in self._events.items():
+            old = fresh.get(entity_id)
+            if state is None:
+                fresh.pop(entity_id, None)
+            elif old is None or state.get("last_updated", "") > old.get("last_updated", ""):
+                fresh[entity_id] = state
+        self._events = {}
+        self.states = fresh
+        self.domains = defaultdict(set)
+        for entity_id in fresh:
+            self.domains[entity_id.split(".")[0]].add(entity_id)
+        self.synced.set()
+        logger.info(f"ha state mirror synced, {len(fresh)} entities")
@@ -0,0 +1,60 @@
+import functools
+import json
+import re
+from datetime import datetime
+
+import pytz
+
+# home assistant 返回的 UTC 时间格式
+UTC_TIME_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?\+00:00')
+LOCAL_TZ = 'Asia/Shanghai'
+
+
+@functools.lru_cache(maxsize=8)
+def _timezone(local_tz):
+    return pytz.timezone(local_tz)
+
+
+# 同一个时间戳在 states 和 history 里反复出现，缓存转换结果
+@functools.lru_cache(maxsize=8192)
+def utc_to_local(utc_time_str, local_tz=LOCAL_TZ):
+    utc_dt = datetime.fromisoformat(utc_time_str)
+    return utc_dt.astimezone(_timezone(local_tz)).isoformat()
+
+
+def convert_utc_to_local(json_data, local_tz=LOCAL_TZ):
+    """
+    把 json 数据中所有的 UTC 时间字符串转换为本地时区
+
+    传入 json 文本时解析一次，只遍历一遍数据，返回新的对象，不修改传入的数据
+    """
+    if isinstance(json_data, (str, bytes)):
+        json_data = json.loads(json_data)
+
+    def convert_time(match):
+        return utc_to_local(match.group(0), local_tz)
+
+    def convert(value):
+        if isinstance(value, str):
+            if "+00:00" not in value:
+                return value
+            return UTC_TIME_PATTERN.sub(convert_time, value)
+        if isinstance(value, dict):
+            return {key: convert(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [convert(item) for item in value]
+        return value
+
+    return convert(json_data)
+
+
+def parse_time(time_str, local_tz=LOCAL_TZ):
+    """把 ISO 时间解析为时间戳，没有时区的按本地时区"""
+    dt = datetime.fromisoformat(time_str)
+    if dt.tzinfo is None:
+        dt = _timezone(local_tz).localize(dt)
+    return dt.timestamp()
+
+
+def timestamp_to_local(timestamp, local_tz=LOCAL_TZ):
+    return datetime.fromtimestamp(timestamp, _timezone(local_tz)).isoformat(timespec="seconds")
@@ -1,11 +1,10 @@
 from tinydb import TinyDB, Query
+import functools
 import json
 from requests import post, get
 import os
-import re
 import time
-import pytz
-from datetime import datetime
+from homeassistant.ha_time import convert_utc_to_local
 from mihagpt.config import HARDWARE_COMMAND_DICT, HARDWARE_MODEL_RUN_PERFECTLY_DICT, HARDWARE_MODEL_RUN_AVAILABLE_DICT, HARDWARE_MODEL_RUN_UNCERTAIN_DICT
 
 # 查询所有区域列表：
@@ -32,6 +31,40 @@ XIAOMI_MIOT_SPEC_ADDRESS = "https://miot-spec.org/miot-spec-v2/instance?type="
 
 XIAOMI_MIOT_SPEC_ALL_ADDRESS = "https://miot-spec.org/miot-spec-v2/instances?status=all"
 
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+# 查询结果按参数缓存，存储有写入时 generation 加一，缓存失效
+# 缓存的结果是共用的，调用方不要修改
+def memoized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        if self._memo_generation != self.generation:
+            self._memo.clear()
+            self._memo_generation = self.generation
+        key = (method.__name__, _freeze(args))
+        if key not in self._memo:
+            self._memo[key] = method(self, *args)
+        return self._memo[key]
+    return wrapper
+
+
+# 带实体状态的列表，缓存的结构不变，每次返回前刷新为最新的状态
+def memoized_with_states(method):
+    cached = memoized(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        result = cached(self, *args)
+        if self.state_mirror is not None and self.state_mirror.ready:
+            self._refresh_states(result)
+        return result
+    return wrapper
+
+
 class HaStorage:
     """
     持久化存储通过home assistant接口获取的区域列表、设备列表、实体列表和服务列表
@@ -46,39 +79,64 @@ class HaStorage:
 
     speaker_db: TinyDB
 
-    def __init__(self):
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        self.area_db = TinyDB(os.path.join(current_dir, 'areas.json'))
-        self.device_db = TinyDB(os.path.join(current_dir, 'devices.json'))
-        self.entity_db = TinyDB(os.path.join(current_dir, 'entities.json'))
-        self.domain_service_db = TinyDB(os.path.join(current_dir, 'domain_services.json'))
-
-        self.device_miot_model_db = TinyDB(os.path.join(current_dir, 'device_miot_model_db.json'))
-        self.device_miot_spec_db = TinyDB(os.path.join(current_dir, 'device_miot_spec_db.json'))
-
-        self.speaker_db = TinyDB(os.path.join(current_dir, 'speaker_db.json'))
+    # 同一进程内多个家庭共用的 TinyDB，按文件路径缓存
+    _shared_dbs: dict = {}
 
+    def __init__(self, storage_dir: str = "", shared_dir: str = ""):
+        """storage_dir 存放本家庭的数据，shared_dir 存放可共用的 miot spec 数据，默认都为本模块目录"""
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        storage_dir = storage_dir or current_dir
+        shared_dir = shared_dir or current_dir
+        os.makedirs(storage_dir, exist_ok=True)
+        self.storage_dir = storage_dir
+        self.area_db = TinyDB(os.path.join(storage_dir, 'areas.json'))
+        self.device_db = TinyDB(os.path.join(storage_dir, 'devices.json'))
+        self.entity_db = TinyDB(os.path.join(storage_dir, 'entities.json'))
+        self.domain_service_db = TinyDB(os.path.join(storage_dir, 'domain_services.json'))
+
+        self.device_miot_model_db = self._shared_db(os.path.join(shared_dir, 'device_miot_model_db.json'))
+        self.device_miot_spec_db = self._shared_db(os.path.join(shared_dir, 'device_miot_spec_db.json'))
+
+        self.speaker_db = TinyDB(os.path.join(storage_dir, 'speaker_db.json'))
+
+        # HaStateMirror，设置后实体的状态从镜像中读取最新值
+        self.state_mirror = None
+
+        # 每次写入存储加一，查询缓存和预先整理的数据据此判断是否过期
+        self.generation = 0
+        self._memo = {}
+        self._memo_generation = 0
+
+    @classmethod
+    def _shared_db(cls, path: str) -> TinyDB:
+        path = os.path.abspath(path)
+        db = cls._shared_dbs.get(path)
+        if db is None:
+            db = cls._shared_dbs[path] = TinyDB(path)
+        return db
+
+    def _changed(self):
+        self.generation += 1
+
+    def _refresh_states(self, value):
+        # 实体信息的格式为 {"实体id": {...}, "state": ""}
+        if isinstance(value, list):
+            for item in value:
+                self._refresh_states(item)
+        elif isinstance(value, dict):
+            if "state" in value and len(value) == 2:
+                entity_id = next(key for key in value if key != "state")
+                state = self.state_mirror.get(entity_id)
+                if state:
+                    value["state"] = state.get("state", "")
+                return
+            for item in value.values():
+                self._refresh_states(item)
 
     # 把时间格式统一转为本地时区
     def convert_utc_to_local(self, json_data, local_tz='Asia/Shanghai'):
-        # 正则表达式匹配 UTC 时间格式
-        utc_time_pattern = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?\+00:00')
-        local_timezone = pytz.timezone(local_tz)
-
-        def convert_time(match):
-            utc_time_str = match.group(0)
-            # 将时间字符串转换为 datetime 对象
-            utc_dt = datetime.fromisoformat(utc_time_str.replace('Z', '+00:00'))
-            # 将 UTC 时间转换为本地时区时间
-            local_dt = utc_dt.astimezone(local_timezone)
-            return local_dt.isoformat()
-
-        # 转换 JSON 数据中的所有 UTC 时间字符串
-        json_str = json.dumps(json_data)
-        converted_json_str = utc_time_pattern.sub(convert_time, json_str)
-        return json.loads(converted_json_str)
-
-    # 初始化ha设备本地数据库
+        return convert_utc_to_local(json_data, local_tz)
+
     def init_data(self, ha_address, ha_port, token, speakers, force=False):
         if force or (not (self.entity_db.all() and self.domain_service_db.all())):
             # 初始化服务列表
@@ -91,6 +149,7 @@ class HaStorage:
                 self.area_db.truncate()
                 self.device_db.truncate()
                 self.entity_db.truncate()
+                self._changed()
 
                 self.save_areas(area_list)
 
@@ -366,9 +425,7 @@ class HaStorage:
 
         if response.status_code == 200:
             # print(response.text)
-            response_local = self.convert_utc_to_local(response.text)
-
-            entity = json.loads(response_local)
+            entity = self.convert_utc_to_local(response.text)
             return entity
         else:
             print(f"Error: Received response with status code {response.status_code}")
@@ -386,9 +443,8 @@ class HaStorage:
 
         if response.status_code == 200:
             # print(response.text)
-            response_local = self.convert_utc_to_local(response.text)
-            # 解析 JSON 字符串为 Python 对象
-            domain_service_list = json.loads(response_local)
+            # 解析 JSON 并转换为本地时间
+            domain_service_list = self.convert_utc_to_local(response.text)
 
             return domain_service_list
         else:
@@ -404,9 +460,8 @@ class HaStorage:
 
         if response.status_code == 200:
             # print(response.text)
-            response_local = self.convert_utc_to_local(response.text)
-            # 解析 JSON 字符串为 Python 对象
-            miot_spec_device_info = json.loads(response_local)
+            # 解析 JSON 并转换为本地时间
+            miot_spec_device_info = self.convert_utc_to_local(response.text)
 
             return miot_spec_device_info
         else:
@@ -422,9 +477,8 @@ class HaStorage:
 
         if response.status_code == 200:
             # print(response.text)
-            response_local = self.convert_utc_to_local(response.text)
-            # 解析 JSON 字符串为 Python 对象
-            miot_spec_device_info_list = json.loads(response_local)
+            # 解析 JSON 并转换为本地时间
+            miot_spec_device_info_list = self.convert_utc_to_local(response.text)
 
             return miot_spec_device_info_list
         else:
@@ -481,6 +535,7 @@ class HaStorage:
         # 确保 area_list 是一个列表，并且每个元素都是字典
         if isinstance(area_list, list) and all(isinstance(item, dict) for item in area_list):
             self.area_db.insert_multiple(area_list)
+            self._changed()
 
     # 在本地数据库中保存设备列表
     def save_devices(self, area_id, device_list):
@@ -494,6 +549,7 @@ class HaStorage:
                 else:
                     device["description"] = ""
             self.device_db.insert_multiple(device_list)
+            self._changed()
 
     # 在本地数据库中保存实体列表
     def save_entities(self, device_id, entity_id_list):
@@ -510,45 +566,55 @@ class HaStorage:
         # 确保 domain_service_list 是一个列表，并且每个元素都是字典
         if isinstance(domain_service_list, list) and all(isinstance(item, dict) for item in domain_service_list):
             self.domain_service_db.insert_multiple(domain_service_list)
+        self._changed()
 
     # 在本地数据库中保存智能音箱列表
     def save_speakers(self, speaker_list):
         # 确保 speaker_list 是一个列表，并且每个元素都是字典
         if isinstance(speaker_list, list) and all(isinstance(item, dict) for item in speaker_list):
             self.speaker_db.insert_multiple(speaker_list)
+            self._changed()
 
     # 在本地数据库中保存区域
     def save_area(self, area):
         self.area_db.insert(area)
+        self._changed()
 
     # 在本地数据库中保存设备
     def save_device(self, area_id, device):
         device["area_id"] = area_id
         self.device_db.insert(device)
+        self._changed()
 
     # 在本地数据库中保存实体
     def save_entity(self, device_id, entity):
         entity["device_id"] = device_id
         self.entity_db.insert(entity)
+        self._changed()
 
     def update_entity(self, entity_id, update):
         Entity = Query()
         self.entity_db.upsert(update, Entity.entity_id == entity_id)
+        self._changed()
 
     # 在本地数据库中保存实体-服务
     def save_domain_service(self, domain_service):
         self.domain_service_db.insert(domain_service)
+        self._changed()
 
     # 从本地数据库中查询所有区域
+    @memoized
     def get_all_areas(self):
         return self.area_db.all()
 
     # 从本地数据库中根据区域id查询区域
+    @memoized
     def get_area_by_id(self, area_id):
         Area = Query()
         return self.area_db.search(Area.area_id == area_id)
 
     # 从本地数据库中根据区域id列表查询区域列表
+    @memoized
     def get_areas_by_id_list(self, area_id_list):
         if area_id_list:
             Area = Query()
@@ -557,11 +623,13 @@ class HaStorage:
             return self.get_all_areas()
 
     # 在本地数据库中查询区域下的所有设备
+    @memoized
     def get_devices_by_area_id(self, area_id):
         Device = Query()
         return self.device_db.search(Device.area_id == area_id)
 
     # 在本地数据库中根据设备id查询设备
+    @memoized
     def get_device_by_id(self, device_id):
         Device = Query()
         return self.device_db.search(Device.device_id == device_id)
@@ -576,15 +644,25 @@ class HaStorage:
         return None
 
     # 在本地数据库中查询设备下的所有实体
+    @memoized
     def get_entities_by_device_id(self, device_id):
         Entity = Query()
         return self.entity_db.search(Entity.device_id == device_id)
 
     # 在本地数据库中根据实体id查询实体
+    @memoized
     def get_entity_by_id(self, entity_id):
         Entity = Query()
         return self.entity_db.search(Entity.entity_id == entity_id)
 
+    # 实体的当前状态，有状态镜像时读取镜像，否则读取启动时保存的状态
+    def get_entity_state(self, entity):
+        if self.state_mirror is not None and self.state_mirror.ready:
+            state = self.state_mirror.get(entity["entity_id"])
+            if state:
+                return state.get("state", "")
+        return entity.get("state", "")
+
     # 在本地数据库中查询实体的属性
     def get_entity_property(self, entity_id, property_name):
         Entity = Query()
@@ -595,15 +673,18 @@ class HaStorage:
         return None
 
     # 在本地数据库中查询所有的实体类型domain
+    @memoized
     def get_all_domain_services(self):
         return self.domain_service_db.all()
 
     # 在本地数据库中根据实体类型domain查询支持的服务
+    @memoized
     def get_domain_service_by_domain(self, domain):
         Domain_service = Query()
         return self.domain_service_db.search(Domain_service.domain == domain)
 
     # 获取在设备-实体列表，格式为：[{"设备名称":[{"设备实体名称":[实体支持的服务列表]}]}]
+    @memoized
     def get_devices_entity_list(self):
         devices_entity_list = {
             "devices": []
@@ -635,6 +716,7 @@ class HaStorage:
         return devices_entity_list
 
     # 获取设备-实体列表，格式为：[{"设备名称":{"description": "description of device", "entities":[{"设备实体名称":{'service':[实体支持的服务列表],'state':'state of entity'}}]}}]
+    @memoized_with_states
     def get_simplified_devices_entities_with_description_list(self, area_id_list, sensor_type_list):
         simplified_devices = []
         areas = []
@@ -671,7 +753,7 @@ class HaStorage:
                                     if supported_services:
                                         for service in supported_services:
                                             entity_info[entity_id]["services"].append(service)
-                                    entity_info["state"] = entity.get("state", "")
+                                    entity_info["state"] = self.get_entity_state(entity)
                                     device_info[device_name]["entities"].append(entity_info)
 
                         area_info[area_name].append(device_info)
@@ -680,6 +762,7 @@ class HaStorage:
         return simplified_devices
 
     # 获取设备-实体列表，格式为：[{"设备名称":[{"设备实体名称":{'service':[实体支持的服务列表],'state':'state of entity'}}]}]
+    @memoized_with_states
     def get_simplified_devices_entity_list(self, area_id_list, sensor_type_list):
         simplified_devices = []
         areas = []
@@ -714,7 +797,7 @@ class HaStorage:
                                         for service, details in supported_services.items():
                                             option_list = details.get("options", [])
                                             entity_info[entity_id]["services"].append({service: option_list})
-                                    entity_info["state"] = entity.get("state", "")
+                                    entity_info["state"] = self.get_entity_state(entity)
                                     device_info[device_name].append(entity_info)
 
                         area_info[area_name].append(device_info)
@@ -723,6 +806,7 @@ class HaStorage:
         return simplified_devices
 
     # 根据设备id获取设备-实体列表，格式为：[{"设备名称":[{"设备实体名称":{'service':[实体支持的服务列表],'state':'state of entity'}}]}]
+    @memoized_with_states
     def get_simplified_devices_entity_by_device_list(self, area_id_list, sensor_type_list, device_name_list):
         def in_device_list(device_name):
             if device_name_list and isinstance(device_name_list, list):
@@ -765,7 +849,7 @@ class HaStorage:
                                             for service, details in supported_services.items():
                                                 option_list = details.get("options", [])
                                                 entity_info[entity_id]["services"].append({service: option_list})
-                                        entity_info["state"] = entity.get("state", "")
+                                        entity_info["state"] = self.get_entity_state(entity)
                                         device_info[device_name].append(entity_info)
 
                             area_info[area_name].append(device_info)
@@ -774,6 +858,7 @@ class HaStorage:
         return simplified_devices
 
     # 根据设备id获取实体id列表，格式为：["实体id"...]
+    @memoized
     def get_simplified_devices_entities_id_list_by_device_list(self, area_id_list, sensor_type_list, device_id_list):
         simplified_entities = []
         areas = []
@@ -801,6 +886,7 @@ class HaStorage:
         return simplified_entities
 
     # 获取在设备列表，格式为：[{"device_name":"name", "device_id":"id", "description":"description"}...]
+    @memoized
     def get_simplified_device_list(self, area_id_list, device_id_list):
         simplified_devices = []
         areas = []
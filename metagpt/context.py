@@ -14,7 +14,10 @@ from pydantic import BaseModel, ConfigDict
 from metagpt.config2 import Config
 from metagpt.configs.llm_config import LLMConfig, LLMType
 from metagpt.provider.base_llm import BaseLLM
-from metagpt.provider.llm_provider_registry import create_llm_instance
+from metagpt.provider.llm_provider_registry import (
+    create_llm_instance,
+    create_shared_llm_instance,
+)
 from metagpt.utils.cost_manager import (
     CostManager,
     FireworksCostManager,
@@ -96,9 +99,8 @@ class Context(BaseModel):
         return self._llm
 
     def llm_with_cost_manager_from_llm_config(self, llm_config: LLMConfig) -> BaseLLM:
-        """Return a LLM instance, fixme: support cache"""
-        # if self._llm is None:
-        llm = create_llm_instance(llm_config)
+        """Return a LLM instance, the client is shared with other instances of the same llm config"""
+        llm = create_shared_llm_instance(llm_config)
         if llm.cost_manager is None:
             llm.cost_manager = self._select_costmanager(llm_config)
         return llm
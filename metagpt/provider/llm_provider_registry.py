@@ -5,6 +5,8 @@
 @Author  : alexanderwu
 @File    : llm_provider_registry.py
 """
+import copy
+
 from metagpt.configs.llm_config import LLMConfig, LLMType
 from metagpt.provider.base_llm import BaseLLM
 
@@ -40,5 +42,20 @@ def create_llm_instance(config: LLMConfig) -> BaseLLM:
     return LLM_REGISTRY.get_provider(config.api_type)(config)
 
 
+def create_shared_llm_instance(config: LLMConfig) -> BaseLLM:
+    """get a llm instance which shares the client (and its connection pool) with other instances of the same config
+
+    The provider instance is built once per (api_type, base_url, model, ...) and every caller gets a shallow copy,
+    so per-instance state like system_prompt and cost_manager stays separate while `aclient` is reused.
+    """
+    key = config.model_dump_json()
+    llm = _SHARED_LLMS.get(key)
+    if llm is None:
+        llm = _SHARED_LLMS[key] = create_llm_instance(config)
+    return copy.copy(llm)
+
+
 # Registry instance
 LLM_REGISTRY = LLMProviderRegistry()
+# llm config json -> provider instance whose client is shared
+_SHARED_LLMS: dict[str, BaseLLM] = {}
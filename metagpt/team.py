@@ -8,6 +8,8 @@
         Section 2.2.3.3 of RFC 135.
 """
 
+import asyncio
+import time
 import warnings
 from pathlib import Path
 from typing import Any, Optional
@@ -40,6 +42,8 @@ class Team(BaseModel):
     env: Optional[Environment] = None
     investment: float = Field(default=10.0)
     idea: str = Field(default="")
+    # rounds used by the last `run`, and whether it stopped because the team was idle or out of time
+    last_run: dict = Field(default_factory=dict, exclude=True)
 
     def __init__(self, context: Context = None, **data: Any):
         super(Team, self).__init__(**data)
@@ -120,16 +124,50 @@ class Team(BaseModel):
         return self.run_project(idea=idea, send_to=send_to)
 
     @serialize_decorator
-    async def run(self, n_round=3, idea="", send_to="", auto_archive=True):
-        """Run company until target round or no money"""
+    async def run(self, n_round=3, idea="", send_to="", auto_archive=True, stop_when_idle=False, timeout=None):
+        """Run company until target round or no money.
+
+        With `stop_when_idle` the run ends as soon as every role is idle and no message is waiting, and
+        `timeout` bounds the wall-clock seconds of the whole run; a round still running then is cancelled
+        and the undelivered messages are dropped.
+        """
         if idea:
             self.run_project(idea=idea, send_to=send_to)
 
+        self.last_run = {"rounds": 0, "max_rounds": n_round, "idle": False, "timed_out": False}
+        deadline = None if timeout is None else time.monotonic() + timeout
         while n_round > 0:
+            if stop_when_idle and self.env.is_idle:
+                self.last_run["idle"] = True
+                break
             n_round -= 1
             self._check_balance()
-            await self.env.run()
+            if deadline is None:
+                await self.env.run()
+            elif not await self._run_round_until(deadline):
+                self.last_run["timed_out"] = True
+                break
+            self.last_run["rounds"] += 1
 
             logger.debug(f"max {n_round=} left.")
         self.env.archive(auto_archive)
         return self.env.history
+
+    async def _run_round_until(self, deadline) -> bool:
+        """Run one round, False if the deadline passed first."""
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            try:
+                await asyncio.wait_for(self.env.run(), remaining)
+                return True
+            except asyncio.TimeoutError:
+                # a timeout raised inside a role is not the deadline of the run,
+                # the loop may wake up a clock tick before the deadline
+                if time.monotonic() < deadline - 0.01:
+                    raise
+        logger.warning("Team run is out of time, stop.")
+        for role in self.env.roles.values():
+            role.rc.msg_buffer.pop_all()
+            role.rc.news = []
+            role.set_todo(None)
+        return False
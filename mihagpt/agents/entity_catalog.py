@@ -0,0 +1,140 @@
+import functools
+import logging
+
+import tiktoken
+
+from homeassistant.homeassistant_storage import HaStorage
+from mihagpt.agents.intent_router import DEVICE_CLASS_NAMES, DOMAIN_NAMES, char_ngrams, cosine, normalize
+
+logger = logging.getLogger("xiaogpt")
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"load tiktoken encoding error: {e}, estimate tokens by length")
+        return None
+
+
+def count_tokens(text) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        # 中文大约一个字一个 token
+        return len(text)
+    return len(encoding.encode(text))
+
+
+class EntityCatalog:
+    """
+    Classify_L2 和自动化提示词中的设备实体列表
+
+    存储刷新后（HaStorage.generation 变化）预先整理每个区域、每个设备的实体并计算 token 数，每轮对话只按区域和实体类型筛选，
+    超过 token_budget 时按和用户需求的相关度选择设备，输出格式和
+    HaStorage.get_simplified_devices_entities_with_description_list 相同。token_budget 为 0 时不限制
+    """
+
+    def __init__(self, ha_storage: HaStorage, token_budget=6000):
+        self.ha_storage = ha_storage
+        self.token_budget = token_budget
+        self.areas = []
+        self.refresh()
+
+    def refresh(self):
+        self.generation = self.ha_storage.generation
+        areas = []
+        entity_count = 0
+        for area in self.ha_storage.get_all_areas():
+            devices = []
+            for device in self.ha_storage.get_devices_by_area_id(area["area_id"]):
+                device_entry = self._device_entry(device)
+                entity_count += len(device_entry["entities"])
+                devices.append(device_entry)
+            areas.append({"area_id": area["area_id"], "area_name": area["area_name"], "devices": devices})
+        self.areas = areas
+        logger.info(f"entity catalog built, {sum(len(area['devices']) for area in areas)} devices, "
+                    f"{entity_count} entities")
+
+    def _device_entry(self, device):
+        device_name = device["device_name"]
+        names = [device_name]
+        entities = []
+        for entity in self.ha_storage.get_entities_by_device_id(device["device_id"]):
+            entity_id = entity["entity_id"]
+            domain = entity_id.split(".")[0]
+            attributes = entity.get("attributes", {})
+            services = list(entity.get("supported_services") or [])
+            names.append(attributes.get("friendly_name", ""))
+            names.extend(DOMAIN_NAMES.get(domain, []))
+            names.extend(DEVICE_CLASS_NAMES.get(attributes.get("device_class"), []))
+            # 和提示词中一样的格式计算 token，状态按保存时的值估计
+            entity_info = {entity_id: {"services": services}, "state": entity.get("state", "")}
+            entities.append({
+                "entity": entity,
+                "domain": domain,
+                "services": services,
+                "tokens": count_tokens(str(entity_info)) + 2,
+            })
+        empty = {device_name: {"description": device["description"], "entities": []}}
+        return {
+            "name": device_name,
+            "description": device["description"],
+            "entities": entities,
+            "tokens": count_tokens(str(empty)) + 2,
+            "vector": char_ngrams(normalize("".join(names))),
+        }
+
+    def select(self, area_id_list, entity_type_list, query=""):
+        """按区域和实体类型筛选，超过 token 预算时保留和 query 最相关的设备"""
+        if self.generation != self.ha_storage.generation:
+            self.refresh()
+        candidates = []
+        for area_index, area in enumerate(self.areas):
+            if area_id_list and area["area_id"] not in area_id_list:
+                continue
+            for device_index, device in enumerate(area["devices"]):
+                entities = [entity for entity in device["entities"]
+                            if not entity_type_list or entity["domain"] in entity_type_list]
+                tokens = device["tokens"] + sum(entity["tokens"] for entity in entities)
+                candidates.append(((area_index, device_index), device, entities, tokens))
+
+        total = sum(tokens for *_, tokens in candidates)
+        if not self.token_budget or total <= self.token_budget:
+            selected = {key for key, *_ in candidates}
+            used = total
+        else:
+            query_vector = char_ngrams(normalize(query))
+            # 没有实体的设备最先去掉，其余按相关度从高到低放入预算
+            ranked = sorted(candidates, key=lambda candidate: (
+                bool(candidate[2]), cosine(query_vector, candidate[1]["vector"])), reverse=True)
+            selected, used = set(), 0
+            for key, _, entities, tokens in ranked:
+                if entities and used + tokens <= self.token_budget:
+                    selected.add(key)
+                    used += tokens
+        logger.info(f"entity catalog selected {len(selected)}/{len(candidates)} devices, "
+                    f"about {used}/{total} tokens")
+
+        by_area = {}
+        for key, device, entities, _ in candidates:
+            if key in selected:
+                by_area.setdefault(key[0], []).append({device["name"]: {
+                    "description": device["description"],
+                    "entities": [self._entity_info(entity) for entity in entities],
+                }})
+        result = []
+        trimmed = len(selected) < len(candidates)
+        for area_index, area in enumerate(self.areas):
+            if area_id_list and area["area_id"] not in area_id_list:
+                continue
+            devices = by_area.get(area_index, [])
+            if devices or not trimmed:
+                result.append({area["area_name"]: devices})
+        return result
+
+    def _entity_info(self, entity):
+        return {
+            entity["entity"]["entity_id"]: {"services": entity["services"]},
+            "state": self.ha_storage.get_entity_state(entity["entity"]),
+        }
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import functools
 import time
 
 from metagpt.roles import Role
@@ -10,17 +12,21 @@ from metagpt.actions import Action
 from metagpt.utils.common import OutputParser
 from metagpt.utils.parse_html import WebPage
 
+from homeassistant.ha_client import HaClient
+from homeassistant.ha_time import convert_utc_to_local
+from homeassistant.ha_state_mirror import HaStateMirror
+from homeassistant.ha_history_store import HaHistoryStore
 from homeassistant.homeassistant_storage import HaStorage
+from mihagpt.agents.intent_router import IntentRouter, guess_next_step, router_stats
+from mihagpt.agents.entity_catalog import EntityCatalog, count_tokens
 
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.keys import Keys
 
 from pathlib import Path
 from typing import Any, Callable, ClassVar
-from requests import post, get
 from datetime import datetime
 import urllib.parse
-import pytz
 import ruamel.yaml
 import uuid
 from ruamel.yaml.compat import StringIO
@@ -39,20 +45,34 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions
 
-# hass相关的全局变量
-areas = []
-area_id_list = []
-devices = []
-entity_type = []
-entities = []
-
 read_entity_limit = 30
 
+
+class TurnContext:
+    """
+    一个 Team 的对话中选出的区域和实体
+
+    Doorman 和 Interpreter 共用，Evaluate 要求再次控制时沿用。每个 Team 一份，不同音箱并发的对话互不影响
+    """
+
+    def __init__(self):
+        self.areas = []
+        self.area_id_list = []
+        self.devices = []
+        self.entity_type = []
+        self.entities = []
+
 AUTOMATION_YAML_PATH = '/data/homeassistant/automations.yaml'
 
 
 # AUTOMATION_YAML_PATH = './automations.yaml'
 
+
+@functools.lru_cache(maxsize=None)
+def load_llm_config(path) -> Config:
+    """大模型配置文件只解析一次，所有角色共用同一个 Config，相同配置的 Action 共用 LLM 客户端和连接池"""
+    return Config.from_yaml_file(Path(path))
+
 def scrape_website(driver, url):
     try:
         driver.get(url)
@@ -96,25 +116,6 @@ def update_entity_type(entity_type):
     return entity_type
 
 
-def convert_utc_to_local(json_data, local_tz='Asia/Shanghai'):
-    # 正则表达式匹配 UTC 时间格式
-    utc_time_pattern = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?\+00:00')
-    local_timezone = pytz.timezone(local_tz)
-
-    def convert_time(match):
-        utc_time_str = match.group(0)
-        # 将时间字符串转换为 datetime 对象
-        utc_dt = datetime.fromisoformat(utc_time_str.replace('Z', '+00:00'))
-        # 将 UTC 时间转换为本地时区时间
-        local_dt = utc_dt.astimezone(local_timezone)
-        return local_dt.isoformat()
-
-    # 转换 JSON 数据中的所有 UTC 时间字符串
-    json_str = json.dumps(json_data, ensure_ascii=False)
-    converted_json_str = utc_time_pattern.sub(convert_time, json_str)
-    return json.loads(converted_json_str)
-
-
 def parse_jason_code(rsp):
     pattern = r"```json(.*)```"
     match = re.search(pattern, rsp, re.DOTALL)
@@ -145,9 +146,24 @@ def is_yaml(yaml_str):
     return True
 
 
-# 通过ha的rest api获取实体的状态
-def get_entity_state_in_cache(entity_id):
-    ha_storage = HaStorage()
+# 取最近一次用户的输入，run_project 发出的内容为 {"user": "", "current_area": ""}
+def latest_user_input(memories):
+    for msg in reversed(memories):
+        if "UserRequirement" in msg.cause_by and is_json(msg.content):
+            user_input = json.loads(msg.content)
+            if isinstance(user_input, dict):
+                return str(user_input.get("user", ""))
+    return ""
+
+
+# 从状态镜像或本地数据库获取实体的状态
+def get_entity_state_in_cache(entity_id, ha_storage: HaStorage):
+    # 只读这个家的镜像和本地数据库
+    mirror = ha_storage.state_mirror
+    if mirror is not None and mirror.ready:
+        state = mirror.get(entity_id)
+        if state:
+            return state
     entities = ha_storage.get_entity_by_id(entity_id)
     if entities and isinstance(entities, list):
         return entities[0]
@@ -156,9 +172,8 @@ def get_entity_state_in_cache(entity_id):
 
 
 # 通过ha的rest api获取实体的状态
-def get_entities_history_rest_api(entity_id_list, ha_address, ha_port, token, timestamp, end_time):
-    def translate(response_data):
-        history = json.loads(response_data)
+async def get_entities_history_rest_api(entity_id_list, ha_address, ha_port, token, timestamp, end_time):
+    def translate(history):
 
         result = []
 
@@ -171,160 +186,148 @@ def get_entities_history_rest_api(entity_id_list, ha_address, ha_port, token, ti
                 result.append(entity_history)
         return result
 
-    base_url = "http://" + ha_address + ":" + ha_port + "/api/history/period"
+    path = "/api/history/period"
     if timestamp:
-        base_url += "/" + timestamp
-
-    entities = ""
-    for entity_id in entity_id_list:
-        entities += entity_id + ","
-
-    entities = entities[:-1]
+        path += "/" + timestamp
 
     params = {
         "end_time": end_time,
-        "filter_entity_id": entities
+        "filter_entity_id": ",".join(entity_id_list)
     }
 
-    encoded_url = f"{base_url}?{urllib.parse.urlencode(params)}"
-
-    encoded_url += "&minimal_response&no_attributes&significant_changes_only"
-
-    # if end_time:
-    #     url += "&end_time=" + end_time
-    headers = {
-        "Authorization": "Bearer " + token
-    }
+    encoded_path = f"{path}?{urllib.parse.urlencode(params)}"
 
-    # logger.info(f"get_entities_history_rest_api: {encoded_url}")
+    encoded_path += "&minimal_response&no_attributes&significant_changes_only"
 
-    response = get(encoded_url, headers=headers)
+    # logger.info(f"get_entities_history_rest_api: {encoded_path}")
 
-    if response.status_code == 200:
-        # print(response.text)
-        response_local = convert_utc_to_local(response.text)
+    status, body = await HaClient.shared(ha_address, ha_port, token).get(encoded_path)
 
-        # 解析 JSON 字符串为 Python 对象
-        entity = translate(response_local)
+    if status == 200:
+        entity = translate(convert_utc_to_local(body))
 
         return entity
     else:
-        logger.error(f"Error: Received response with status code {response.status_code}")
+        logger.error(f"Error: Received response with status code {status}")
         return None
 
 
 # 通过ha的rest api获取实体的状态
-def get_entity_state_rest_api(entity_id, ha_address, ha_port, token):
-    url = "http://" + ha_address + ":" + ha_port + "/api/states/" + entity_id
-    headers = {
-        "Authorization": "Bearer " + token
-    }
-
-    response = get(url, headers=headers)
+async def get_entity_state_rest_api(entity_id, ha_address, ha_port, token):
+    status, body = await HaClient.shared(ha_address, ha_port, token).get("/api/states/" + entity_id)
 
-    if response.status_code == 200:
-        # print(response.text)
-        response_local = convert_utc_to_local(response.text)
-
-        # 解析 JSON 字符串为 Python 对象
-        entity = json.loads(response_local)
+    if status == 200:
+        # 解析 JSON 并转换为本地时间
+        entity = convert_utc_to_local(body)
 
         return entity
     else:
-        logger.error(f"Error: Received response with status code {response.status_code}")
+        logger.error(f"Error: Received response with status code {status}")
         return None
 
 
 # 通过ha的rest api获取所有实体的状态
-def get_entity_states_rest_api(ha_address, ha_port, token):
-    url = "http://" + ha_address + ":" + ha_port + "/api/states"
-    headers = {
-        "Authorization": "Bearer " + token
-    }
+async def get_entity_states_rest_api(ha_address, ha_port, token):
+    status, body = await HaClient.shared(ha_address, ha_port, token).get("/api/states")
 
-    response = get(url, headers=headers)
-
-    if response.status_code == 200:
-        # print(response.text)
-        response_local = convert_utc_to_local(response.text)
-
-        # 解析 JSON 字符串为 Python 对象
-        entity = json.loads(response_local)
+    if status == 200:
+        # 解析 JSON 并转换为本地时间
+        entity = convert_utc_to_local(body)
 
         return entity
     else:
-        logger.error(f"Error: Received response with status code {response.status_code}")
+        logger.error(f"Error: Received response with status code {status}")
         return None
 
 
-# 通过ha的rest api调用服务
-def call_ha_service_rest_api(entity_id, service, option_name, option, ha_address, ha_port, token):
-    domain = entity_id.split(".")[0]
+# 批量读取实体的状态，根据代价模型选择并发逐个读取或者读取全部实体后过滤
+async def get_entity_states_bulk(entity_id_list, ha_address, ha_port, token):
+    # 状态镜像中有全部实体时不访问网络
+    mirror = HaStateMirror.find(ha_address, ha_port, token)
+    if mirror and mirror.has_all(entity_id_list):
+        return convert_utc_to_local(mirror.get_many(entity_id_list))
 
-    url = "http://" + ha_address + ":" + ha_port + "/api/services/" + domain + "/" + service
-    headers = {
-        "Authorization": "Bearer " + token
-    }
+    client = HaClient.shared(ha_address, ha_port, token)
+    if client.prefer_full_states(len(entity_id_list), read_entity_limit):
+        status, body = await client.get("/api/states")
+        if status != 200:
+            logger.error(f"Error: Received response with status code {status}")
+            return []
+        wanted = set(entity_id_list)
+        by_id = {entity["entity_id"]: entity for entity in json.loads(body) if entity["entity_id"] in wanted}
+        # 只转换需要的实体的时间
+        return convert_utc_to_local([by_id[entity_id] for entity_id in entity_id_list if entity_id in by_id])
+
+    # 并发数由客户端的连接池大小限制
+    semaphore = asyncio.Semaphore(client.limit)
 
-    json_data = {}
+    async def read(entity_id):
+        async with semaphore:
+            return await get_entity_state_rest_api(entity_id, ha_address, ha_port, token)
+
+    states = await asyncio.gather(*(read(entity_id) for entity_id in entity_id_list))
+    return [state for state in states if state]
+
+
+# 调用服务时改变的是其他实体状态的 domain
+INDIRECT_DOMAINS = {"scene", "script", "group", "automation"}
+
+
+def build_service_data(entity_id, option_name, option):
     if option_name and option_name != "NA" and option_name != "hvac_mode/NA" and option and option != "NA" and option != "cool/NA":
-        json_data = {
+        return {
             "entity_id": entity_id,
             option_name: option
         }
     else:
-        json_data = {
+        return {
             "entity_id": entity_id
         }
 
-    logger.info(f"ha url:{url}, ha headers:{headers}, ha json:{json_data}")
 
-    response = post(url, headers=headers, json=json_data)
+# 通过ha的rest api调用服务，entity_id 可以是同一 domain 下的实体 id 列表
+async def call_ha_service_rest_api(entity_id, service, option_name, option, ha_address, ha_port, token):
+    first_entity_id = entity_id[0] if isinstance(entity_id, list) else entity_id
+    domain = first_entity_id.split(".")[0]
 
-    if response.status_code == 200:
-        # print(response.text)
-        response_local = convert_utc_to_local(response.text)
+    path = "/api/services/" + domain + "/" + service
 
-        # 解析 JSON 字符串为 Python 对象
-        result = json.loads(response_local)
+    json_data = build_service_data(entity_id, option_name, option)
+
+    logger.info(f"ha path:{path}, ha json:{json_data}")
+
+    status, body = await HaClient.shared(ha_address, ha_port, token).post(path, json=json_data)
+
+    if status == 200:
+        # 解析 JSON 并转换为本地时间
+        result = convert_utc_to_local(body)
 
         return result
     else:
-        logger.error(f"Error: Received response with status code {response.status_code}")
+        logger.error(f"Error: Received response with status code {status}")
         return None
 
 
 # 通过ha的rest api重新载入automation的yaml配置文件
-def reload_automation_rest_api(ha_address, ha_port, token):
-    url = "http://" + ha_address + ":" + ha_port + "/api/services/automation/reload"
-    headers = {
-        "Authorization": "Bearer " + token
-    }
+async def reload_automation_rest_api(ha_address, ha_port, token):
+    status, _ = await HaClient.shared(ha_address, ha_port, token).post("/api/services/automation/reload")
 
-    response = post(url, headers=headers)
-
-    if response.status_code == 200:
+    if status == 200:
         return True
     else:
-        logger.error(f"Error: Received response with status code {response.status_code}")
+        logger.error(f"Error: Received response with status code {status}")
         return False
 
 
 # 通过ha的rest api获取错误日志
-def get_ha_errlog_rest_api(ha_address, ha_port, token):
-    url = "http://" + ha_address + ":" + ha_port + "/api/error_log"
-    headers = {
-        "Authorization": "Bearer " + token
-    }
-
-    response = get(url, headers=headers)
+async def get_ha_errlog_rest_api(ha_address, ha_port, token):
+    status, body = await HaClient.shared(ha_address, ha_port, token).get("/api/error_log")
 
-    if response.status_code == 200:
-        # 尝试将响应内容从ISO-8859-1编码转换为UTF-8编码
-        log_content = response.content.decode('utf-8')
+    if status == 200:
+        log_content = body.decode('utf-8')
         return log_content
     else:
-        logger.error(f"Error: Received response with status code {response.status_code}")
+        logger.error(f"Error: Received response with status code {status}")
         return None
 
 
@@ -720,12 +723,15 @@ class Call_ha_service_response(Action):
         """
         entities_services格式：[{{"entity_id":"climate.xiaomi_mc5_1642_air_conditioner","service":"set_hvac_mode","option_name":"hvac_mode/NA","option":"cool/NA"}}...]
         """
-        results = []
+        # 按 (domain, service, 参数) 分组，每组调用一次服务，同一阶段的组并发调用。
+        # 同一个实体再次出现时开始新的阶段，保证同一实体的服务按大模型给出的顺序执行
+        calls = []
+        stages = [{}]
+        touched = set()
         if entities_services and isinstance(entities_services, list):
             for entity_service in entities_services:
                 if "entities" in entity_service and entity_service["entities"] and isinstance(
                         entity_service["entities"], list):
-                    entities = entity_service["entities"]
                     for entity in entity_service["entities"]:
                         entity_id = entity["entity_id"]
                         service = entity["service"]
@@ -737,10 +743,42 @@ class Call_ha_service_response(Action):
                                 option_name = mode
                                 option = entity["option"]
 
-                        result = call_ha_service_rest_api(entity_id, service, option_name, option, ha_address, ha_port,
-                                                          token)
-                        # result = "home assistant空调已成功切换到制冷模式。当前温度为34.8°C，设定温度为26.0°C。"
-                        results.append(result)
+                        domain = entity_id.split(".")[0]
+                        data = json.dumps(build_service_data("", option_name, option), sort_keys=True)
+                        # 场景、脚本、群组改变的是其他实体的状态，单独调用，保留完整的结果
+                        key = (domain, service, data, entity_id if domain in INDIRECT_DOMAINS else "")
+                        groups = stages[-1]
+                        if entity_id in touched and entity_id not in groups.get(key, {}).get("entity_ids", []):
+                            groups = {}
+                            stages.append(groups)
+                            touched = set()
+                        if key not in groups:
+                            groups[key] = {"entity_ids": [], "service": service, "option_name": option_name, "option": option}
+                        if entity_id not in groups[key]["entity_ids"]:
+                            groups[key]["entity_ids"].append(entity_id)
+                        touched.add(entity_id)
+                        calls.append((entity_id, len(stages) - 1, key))
+
+        async def call_group(group):
+            try:
+                return await call_ha_service_rest_api(group["entity_ids"], group["service"], group["option_name"],
+                                                      group["option"], ha_address, ha_port, token)
+            except Exception as e:
+                logger.error(f"call ha service error: {e}")
+                return None
+
+        stage_results = []
+        for groups in stages:
+            group_results = await asyncio.gather(*(call_group(group) for group in groups.values()))
+            stage_results.append(dict(zip(groups.keys(), group_results)))
+
+        # 每个实体的结果保持原来的格式：该实体被改变的状态列表，调用失败为 None
+        results = []
+        for entity_id, stage, key in calls:
+            result = stage_results[stage][key]
+            if isinstance(result, list) and len(stages[stage][key]["entity_ids"]) > 1:
+                result = [state for state in result if state.get("entity_id") == entity_id]
+            results.append(result)
 
         return json.dumps(results, ensure_ascii=False)
 
@@ -849,10 +887,10 @@ class Judger(Role):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        gpt4o_llm = Config.from_yaml_file(Path("config/gpt4o.yaml"))
-        gpt4o_ca_llm = Config.from_yaml_file(Path("config/gpt4o_ca.yaml"))
-        gpt4o_mini_llm = Config.from_yaml_file(Path("config/gpt4omini.yaml"))
-        kimiai_8k_llm = Config.from_yaml_file(Path("config/kimiai_8k.yaml"))
+        gpt4o_llm = load_llm_config("config/gpt4o.yaml")
+        gpt4o_ca_llm = load_llm_config("config/gpt4o_ca.yaml")
+        gpt4o_mini_llm = load_llm_config("config/gpt4omini.yaml")
+        kimiai_8k_llm = load_llm_config("config/kimiai_8k.yaml")
 
         self._watch(
             [Read_ha_state_response, Call_ha_service_response, Read_ha_history_response, Gen_ha_automation, SearchWeb])
@@ -895,8 +933,17 @@ class Read_ha_history_response(Action):
     async def run(self, context: str, entity_id_list, ha_address, ha_port, token, start_time, end_time):
         entities_history = []
         if entity_id_list:
-            states = get_entities_history_rest_api(entity_id_list, ha_address, ha_port, token, start_time, end_time)
-            entities_history.extend(states)
+            # 有本地历史缓存时只请求缓存之外的部分，较长的历史汇总后返回
+            history_store = HaHistoryStore.find(ha_address, ha_port, token)
+            states = None
+            if history_store:
+                try:
+                    states = await history_store.history(entity_id_list, start_time, end_time)
+                except Exception as e:
+                    logger.warning(f"read history from local store error: {e}")
+            if states is None:
+                states = await get_entities_history_rest_api(entity_id_list, ha_address, ha_port, token, start_time, end_time)
+            entities_history.extend(states or [])
 
         return json.dumps(entities_history, ensure_ascii=False)
 
@@ -980,11 +1027,11 @@ class Gen_ha_automation(Action):
                 with open(file_path, 'w', encoding='utf-8') as file:
                     file.write(stream.getvalue())
 
-        reload_result = reload_automation_rest_api(ha_address, ha_port, token)
+        reload_result = await reload_automation_rest_api(ha_address, ha_port, token)
         error_list = []
 
         if reload_result:
-            errlog = get_ha_errlog_rest_api(ha_address, ha_port, token)
+            errlog = await get_ha_errlog_rest_api(ha_address, ha_port, token)
             for alias in alias_list:
                 now = datetime.now()
                 # error = self.find_log_segment(errlog, '打开一楼办公室灯', now, time_delta=10)
@@ -1033,10 +1080,10 @@ class Actuator(Role):
         self.ha_token = ha_token
         self.web_driver = web_driver
 
-        gpt4o_llm = Config.from_yaml_file(Path("config/gpt4o.yaml"))
-        gpt4o_ca_llm = Config.from_yaml_file(Path("config/gpt4o_ca.yaml"))
-        gpt4o_mini_llm = Config.from_yaml_file(Path("config/gpt4omini.yaml"))
-        kimiai_8k_llm = Config.from_yaml_file(Path("config/kimiai_8k.yaml"))
+        gpt4o_llm = load_llm_config("config/gpt4o.yaml")
+        gpt4o_ca_llm = load_llm_config("config/gpt4o_ca.yaml")
+        gpt4o_mini_llm = load_llm_config("config/gpt4omini.yaml")
+        kimiai_8k_llm = load_llm_config("config/kimiai_8k.yaml")
 
         self._watch([Classify_L2_R, Classify_L2_W, Classify_L2_Auto, Automation_initialize])
         self.set_actions([Read_ha_state_response(config=gpt4o_mini_llm),
@@ -1289,16 +1336,7 @@ class Read_ha_state_response(Action):
 
         entitis_states = []
         if entity_id_list and isinstance(entity_id_list, list):
-            if len(entity_id_list) <= read_entity_limit:
-                for entity_id in entity_id_list:
-                    state_info = {}
-                    entity_state = get_entity_state_rest_api(entity_id, ha_address, ha_port, token)
-                    # entity_state = get_entity_state_in_cache(sensor)
-                    if entity_state:
-                        entitis_states.append(entity_state)
-            else:
-                all_entities = get_entity_states_rest_api(ha_address, ha_port, token)
-                entitis_states = [entity for entity in all_entities if entity['entity_id'] in entity_id_list]
+            entitis_states = await get_entity_states_bulk(entity_id_list, ha_address, ha_port, token)
 
         return json.dumps(entitis_states, ensure_ascii=False)
 
@@ -1378,12 +1416,15 @@ class Classify_L2_R(Action):
     """
 
     async def run(self, context, ha_storage: HaStorage, area_id_list, area_list, entity_list):
-        global entity_type
         now = datetime.now()
         classifier_prompt = self.CLASSIFY_PROMPT_TEMPLATE.format(context=context, entity_list=entity_list,
                                                                  area_list=area_list, time=now)
         logger.info(f"分类器提示词：{classifier_prompt}")
+        start = time.perf_counter()
         rsp_classifier = await self._aask(classifier_prompt)
+        elapsed = time.perf_counter() - start
+        router_stats.observe_llm("L2_R", elapsed)
+        logger.info(f"{self.name} prompt {count_tokens(classifier_prompt)} tokens, llm {elapsed:.1f}s")
         logger.info(rsp_classifier)
         rsp_result = parse_jason_code(rsp_classifier)
 
@@ -1467,12 +1508,15 @@ class Classify_L2_W(Action):
     """
 
     async def run(self, context, ha_storage: HaStorage, area_id_list, area_list, entity_list):
-        global entity_type
         now = datetime.now()
         classifier_prompt = self.CLASSIFY_PROMPT_TEMPLATE.format(context=context, entity_list=entity_list,
                                                                  area_list=area_list, time=now)
         logger.info(f"分类器提示词：{classifier_prompt}")
+        start = time.perf_counter()
         rsp_classifier = await self._aask(classifier_prompt)
+        elapsed = time.perf_counter() - start
+        router_stats.observe_llm("L2_W", elapsed)
+        logger.info(f"{self.name} prompt {count_tokens(classifier_prompt)} tokens, llm {elapsed:.1f}s")
         logger.info(rsp_classifier)
         rsp_result = parse_jason_code(rsp_classifier)
 
@@ -1591,12 +1635,14 @@ class Classify_L2_Auto(Action):
     """
 
     async def run(self, context, ha_storage: HaStorage, area_id_list, area_list, entity_list):
-        global entity_type
         now = datetime.now()
         classifier_prompt = self.CLASSIFY_PROMPT_TEMPLATE.format(context=context, entity_list=entity_list,
                                                                  area_list=area_list, time=now)
         logger.info(f"分类器提示词：{classifier_prompt}")
+        start = time.perf_counter()
         rsp_classifier = await self._aask(classifier_prompt)
+        logger.info(f"{self.name} prompt {count_tokens(classifier_prompt)} tokens, "
+                    f"llm {time.perf_counter() - start:.1f}s")
         logger.info(rsp_classifier)
 
         yaml = parse_yaml_code(rsp_classifier)
@@ -1688,12 +1734,14 @@ class Automation_initialize(Action):
     """
 
     async def run(self, area_list, entity_list):
-        global entity_type
         now = datetime.now()
         automation_prompt = self.AUTOMATION_PROMPT_TEMPLATE.format(entity_list=entity_list,
                                                                    area_list=area_list, time=now)
         logger.info(f"自动化初始化提示词：{automation_prompt}")
+        start = time.perf_counter()
         rsp = await self._aask(automation_prompt)
+        logger.info(f"{self.name} prompt {count_tokens(automation_prompt)} tokens, "
+                    f"llm {time.perf_counter() - start:.1f}s")
         logger.info(rsp)
 
         yaml = parse_yaml_code(rsp)
@@ -1706,6 +1754,93 @@ class Automation_initialize(Action):
         return json.dumps(result, ensure_ascii=False)
 
 
+class SpeculationStats:
+    """推测执行 L2 分类的命中率和浪费的 token"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.wasted_tokens = 0
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"speculation hit {self.hits}/{total} ({rate:.0%}), wasted about {self.wasted_tokens} tokens"
+
+
+speculation_stats = SpeculationStats()
+
+
+class Speculator:
+    """
+    L1 分类的同时推测执行 L2 分类
+
+    Doorman 调用 Classify_L1 前按说法猜测结果，用整个家的设备实体列表（有 EntityCatalog 时按 token 预算选择）
+    先开始对应的 Classify_L2_R/W/Auto。L1 的结果一致时 Interpreter 直接使用推测的结果，不一致时取消。
+    每个 Team 一个，由 Doorman 和 Interpreter 共用
+    """
+    STEP_ACTIONS: ClassVar[dict] = {2: Classify_L2_R, 3: Classify_L2_W, 4: Classify_L2_Auto}
+
+    def __init__(self, ha_storage: HaStorage, entity_catalog: EntityCatalog = None):
+        self.ha_storage = ha_storage
+        self.entity_catalog = entity_catalog
+        gpt4o_mini_llm = load_llm_config("config/gpt4omini.yaml")
+        self.actions = {step: action(config=gpt4o_mini_llm) for step, action in self.STEP_ACTIONS.items()}
+        self.step = None
+        self.task = None
+        self.tokens = 0
+
+    def start(self, context, user_input):
+        self.cancel()
+        step = guess_next_step(user_input)
+        if step is None:
+            return
+        areas = self.ha_storage.get_all_areas()
+        if self.entity_catalog is not None:
+            entities = self.entity_catalog.select([], [], user_input)
+        else:
+            entities = self.ha_storage.get_simplified_devices_entities_with_description_list([], [])
+        action = self.actions[step]
+        self.step = step
+        self.tokens = count_tokens(action.CLASSIFY_PROMPT_TEMPLATE + context + str(areas) + str(entities))
+        self.task = asyncio.create_task(action.run(context, self.ha_storage, [], areas, entities))
+        logger.info(f"speculatively run {action.name}")
+
+    def resolve(self, l1_result):
+        """L1 分类完成后调用，结果不一致时取消推测的 L2 分类"""
+        if self.task is None:
+            return
+        step = None
+        if is_json(l1_result):
+            msg = json.loads(l1_result)
+            if isinstance(msg, dict):
+                step = msg.get("next_step")
+        if step == self.step:
+            speculation_stats.hits += 1
+        else:
+            speculation_stats.misses += 1
+            speculation_stats.wasted_tokens += self.tokens
+            self.cancel()
+        logger.info(speculation_stats.report())
+
+    async def take(self, step):
+        """返回和 step 一致的推测结果，没有时返回 None"""
+        if self.task is None or step != self.step:
+            return None
+        task, self.task, self.step = self.task, None, None
+        try:
+            return await task
+        except Exception as e:
+            logger.warning(f"speculative classification error: {e}")
+            return None
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+        self.step = None
+
+
 class Interpreter(Role):
     name: str = "Interpreter"
     profile: str = "Interpreter"
@@ -1714,18 +1849,23 @@ class Interpreter(Role):
     get_memories: ClassVar[callable]
     _think: ClassVar[callable]
 
-    def __init__(self, tts_callback, listen_callback, ha_storage: HaStorage, web_driver, **kwargs):
+    def __init__(self, tts_callback, listen_callback, ha_storage: HaStorage, web_driver,
+                 entity_catalog: EntityCatalog = None, speculator: Speculator = None,
+                 turn_context: TurnContext = None, **kwargs):
         super().__init__(**kwargs)
+        self.speculator = speculator
+        self.turn_context = turn_context or TurnContext()
 
         self.tts_callback = tts_callback
         self.listen_callback = listen_callback
         self.ha_storage = ha_storage
         self.web_driver = web_driver
+        self.entity_catalog = entity_catalog
 
-        gpt4o_llm = Config.from_yaml_file(Path("config/gpt4o.yaml"))
-        gpt4o_ca_llm = Config.from_yaml_file(Path("config/gpt4o_ca.yaml"))
-        gpt4o_mini_llm = Config.from_yaml_file(Path("config/gpt4omini.yaml"))
-        kimiai_8k_llm = Config.from_yaml_file(Path("config/kimiai_8k.yaml"))
+        gpt4o_llm = load_llm_config("config/gpt4o.yaml")
+        gpt4o_ca_llm = load_llm_config("config/gpt4o_ca.yaml")
+        gpt4o_mini_llm = load_llm_config("config/gpt4omini.yaml")
+        kimiai_8k_llm = load_llm_config("config/kimiai_8k.yaml")
 
         self._watch([Classify_L1, Evaluate])
         self.set_actions(
@@ -1738,7 +1878,7 @@ class Interpreter(Role):
         self._set_react_mode(react_mode=RoleReactMode.BY_ORDER.value)
 
     async def _act(self) -> Message:
-        global areas, area_id_list, devices, entity_type, entities
+        ctx = self.turn_context
         news = self.rc.news[0]
         logger.info(f"Interpreter news:{news}")
         todo = self.rc.todo
@@ -1796,15 +1936,16 @@ class Interpreter(Role):
                                 # self.tts_callback.say_sync(msg["tips"])
                                 logger.info(f"msg['tips']:{msg['tips']}")
                             # self.rc.todo = Classify_L2_R()
-                            area_id_list = msg["area_ids"]
-                            areas = self.ha_storage.get_areas_by_id_list(area_id_list)
-                            entity_type = msg["entity type"]
-                            entity_type = update_entity_type(entity_type)
-                            entities = self.ha_storage.get_simplified_devices_entities_with_description_list(
-                                msg["area_ids"], entity_type)
-                            devices = self.ha_storage.get_simplified_device_list(msg["area_ids"], [])
+                            ctx.area_id_list = msg["area_ids"]
+                            ctx.areas = self.ha_storage.get_areas_by_id_list(ctx.area_id_list)
+                            ctx.entity_type = msg["entity type"]
+                            ctx.entity_type = update_entity_type(ctx.entity_type)
+                            ctx.entities = self.get_entities(msg["area_ids"], ctx.entity_type, msg)
+                            ctx.devices = self.ha_storage.get_simplified_device_list(msg["area_ids"], [])
 
-                            code_text = await todo.run(context, self.ha_storage, area_id_list, areas, entities)
+                            code_text = await self.take_speculation(news, msg["next_step"])
+                            if code_text is None:
+                                code_text = await todo.run(context, self.ha_storage, ctx.area_id_list, ctx.areas, ctx.entities)
 
                             msg = Message(content=code_text, role=self.name, cause_by=type(todo))
                             return msg
@@ -1815,49 +1956,50 @@ class Interpreter(Role):
                                 logger.info(f"msg['tips']:{msg['tips']}")
                             # self.rc.todo = Classify_L2_W()
                             if "AskUserToConfirm" in news.cause_by or "Evaluate" in news.cause_by:
-                                code_text = await todo.run(context, self.ha_storage, area_id_list, areas, entities)
+                                code_text = await todo.run(context, self.ha_storage, ctx.area_id_list, ctx.areas, ctx.entities)
 
                                 msg = Message(content=code_text, role=self.name, cause_by=type(todo))
                                 return msg
                             else:
-                                area_id_list = msg["area_ids"]
-                                areas = self.ha_storage.get_areas_by_id_list(area_id_list)
-                                entity_type = msg["entity type"]
-                                entity_type = update_entity_type(entity_type)
-                                entities = self.ha_storage.get_simplified_devices_entities_with_description_list(
-                                    msg["area_ids"], entity_type)
-                                devices = self.ha_storage.get_simplified_device_list(msg["area_ids"], [])
+                                ctx.area_id_list = msg["area_ids"]
+                                ctx.areas = self.ha_storage.get_areas_by_id_list(ctx.area_id_list)
+                                ctx.entity_type = msg["entity type"]
+                                ctx.entity_type = update_entity_type(ctx.entity_type)
+                                ctx.entities = self.get_entities(msg["area_ids"], ctx.entity_type, msg)
+                                ctx.devices = self.ha_storage.get_simplified_device_list(msg["area_ids"], [])
 
-                                code_text = await todo.run(context, self.ha_storage, area_id_list, areas, entities)
+                                code_text = await self.take_speculation(news, msg["next_step"])
+                                if code_text is None:
+                                    code_text = await todo.run(context, self.ha_storage, ctx.area_id_list, ctx.areas, ctx.entities)
 
                                 msg = Message(content=code_text, role=self.name, cause_by=type(todo))
                                 return msg
                         elif "next_step" in msg and msg["next_step"] == 4:
                             # self.rc.todo = Classify_L2_Auto(self.tts_callback)
                             if "Evaluate" in news.cause_by:
-                                code_text = await todo.run(context, self.ha_storage, area_id_list, areas, entities)
+                                code_text = await todo.run(context, self.ha_storage, ctx.area_id_list, ctx.areas, ctx.entities)
 
                                 msg = Message(content=code_text, role=self.name, cause_by=type(todo))
                                 return msg
                             else:
-                                area_id_list = msg["area_ids"]
-                                areas = self.ha_storage.get_areas_by_id_list(area_id_list)
-                                entity_type = msg["entity type"]
-                                entity_type = update_entity_type(entity_type)
-                                entities = self.ha_storage.get_simplified_devices_entities_with_description_list(
-                                    msg["area_ids"], entity_type)
-                                devices = self.ha_storage.get_simplified_device_list(msg["area_ids"], [])
+                                ctx.area_id_list = msg["area_ids"]
+                                ctx.areas = self.ha_storage.get_areas_by_id_list(ctx.area_id_list)
+                                ctx.entity_type = msg["entity type"]
+                                ctx.entity_type = update_entity_type(ctx.entity_type)
+                                ctx.entities = self.get_entities(msg["area_ids"], ctx.entity_type, msg)
+                                ctx.devices = self.ha_storage.get_simplified_device_list(msg["area_ids"], [])
 
-                                code_text = await todo.run(context, self.ha_storage, area_id_list, areas, entities)
+                                code_text = await self.take_speculation(news, msg["next_step"])
+                                if code_text is None:
+                                    code_text = await todo.run(context, self.ha_storage, ctx.area_id_list, ctx.areas, ctx.entities)
 
                                 msg = Message(content=code_text, role=self.name, cause_by=type(todo))
                                 return msg
                         elif "next_step" in msg and msg["next_step"] == 10:
                             # self.rc.todo = Automation_initialize(self.tts_callback)
-                            areas = self.ha_storage.get_all_areas()
-                            entities = self.ha_storage.get_simplified_devices_entities_with_description_list(
-                                [], [])
-                            code_text = await todo.run(areas, entities)
+                            ctx.areas = self.ha_storage.get_all_areas()
+                            ctx.entities = self.get_entities([], [], msg)
+                            code_text = await todo.run(ctx.areas, ctx.entities)
 
                             msg = Message(content=code_text, role=self.name, cause_by=type(todo))
                             return msg
@@ -1935,6 +2077,22 @@ class Interpreter(Role):
         self.set_todo(self.actions[7])
         return self.rc.todo
 
+    def get_entities(self, area_id_list, entity_type_list, msg):
+        """Classify_L2 提示词中的设备实体列表，有 EntityCatalog 时按 token 预算选择和需求相关的设备"""
+        if self.entity_catalog is None:
+            return self.ha_storage.get_simplified_devices_entities_with_description_list(area_id_list, entity_type_list)
+        query = self.get_user_input() + str(msg.get("requirement analysis", ""))
+        return self.entity_catalog.select(area_id_list, entity_type_list, query)
+
+    def get_user_input(self):
+        return latest_user_input(self.rc.memory.get())
+
+    async def take_speculation(self, news, step):
+        # 只有 L1 分类的结果可以使用推测执行的 L2 分类
+        if self.speculator is None or "Classify_L1" not in news.cause_by:
+            return None
+        return await self.speculator.take(step)
+
     def get_memories(self, k=0):
         context = self.rc.memory.get(k=k)
 
@@ -1987,7 +2145,11 @@ class Classify_L1(Action):
     async def run(self, context: str, areas):
         classifier_prompt = self.CLASSIFY_PROMPT_TEMPLATE.format(user_input=context, areas=areas)
         logger.info(f"分类器L1提示词：{classifier_prompt}")
+        start = time.perf_counter()
         rsp_classifier = await self._aask(classifier_prompt)
+        elapsed = time.perf_counter() - start
+        router_stats.observe_llm("L1", elapsed)
+        logger.info(f"{self.name} prompt {count_tokens(classifier_prompt)} tokens, llm {elapsed:.1f}s")
         logger.info(rsp_classifier)
         rsp_result = parse_jason_code(rsp_classifier)
 
@@ -2000,15 +2162,20 @@ class Doorman(Role):
 
     _act: ClassVar[callable]
 
-    def __init__(self, ha_storage: HaStorage, **kwargs):
+    def __init__(self, ha_storage: HaStorage, intent_router: IntentRouter = None, speculator: Speculator = None,
+                 turn_context: TurnContext = None, **kwargs):
         super().__init__(**kwargs)
+        self.turn_context = turn_context or TurnContext()
 
         self.areas = ha_storage.get_all_areas()
+        self.ha_storage = ha_storage
+        self.intent_router = intent_router
+        self.speculator = speculator
 
-        gpt4o_llm = Config.from_yaml_file(Path("config/gpt4o.yaml"))
-        gpt4o_ca_llm = Config.from_yaml_file(Path("config/gpt4o_ca.yaml"))
-        gpt4o_mini_llm = Config.from_yaml_file(Path("config/gpt4omini.yaml"))
-        kimiai_8k_llm = Config.from_yaml_file(Path("config/kimiai_8k.yaml"))
+        gpt4o_llm = load_llm_config("config/gpt4o.yaml")
+        gpt4o_ca_llm = load_llm_config("config/gpt4o_ca.yaml")
+        gpt4o_mini_llm = load_llm_config("config/gpt4omini.yaml")
+        kimiai_8k_llm = load_llm_config("config/kimiai_8k.yaml")
 
         self._watch([UserRequirement])
         self.set_actions([Classify_L1(config=gpt4o_mini_llm)])
@@ -2016,10 +2183,47 @@ class Doorman(Role):
     async def _act(self) -> Message:
         todo = self.rc.todo
 
+        routed = self._route()
+        if routed:
+            return routed
+
         context = self.get_memories()
         if isinstance(context, list):
             context = str(context)
+        if self.speculator is not None:
+            self.speculator.start(context, self.get_user_input())
         code_text = await todo.run(context, self.areas)
+        if self.speculator is not None:
+            self.speculator.resolve(code_text)
         msg = Message(content=code_text, role=self.name, cause_by=type(todo))
 
         return msg
+
+    def get_user_input(self):
+        return latest_user_input(self.rc.memory.get())
+
+    def _route(self):
+        """本地路由命中时直接发出 L2 分类的结果，由 Actuator 执行，跳过 L1 和 L2 的大模型分类"""
+        ctx = self.turn_context
+        if self.intent_router is None or not self.rc.news:
+            return None
+        # Team 在各轮之间复用，记忆一直累积，只看这一轮刚收到的用户问题
+        msg = self.rc.news[-1]
+        memories = self.rc.memory.get()
+        if "UserRequirement" not in msg.cause_by or memories[-1] is not msg or not is_json(msg.content):
+            return None
+        user_input = json.loads(msg.content)
+        if not isinstance(user_input, dict):
+            return None
+        result = self.intent_router.route(user_input.get("user", ""), user_input.get("current_area", ""))
+        if result is None:
+            return None
+
+        # 和 Interpreter 一样记下区域和实体，后续 Evaluate 要求再次控制时使用
+        ctx.area_id_list, ctx.entity_type = self.intent_router.selected_areas(result)
+        ctx.areas = self.ha_storage.get_areas_by_id_list(ctx.area_id_list)
+        ctx.entities = self.ha_storage.get_simplified_devices_entities_with_description_list(ctx.area_id_list, ctx.entity_type)
+        ctx.devices = self.ha_storage.get_simplified_device_list(ctx.area_id_list, [])
+
+        cause_by = Classify_L2_W if result["next_step"] == 3 else Classify_L2_R
+        return Message(content=json.dumps(result, ensure_ascii=False), role=self.name, cause_by=cause_by)
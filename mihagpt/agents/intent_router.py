@@ -0,0 +1,322 @@
+import logging
+import math
+import re
+import time
+from collections import Counter
+
+from homeassistant.homeassistant_storage import HaStorage
+
+logger = logging.getLogger("xiaogpt")
+
+# 控制指令的动词，按长度从长到短匹配
+COMMAND_VERBS = {
+    "turn_on": ["打开", "开启", "开一下", "开开", "开"],
+    "turn_off": ["关闭", "关掉", "关上", "关一下", "关"],
+}
+# 窗帘的开关对应的服务
+COVER_SERVICES = {"turn_on": "open_cover", "turn_off": "close_cover"}
+# 查询状态的说法
+QUERY_WORDS = ["是多少", "多少度", "有多少", "多少", "几度", "开着吗", "关着吗", "开了吗", "关了吗",
+               "状态", "怎么样", "是否", "吗", "呢"]
+# 需要大模型理解的说法：历史、条件、定时、设置参数、多个动作、否定等，遇到时交给大模型
+FALLBACK_PATTERN = re.compile(
+    r"昨天|前天|上周|上个|过去|之前|以前|历史|记录|刚才|早上|上午|中午|下午|晚上|"
+    r"如果|自动化|场景|每天|定时|分钟|小时|以后|之后|然后|并且|再|和|跟|、|"
+    r"调到|调成|调高|调低|调大|调小|设置|设为|设成|模式|档|亮度|色温|音量|\d+(?:度|%|级|分|点|秒)|"
+    r"制冷|制热|除湿|送风|自动|睡眠|静音|加热|风速|风量|摆风|扫风|"
+    r"不要|别|不用|锁|为什么|怎么|如何"
+)
+# 填充词，去掉后剩下的就是要找的设备
+FILLER_PATTERN = re.compile(r"请|帮我|帮忙|给我|麻烦|一下|把|将|的|吧|啊|了|现在|目前|当前|家里|家中|里|所有|全部")
+PUNCTUATION_PATTERN = re.compile(r"[\s,，.。!！?？~～、;；:：\"'“”‘’]")
+
+# 实体类型的常用叫法
+DOMAIN_NAMES = {
+    "light": ["灯", "灯光", "电灯"],
+    "switch": ["开关", "插座"],
+    "climate": ["空调", "温控器", "地暖"],
+    "fan": ["风扇", "电风扇", "新风"],
+    "cover": ["窗帘", "卷帘"],
+    "humidifier": ["加湿器", "除湿机"],
+    "media_player": ["电视"],
+    "vacuum": ["扫地机", "扫地机器人"],
+    "water_heater": ["热水器"],
+}
+# 传感器的常用叫法
+DEVICE_CLASS_NAMES = {
+    "temperature": ["温度", "气温"],
+    "humidity": ["湿度"],
+    "pm25": ["pm25", "空气质量"],
+    "illuminance": ["光照", "光照度"],
+    "battery": ["电量"],
+    "carbon_dioxide": ["二氧化碳"],
+    "power": ["功率"],
+    "energy": ["用电量", "耗电量"],
+}
+# 只读取状态的实体类型
+READ_DOMAINS = {"sensor", "binary_sensor"} | set(DOMAIN_NAMES)
+
+
+def normalize(text):
+    return PUNCTUATION_PATTERN.sub("", str(text).lower())
+
+
+def char_ngrams(text):
+    """单字和相邻两字组成的稀疏向量，中文设备名不需要分词"""
+    grams = Counter(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+def cosine(a, b):
+    dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+    if not dot:
+        return 0.0
+    return dot / math.sqrt(sum(v * v for v in a.values()) * sum(v * v for v in b.values()))
+
+
+def name_score(target, target_vector, name, name_vector):
+    """
+    用户说的设备和实体名称的相似度，完全相同为 1，名称包含用户说的设备时按长度比例打分，否则比较字符向量
+
+    用户说的比名称多出的字（如“空调制冷”的“制冷”、“灯带”的“带”）可能是模式或另一个设备，不按包含打分，
+    字符向量的相似度低于阈值，交给大模型处理
+    """
+    if target == name:
+        return 1.0
+    if target in name:
+        return 0.85 + 0.15 * len(target) / len(name)
+    return cosine(target_vector, name_vector)
+
+
+AUTOMATION_PATTERN = re.compile(r"自动化|场景|如果|每当|当.+时|定时|每天|每晚|每周")
+WRITE_PATTERN = re.compile(r"调到|调成|调高|调低|调大|调小|设置|设为|设成|切换")
+
+
+def guess_next_step(text):
+    """按说法猜 Classify_L1 的结果：2 读取、3 控制、4 自动化，猜不出返回 None"""
+    text = normalize(text)
+    if AUTOMATION_PATTERN.search(text):
+        return 4
+    if any(word in text for word in QUERY_WORDS):
+        return 2
+    masked = text.replace("开关", "")
+    if WRITE_PATTERN.search(text) or any(verb in masked for verbs in COMMAND_VERBS.values() for verb in verbs):
+        return 3
+    return None
+
+
+class RouterStats:
+    """本地路由的命中率，以及命中时省下的大模型分类耗时"""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.hits = 0
+        self.misses = 0
+        self.route_seconds = 0.0
+        # 没有命中时 L1、L2 分类的平均耗时
+        self.llm_seconds = {}
+
+    def observe_llm(self, stage, seconds):
+        average = self.llm_seconds.get(stage)
+        self.llm_seconds[stage] = seconds if average is None else average + self.alpha * (seconds - average)
+
+    def observe_route(self, hit, seconds):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.route_seconds += seconds
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def saved_seconds(self):
+        # 命中时省掉一次 L1 和一次 L2 分类
+        per_hit = self.llm_seconds.get("L1", 0.0) + max(
+            self.llm_seconds.get("L2_R", 0.0), self.llm_seconds.get("L2_W", 0.0))
+        return max(self.hits * per_hit - self.route_seconds, 0.0)
+
+    def report(self):
+        return (f"intent router hit {self.hits}/{self.hits + self.misses} ({self.hit_rate:.0%}), "
+                f"saved about {self.saved_seconds:.1f}s")
+
+
+router_stats = RouterStats()
+
+
+class IntentRouter:
+    """
+    本地意图路由
+
+    简单明确的设备控制（如“打开客厅灯”）和状态查询（如“卧室温度多少”）不经过大模型分类，
+    从 HaStorage 中按区域、设备名和实体类型匹配实体，直接给出和 Classify_L2_W/Classify_L2_R 相同格式的结果。
+    匹配度低于 threshold 或者说法需要理解上下文时返回 None，交给大模型处理
+    """
+
+    def __init__(self, ha_storage: HaStorage, threshold=0.8, max_entities=8):
+        self.ha_storage = ha_storage
+        self.threshold = threshold
+        self.max_entities = max_entities
+        self._build()
+
+    def _build(self):
+        ha_storage = self.ha_storage
+        self.generation = ha_storage.generation
+        self.areas = {}
+        self.entities = []
+        for area in ha_storage.get_all_areas():
+            area_name = normalize(area["area_name"])
+            self.areas[area_name] = area["area_id"]
+            for device in ha_storage.get_devices_by_area_id(area["area_id"]):
+                for entity in ha_storage.get_entities_by_device_id(device["device_id"]):
+                    self._add_entity(area, area_name, device, entity)
+        logger.info(f"intent router indexed {len(self.entities)} entities in {len(self.areas)} areas")
+
+    def _add_entity(self, area, area_name, device, entity):
+        entity_id = entity["entity_id"]
+        domain = entity_id.split(".")[0]
+        attributes = entity.get("attributes", {})
+        friendly_name = normalize(attributes.get("friendly_name", ""))
+        # 和 L2 分类器的约束一致，不选择指示灯
+        if "indicator" in entity_id or "指示灯" in friendly_name:
+            return
+
+        names = set(DOMAIN_NAMES.get(domain, []))
+        names.update(DEVICE_CLASS_NAMES.get(attributes.get("device_class"), []))
+        for name in (friendly_name, normalize(device["device_name"])):
+            # 名称里常带着区域名，去掉后再比较
+            name = name.replace(area_name, "")
+            if name:
+                names.add(name)
+
+        services = set()
+        for service in entity.get("supported_services") or []:
+            services.update(service)
+
+        self.entities.append({
+            "entity_id": entity_id,
+            "domain": domain,
+            "area_id": area["area_id"],
+            "device_name": device["device_name"],
+            "services": services,
+            "names": [(name, char_ngrams(name)) for name in names],
+        })
+
+    def route(self, text, current_area=""):
+        start = time.perf_counter()
+        if self.generation != self.ha_storage.generation:
+            self._build()
+        result = self._route(normalize(text), normalize(current_area))
+        router_stats.observe_route(result is not None, time.perf_counter() - start)
+        logger.info(router_stats.report())
+        return result
+
+    def _route(self, text, current_area):
+        if not text or FALLBACK_PATTERN.search(text):
+            return None
+
+        # 先找区域，没有说区域时用音箱所在的区域，说了“所有”时不限区域
+        area_id = None
+        for area_name in sorted(self.areas, key=len, reverse=True):
+            if area_name and area_name in text:
+                area_id = self.areas[area_name]
+                text = text.replace(area_name, "")
+                break
+        whole_home = re.search(r"所有|全部", text) is not None
+        if area_id is None and not whole_home:
+            area_id = self.areas.get(current_area)
+
+        command = None
+        if not any(word in text for word in QUERY_WORDS):
+            command, text = self._command(text)
+            # 不知道是哪个房间时不控制整个家里的设备
+            if command is None or (area_id is None and not whole_home):
+                return None
+        for word in QUERY_WORDS:
+            text = text.replace(word, "")
+        target = FILLER_PATTERN.sub("", text)
+        if not target:
+            return None
+
+        matches = self._match(target, area_id, command)
+        if not matches:
+            return None
+        best = matches[0][0]
+        if best < self.threshold:
+            logger.info(f"intent router best match {best:.2f} for {target}, fall back to llm")
+            return None
+        # 同样匹配的实体一起处理，如“打开客厅灯”打开客厅所有的灯
+        selected = [(score, entity, service) for score, entity, service in matches if score >= best - 0.05]
+        if len(selected) > self.max_entities:
+            return None
+        logger.info(f"intent router matched {[entity['entity_id'] for _, entity, _ in selected]}, score {best:.2f}")
+
+        if command is None:
+            return {
+                "next_step": 7,
+                "read_entity_list": [entity["entity_id"] for _, entity, _ in selected],
+                "question": "NA",
+                "result": "NA",
+            }
+        devices = {}
+        for _, entity, service in selected:
+            devices.setdefault(entity["device_name"], []).append(
+                {"entity_id": entity["entity_id"], "service": service, "option": ""})
+        return {
+            "next_step": 3,
+            "write_entity_list": [{"device": device, "entities": entities} for device, entities in devices.items()],
+            "question": "NA",
+            "result": "NA",
+        }
+
+    @staticmethod
+    def _command(text):
+        """返回 (服务, 去掉动词后的文本)，“开关”是设备名，不当作动词"""
+        masked = text.replace("开关", "\0\0")
+        found = []
+        for service, verbs in COMMAND_VERBS.items():
+            for verb in verbs:
+                pos = masked.find(verb)
+                if pos >= 0:
+                    found.append((pos, -len(verb), service, verb))
+                    break
+        if not found:
+            return None, text
+        pos, length, service, verb = min(found)
+        return service, text[:pos] + text[pos - length:]
+
+    def _match(self, target, area_id, command):
+        target_vector = char_ngrams(target)
+        matches = []
+        for entity in self.entities:
+            if area_id and entity["area_id"] != area_id:
+                continue
+            service = None
+            if command:
+                service = COVER_SERVICES[command] if entity["domain"] == "cover" else command
+                if service not in entity["services"]:
+                    continue
+            elif entity["domain"] not in READ_DOMAINS:
+                continue
+            score = max(name_score(target, target_vector, name, vector) for name, vector in entity["names"])
+            matches.append((score, entity, service))
+        matches.sort(key=lambda match: match[0], reverse=True)
+        return matches
+
+    def selected_areas(self, route):
+        """命中的实体所在的区域 id 列表和实体类型"""
+        entity_ids = set(route.get("read_entity_list") or [])
+        for device in route.get("write_entity_list") or []:
+            entity_ids.update(entity["entity_id"] for entity in device["entities"])
+        area_ids, domains = [], []
+        for entity in self.entities:
+            if entity["entity_id"] in entity_ids:
+                if entity["area_id"] not in area_ids:
+                    area_ids.append(entity["area_id"])
+                if entity["domain"] not in domains:
+                    domains.append(entity["domain"])
+        return area_ids, domains
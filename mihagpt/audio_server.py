@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+from pathlib import Path
+
+from aiohttp import web
+
+from mihagpt.utils import get_hostname
+
+logger = logging.getLogger(__name__)
+
+SILENT_MP3 = Path(__file__).resolve().parent.parent / "mute_mp3" / "silent.mp3"
+PORT_RANGE = range(8050, 8090)
+CHUNK_SIZE = 16 * 1024
+# only audio is served from the directories, not e.g. the cache index
+AUDIO_SUFFIXES = {".mp3", ".wav", ".m4a", ".aac", ".ogg", ".flac"}
+# seconds between size checks of a file that is being written
+WATCH_INTERVAL = 0.05
+# seconds a finished stream stays reachable under its partial name
+STREAM_KEEP_SECONDS = 300
+
+
+class _Stream:
+    """A file that is still being written, readers wait for it to grow."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.size = 0
+        self.done = False
+        # where the finished file was moved, None if it failed
+        self.final_path: Path | None = None
+        self._changed = asyncio.Event()
+
+    def update(self, size: int | None = None, done: bool = False) -> None:
+        if size is not None:
+            self.size = size
+        self.done = self.done or done
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, size: int) -> None:
+        """Wait until the file is larger than ``size`` bytes or finished."""
+        while self.size <= size and not self.done:
+            await self._changed.wait()
+
+
+class AudioServer:
+    """Serve audio files to the speakers from the running event loop.
+
+    Finished files are served with ``FileResponse`` so range requests work.
+    Files registered with ``begin_stream`` are still being written: they are
+    sent chunked as they grow, until ``end_stream`` is called, so a speaker
+    can start playing on the first bytes. After ``end_stream`` the partial
+    name keeps resolving to the file's final path for a while.
+    """
+
+    def __init__(self, port: int | None = None, hostname: str | None = None) -> None:
+        self.port = port or int(os.getenv("XIAOGPT_PORT", 0)) or None
+        self.hostname = hostname or get_hostname()
+        self.directories: list[Path] = []
+        self.files: dict[str, Path] = {"silent.MP3": SILENT_MP3}
+        # partial file name -> stream
+        self._streams: dict[str, _Stream] = {}
+        self._runner: web.AppRunner | None = None
+        self._lock = asyncio.Lock()
+
+    def add_directory(self, directory: str | Path) -> None:
+        self.directories.append(Path(directory))
+
+    def url(self, name: str) -> str:
+        return f"http://{self.hostname}:{self.port}/{name}"
+
+    @property
+    def silent_url(self) -> str:
+        return self.url("silent.MP3")
+
+    @property
+    def started(self) -> bool:
+        return self._runner is not None
+
+    async def start(self) -> None:
+        async with self._lock:
+            if self._runner is not None:
+                return
+            app = web.Application()
+            app.router.add_get("/{name}", self._handle)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            ports = [self.port] if self.port else random.sample(PORT_RANGE, len(PORT_RANGE))
+            for port in ports:
+                try:
+                    await web.TCPSite(runner, None, port).start()
+                except OSError:
+                    if port == ports[-1]:
+                        await runner.cleanup()
+                        raise
+                    continue
+                self.port = port
+                break
+            self._runner = runner
+            logger.info(f"Serving on {self.hostname}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def begin_stream(self, path: Path) -> None:
+        stream = self._streams[path.name] = _Stream(path)
+        asyncio.create_task(self._watch(stream))
+
+    def end_stream(self, path: Path, final_path: Path | None = None) -> None:
+        """Mark ``path`` as finished, it was moved to ``final_path`` if given."""
+        stream = self._streams.get(path.name)
+        if stream is None:
+            return
+        stream.final_path = final_path
+        stream.update(done=True)
+        if final_path is None:
+            del self._streams[path.name]
+        else:
+            asyncio.get_running_loop().call_later(
+                STREAM_KEEP_SECONDS, self._streams.pop, path.name, None
+            )
+
+    async def wait_for_data(self, path: Path) -> None:
+        """Wait until the streamed ``path`` has its first bytes or is finished."""
+        if stream := self._streams.get(path.name):
+            await stream.wait(0)
+
+    @staticmethod
+    async def _watch(stream: _Stream) -> None:
+        # the engines write the file themselves, one watcher per file wakes all its readers
+        while not stream.done:
+            try:
+                size = stream.path.stat().st_size
+            except FileNotFoundError:
+                size = 0
+            if size != stream.size:
+                stream.update(size)
+            await asyncio.sleep(WATCH_INTERVAL)
+
+    def _resolve(self, name: str) -> Path | None:
+        if name in self.files:
+            return self.files[name]
+        if stream := self._streams.get(name):
+            return stream.final_path or stream.path
+        # partial files are only served while they are streamed
+        if "/" in name or name.startswith(".") or Path(name).suffix.lower() not in AUDIO_SUFFIXES:
+            return None
+        for directory in self.directories:
+            path = directory / name
+            if path.is_file():
+                return path
+        return None
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+        path = self._resolve(name)
+        if path is None:
+            raise web.HTTPNotFound()
+        stream = self._streams.get(name)
+        if stream is None or stream.done:
+            return web.FileResponse(path)
+        return await self._stream(request, path, stream)
+
+    async def _stream(
+        self, request: web.Request, path: Path, stream: _Stream
+    ) -> web.StreamResponse:
+        # open before the first await, the open file stays readable after it is
+        # moved into the cache
+        with open(path, "rb") as f:
+            response = web.StreamResponse(headers={"Content-Type": "audio/mpeg"})
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            sent = 0
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if chunk:
+                    await response.write(chunk)
+                    sent += len(chunk)
+                elif stream.done:
+                    # the writer may have flushed the tail right before finishing
+                    if not (chunk := f.read()):
+                        break
+                    await response.write(chunk)
+                else:
+                    await stream.wait(sent)
+        await response.write_eof()
+        return response
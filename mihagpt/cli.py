@@ -8,6 +8,21 @@ from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from selenium import webdriver
 from selenium.webdriver.firefox.service import Service
 
+
+def create_driver(debug_mode: bool) -> webdriver.Firefox:
+    options = FirefoxOptions()
+    options.add_argument(
+        "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:129.0) Gecko/20100101 Firefox/129.0")
+    options.add_argument("--headless")
+
+    if debug_mode:
+        # windows
+        return webdriver.Firefox(options=options)
+    # armbian
+    service = Service('/usr/local/bin/geckodriver')
+    return webdriver.Firefox(options=options, service=service)
+
+
 async def mute_xiaoai(miboy):
     while True:
         await miboy.stop_if_xiaoai_is_playing()
@@ -235,21 +250,7 @@ def main():
 
     async def main(config: Config) -> None:
         miboy = MiGPT(config)
-
-        options = FirefoxOptions()
-        options.add_argument(
-            "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:129.0) Gecko/20100101 Firefox/129.0")
-        options.add_argument("--headless")
-
-        debug_mode = config.debug_mode
-
-        if debug_mode:
-            # windows
-            driver = webdriver.Firefox(options=options)
-        else:
-            # armbian
-            service = Service('/usr/local/bin/geckodriver')
-            driver = webdriver.Firefox(options=options, service=service)
+        driver = create_driver(config.debug_mode)
 
         # 启动 miboy.run_forever() 并等待它的完成
         run_forever_task = asyncio.create_task(miboy.run_forever(driver))
@@ -8,7 +8,7 @@ from typing import Any, Iterable, Literal
 
 import yaml
 
-from mihagpt.utils import validate_proxy
+from mihagpt.utils import validate_detect_languages, validate_proxy
 
 LATEST_ASK_API = "https://userprofile.mina.mi.com/device_profile/v2/conversation?source=dialogu&hardware={hardware}&timestamp={timestamp}&limit=2"
 COOKIE_TEMPLATE = "deviceId={device_id}; serviceToken={service_token}; userId={user_id}"
@@ -140,16 +140,68 @@ class Config:
         "mi", "edge", "azure", "openai", "baidu", "google", "volc", "minimax"
     ] = "mi"
     tts_options: dict[str, Any] = field(default_factory=dict)
+    # number of sentences synthesized ahead of the one playing
+    tts_lookahead: int = 2
+    # synthesized audio cache, kept across restarts when a directory is set
+    tts_cache_dir: str = ""
+    tts_cache_size: int = 64 * 1024 * 1024
+    # start playing a sentence while its audio is still being synthesized
+    tts_stream_playback: bool = False
+    # languages the voice is picked from, ISO 639-1 codes
+    detect_languages: list[str] = field(default_factory=lambda: ["zh", "en"])
     gpt_options: dict[str, Any] = field(default_factory=dict)
 
     ha_token: str = ""
     ha_address: str = ""
     debug_mode: bool = False
     ha_miot_auth_directory: str = ""
+    # keep an in-memory mirror of all HA states fed by the websocket api
+    ha_state_mirror: bool = True
+    # cache HA history on disk and only fetch what is newer than the cache
+    ha_history_cache: bool = True
+    # longer histories are summarized before they go into the prompt
+    ha_history_max_points: int = 48
+    # handle clear device commands and state queries without the llm classifiers
+    intent_router: bool = True
+    intent_router_threshold: float = 0.8
+    # token budget of the device/entity list in the classifier prompts, 0 for no limit
+    entity_catalog_token_budget: int = 6000
+    # start the likely L2 classifier while L1 is still running, costs extra tokens on a miss
+    speculative_classification: bool = False
+    # rounds of the agent team per question, stop early once every role is idle
+    team_max_rounds: int = 20
+    team_stop_when_idle: bool = True
+    # wall-clock seconds per question, 0 for no limit
+    team_turn_timeout: float = 180
+    # token file and home assistant storage of this home, set them per home
+    # when several homes run in one process (python -m mihagpt.supervisor)
+    mi_token_path: str = ""
+    ha_storage_dir: str = ""
+    # miot spec data shared by all homes
+    ha_shared_storage_dir: str = ""
+    # refresh mi service tokens older than this (seconds) in the background
+    mi_token_max_age: float = 12 * 3600
+    # seconds the mina/miio device lists are cached
+    device_registry_ttl: float = 600
+
+    # poll all involved speakers at once instead of one by one
+    concurrent_polling: bool = False
+    polling_concurrency: int = 4
+    # adaptive polling: slow when idle, fast after a keyword hit, back off on errors
+    adaptive_polling: bool = False
+    poll_idle_interval: float = 3.0
+    poll_burst_interval: float = 0.5
+    poll_burst_duration: float = 30.0
+    poll_max_backoff: float = 30.0
+    poll_speaker_min_interval: float = 0.5
+    # handle questions from different speakers at the same time, each with its own team
+    concurrent_turns: bool = False
+    max_concurrent_turns: int = 2
 
     def __post_init__(self) -> None:
         if self.proxy:
             validate_proxy(self.proxy)
+        self.detect_languages = validate_detect_languages(self.detect_languages)
         if (
             self.api_base
             and self.api_base.endswith(("openai.azure.com", "openai.azure.com/"))
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import asyncio
+import fnmatch
+import json
+import logging
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from miservice import MiAccount
+
+logger = logging.getLogger("xiaogpt")
+
+# home assistant xiaomi_miot auth files, by sid
+MIOT_AUTH_PATTERNS = {
+    "micoapi": "auth-*cn-micoapi.json",
+    "xiaomiio": "auth-*cn.json",
+}
+
+
+class HaMiotAuthReader:
+    """Read the Home Assistant xiaomi_miot auth files incrementally.
+
+    The directory walk runs in a worker thread, and a file is only read and
+    parsed again when its mtime changed since the last scan.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        # path -> (mtime, (user_id, service_token, ssecurity))
+        self._files: dict[str, tuple[int, tuple[str, str, str] | None]] = {}
+
+    def _scan(self) -> dict[str, list[tuple[str, int]]]:
+        found: dict[str, list[tuple[str, int]]] = {sid: [] for sid in MIOT_AUTH_PATTERNS}
+        for root, dirs, files in os.walk(self.directory):
+            for sid, pattern in MIOT_AUTH_PATTERNS.items():
+                for filename in fnmatch.filter(files, pattern):
+                    full_path = os.path.join(root, filename)
+                    try:
+                        found[sid].append((full_path, os.stat(full_path).st_mtime_ns))
+                    except OSError:
+                        continue
+        return found
+
+    def _load(self, full_path: str) -> tuple[str, str, str] | None:
+        try:
+            with open(full_path, encoding="utf-8") as f:
+                data = json.load(f)["data"]
+            return data["user_id"], data["service_token"], data["ssecurity"]
+        except Exception as e:
+            logger.warning(f"无法读取文件 {full_path}: {e}")
+            return None
+
+    def _read(self) -> dict[str, tuple[str, str, str]]:
+        credentials = {}
+        for sid, files in self._scan().items():
+            # newest file wins
+            for full_path, mtime in sorted(files, key=lambda f: f[1], reverse=True):
+                cached = self._files.get(full_path)
+                if cached is None or cached[0] != mtime:
+                    cached = self._files[full_path] = (mtime, self._load(full_path))
+                if cached[1]:
+                    credentials[sid] = cached[1]
+                    break
+        return credentials
+
+    async def read(self) -> dict[str, tuple[str, str, str]]:
+        """Return ``{sid: (user_id, service_token, ssecurity)}`` without blocking the loop."""
+        if not self.directory:
+            return {}
+        return await asyncio.to_thread(self._read)
+
+
+class CredentialManager:
+    """Keep the Mi account credentials fresh in the background.
+
+    It is used as the ``update_token_callback`` of ``MiAccount`` so relogins are
+    served from the Home Assistant auth files when they are available, and it
+    proactively refreshes service tokens that are getting old, so token churn
+    never happens in the middle of polling or TTS.
+    """
+
+    def __init__(
+        self,
+        auth_directory: str = "",
+        max_age: float = 12 * 3600,
+        check_interval: float = 600,
+    ) -> None:
+        self.reader = HaMiotAuthReader(auth_directory)
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.account: MiAccount | None = None
+        self.credentials: dict[str, tuple[str, str, str]] = {}
+
+    async def refresh_from_files(self) -> dict[str, tuple[str, str, str]]:
+        self.credentials = await self.reader.read()
+        return self.credentials
+
+    async def get_credentials(self, sid: str) -> tuple[str, str, str] | None:
+        credentials = await self.refresh_from_files()
+        return credentials.get(sid)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if self.account is None:
+                continue
+            try:
+                await self.account.refresh_stale(self.max_age)
+            except Exception as e:
+                logger.warning(f"refresh mi token error: {e}")
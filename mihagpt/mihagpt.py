@@ -10,26 +10,36 @@ import time
 from pathlib import Path
 from typing import AsyncIterator
 import threading
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-import os
-import fnmatch
-import aiofiles
 from typing import Callable, Optional, Union
 
-from aiohttp import ClientSession, ClientTimeout
-from miservice import MiAccount, MiIOService, MiNAService, miio_command
+from aiohttp import ClientTimeout
+from miservice import (
+    DeviceRegistry,
+    MiAccount,
+    MiIOService,
+    MiNAService,
+    MiSessionPool,
+    MiTokenStore,
+    miio_command,
+)
 from rich import print
 from rich.logging import RichHandler
 import schedule
 
+from mihagpt.audio_server import AudioServer
 from mihagpt.bot import get_bot
+from mihagpt.credentials import CredentialManager
 from mihagpt.config import (
-    COOKIE_TEMPLATE,
+    DEFAULT_COMMAND,
+    HARDWARE_COMMAND_DICT,
     LATEST_ASK_API,
     MI_ASK_SIMULATE_DATA,
     WAKEUP_KEYWORD,
     Config,
 )
+from mihagpt.poller import PollScheduler, SpeakerPollState
 from mihagpt.tts import TTS, MiTTS, TetosTTS
 from mihagpt.utils import detect_language, parse_cookie_string
 
@@ -37,46 +47,93 @@ from metagpt.tools.web_browser_engine import WebBrowserEngine
 from metagpt.configs.browser_config import BrowserConfig
 from metagpt.team import Team
 
+from homeassistant.ha_client import HaClient
+from homeassistant.ha_state_mirror import HaStateMirror
+from homeassistant.ha_history_store import HaHistoryStore
 from homeassistant.homeassistant_storage import HaStorage
-from mihagpt.agents.ha_agent import Actuator, Judger, Interpreter, Doorman
+from mihagpt.agents.ha_agent import Actuator, Judger, Interpreter, Doorman, Speculator, TurnContext
+from mihagpt.agents.entity_catalog import EntityCatalog
+from mihagpt.agents.intent_router import IntentRouter
 
 
 EOF = object()
 
 
+@dataclass
+class SpeakerTurnState:
+    """Smart mode and conversation state of a speaker.
+
+    With concurrent turns every speaker has its own state, otherwise all
+    speakers share one.
+    """
+
+    smart_mode: bool = False
+    in_conversation: bool = False
+    smart_mode_start_time: datetime = field(default_factory=datetime.now)
+    xiaoai_mute: bool = False
+
+
 class MiGPT:
 
     browse_func: Union[Callable[[list[str]], None], None] = None
     web_browser_engine: Optional[WebBrowserEngine] = None
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, audio_server: AudioServer | None = None):
         self.config = config
+        # the supervisor shares one audio server between all homes
+        if audio_server is not None:
+            self.audio_server = audio_server
 
-        self.mi_token_home = Path.home() / ".mi.token"
+        self.mi_token_home = Path(config.mi_token_path) if config.mi_token_path else Path.home() / ".mi.token"
+        # parsed token and per device cookies are cached in memory
+        self.token_store = MiTokenStore(str(self.mi_token_home))
         self.last_timestamp = int(time.time() * 1000)  # timestamp last call mi speaker
         self.cookie_jar = None
         self.device_id = ""
         self.parent_id = None
         self.mina_service = None
         self.miio_service = None
-        self.in_conversation = False
+        self.ha_client: HaClient | None = None
+        self.state_mirror: HaStateMirror | None = None
+        # device lists of both services cached with a ttl, shared by all lookups
+        self.device_registry = DeviceRegistry(
+            ttl=config.device_registry_ttl,
+            commands=HARDWARE_COMMAND_DICT,
+            default_command=DEFAULT_COMMAND,
+        )
         self.polling_event = asyncio.Event()
         self.last_record = asyncio.Queue(1)
+        # per speaker record queues, only used by concurrent turns
+        self.speaker_queues: dict[str, asyncio.Queue] = {}
+        self.turn_semaphore = asyncio.Semaphore(max(1, config.max_concurrent_turns))
         # setup logger
         self.log = logging.getLogger("xiaogpt")
         self.log.setLevel(logging.DEBUG if config.verbose else logging.INFO)
-        self.log.addHandler(RichHandler())
+        if not self.log.handlers:
+            # several homes may run in one process, log through one handler
+            self.log.addHandler(RichHandler())
         self.log.debug(config)
-        self.mi_session = ClientSession()
+        # one pooled keep-alive session per xiaomi host, shared by miservice and the poller
+        self.mi_session = MiSessionPool()
 
-        self.smart_mode = False
-        self.xiaoai_mute = False
         self.xiaoai_mute_lock = threading.Lock()
-
-        self.smart_mode_start_time = datetime.now()
+        self.default_turn_state = SpeakerTurnState()
+        # per speaker smart mode and conversation state, only used by concurrent turns
+        self.turn_states: dict[str, SpeakerTurnState] = {}
 
         self.speaker_list = None
         self.current_speaker = None
+        # per speaker polling state, only used by concurrent polling
+        self.speaker_states: dict[str, SpeakerPollState] = {}
+        self.poll_semaphore = asyncio.Semaphore(max(1, config.polling_concurrency))
+        self.poll_scheduler = PollScheduler.from_config(config)
+        self._retry_task: asyncio.Task | None = None
+
+        # reads home assistant miot auth files and refreshes tokens in the background
+        self.credential_manager = CredentialManager(
+            config.ha_miot_auth_directory,
+            max_age=config.mi_token_max_age,
+        )
 
         self.xiaomi_user_id_micoapi = ""
         self.xiaomi_sid_micoapi = ""
@@ -101,51 +158,95 @@ class MiGPT:
             return False
         return True
 
-    def set_xiaoai_mute(self, value: bool):
+    def turn_state(self, speaker: dict | None = None) -> SpeakerTurnState:
+        """The smart mode and conversation state of ``speaker``."""
+        if not self.config.concurrent_turns or not speaker:
+            return self.default_turn_state
+        state = self.turn_states.get(speaker["deviceID"])
+        if state is None:
+            state = self.turn_states[speaker["deviceID"]] = SpeakerTurnState()
+        return state
+
+    def is_active(self) -> bool:
+        """True if any speaker is in smart mode or in a conversation."""
+        return any(
+            state.smart_mode or state.in_conversation
+            for state in (self.default_turn_state, *self.turn_states.values())
+        )
+
+    def set_xiaoai_mute(self, value: bool, state: SpeakerTurnState | None = None):
         # 使用同步锁来保证线程安全
         with self.xiaoai_mute_lock:
-            self.xiaoai_mute = value
+            (state or self.default_turn_state).xiaoai_mute = value
 
-    def get_xiaoai_mute(self) -> bool:
+    def get_xiaoai_mute(self, state: SpeakerTurnState | None = None) -> bool:
         # 使用同步锁来保证线程安全
         with self.xiaoai_mute_lock:
-            return self.xiaoai_mute
+            return (state or self.default_turn_state).xiaoai_mute
 
     async def close(self):
         await self.mi_session.close()
+        # the mirror and connection pool are shared by the homes on the same
+        # HA, they are only stopped when the last of them releases them
+        if self.state_mirror is not None:
+            await self.state_mirror.release()
+            self.state_mirror = None
+        if self.ha_client is not None:
+            await self.ha_client.release()
+            self.ha_client = None
 
     async def poll_latest_ask(self):
-        async with ClientSession() as session:
-            session._cookie_jar = self.cookie_jar
-            while True:
-                self.log.debug(
-                    "Listening new message, timestamp: %s", self.last_timestamp
-                )
+        # reuse the pooled session, the cookie jar is shared with miservice
+        session = self.mi_session
+        session.warm_up()
+        while True:
+            self.log.debug(
+                "Listening new message, timestamp: %s", self.last_timestamp
+            )
+            if self.config.concurrent_polling:
+                new_record = await self.get_latest_ask_from_xiaoai_concurrently(session)
+            else:
                 new_record = await self.get_latest_ask_from_xiaoai(session)
-                start = time.perf_counter()
-                self.log.debug(
-                    "Polling_event, timestamp: %s %s", self.last_timestamp, new_record
-                )
-                await self.polling_event.wait()
-                if self.smart_mode and self.current_speaker and self.current_speaker["use_command"]:
-                    await self.stop_if_xiaoai_is_playing()
-                elif (
-                    self.config.mute_xiaoai
-                    and new_record
-                    and self.need_ask_gpt(new_record)
-                ):
-                    await self.stop_if_xiaoai_is_playing()
-                if (d := time.perf_counter() - start) < 1:
-                    # sleep to avoid too many request
-                    self.log.debug("Sleep %f, timestamp: %s", d, self.last_timestamp)
-                    # if you want force mute xiaoai, comment this line below.
-                    await asyncio.sleep(1 - d)
+            start = time.perf_counter()
+            self.log.debug(
+                "Polling_event, timestamp: %s %s", self.last_timestamp, new_record
+            )
+            # the speaker of a new record is the current speaker
+            speaker = self.current_speaker
+            state = self.turn_state(speaker)
+            if new_record and self.need_ask_gpt(new_record, state):
+                self.poll_scheduler.on_keyword_hit(new_record.get("time"))
+            await self.polling_event.wait()
+            if state.smart_mode and speaker and speaker["use_command"]:
+                await self.stop_if_xiaoai_is_playing(speaker)
+            elif (
+                self.config.mute_xiaoai
+                and new_record
+                and self.need_ask_gpt(new_record, state)
+            ):
+                await self.stop_if_xiaoai_is_playing(speaker)
+            interval = self.poll_interval()
+            if (d := time.perf_counter() - start) < interval:
+                # sleep to avoid too many request
+                self.log.debug("Sleep %f, timestamp: %s", interval - d, self.last_timestamp)
+                # if you want force mute xiaoai, comment this line below.
+                await asyncio.sleep(interval - d)
+
+    def poll_interval(self) -> float:
+        if not self.config.adaptive_polling:
+            return 1
+        interval = self.poll_scheduler.next_interval(
+            active=self.is_active()
+        )
+        self.log.debug("Poll scheduler: %s", self.poll_scheduler.metrics())
+        return interval
 
     async def init_all_data(self):
         await self.login_miboy()
         await self._init_data_hardware()
         self.mi_session.cookie_jar.update_cookies(self.get_cookie(self.device_id))
         self.cookie_jar = self.mi_session.cookie_jar
+        await self.audio_server.start()
         self.tts  # init tts
 
     async def login_miboy(self):
@@ -153,48 +254,39 @@ class MiGPT:
             self.mi_session,
             self.config.account,
             self.config.password,
-            str(self.mi_token_home),
+            self.token_store,
+            update_token_callback=self.credential_manager.get_credentials
+            if self.config.ha_miot_auth_directory
+            else None,
         )
+        self.credential_manager.account = account
         # Forced login to refresh to refresh token
-        await account.login("micoapi")
-        self.mina_service = MiNAService(account)
-        self.miio_service = MiIOService(account)
+        await account.relogin("micoapi")
+        self.mina_service = MiNAService(account, self.device_registry)
+        self.miio_service = MiIOService(account, registry=self.device_registry)
 
     async def init_miboy(self):
-        while True:
-            if self.xiaomi_user_id_micoapi and self.xiaomi_sid_micoapi and self.xiaomi_service_token_micoapi and self.xiaomi_ssecurity_micoapi:
-                account_micoapi = MiAccount(
-                    self.mi_session,
-                    self.xiaomi_user_id_micoapi,
-                    self.xiaomi_sid_micoapi,
-                    self.xiaomi_service_token_micoapi,
-                    self.xiaomi_ssecurity_micoapi,
-                    str(self.mi_token_home),
-                    save_token=True,
-                    update_token_callback=self.update_mi_token
-                )
-                self.mina_service = MiNAService(account_micoapi)
-            if self.xiaomi_user_id_miio and self.xiaomi_sid_miio and self.xiaomi_service_token_miio and self.xiaomi_ssecurity_miio:
-                account_miio = MiAccount(
-                    self.mi_session,
-                    self.xiaomi_user_id_miio,
-                    self.xiaomi_sid_miio,
-                    self.xiaomi_service_token_miio,
-                    self.xiaomi_ssecurity_miio,
-                    str(self.mi_token_home),
-                    save_token=False,
-                    update_token_callback=self.update_mi_token
-                )
-                self.miio_service = MiIOService(account_miio)
-                break
-            else:
-                time.sleep(10)
+        # wait for home assistant to write the miot auth files, without blocking the loop
+        while not await self.update_mi_token():
+            await asyncio.sleep(10)
+        account = MiAccount(
+            self.mi_session,
+            self.config.account,
+            self.config.password,
+            self.token_store,
+            update_token_callback=self.credential_manager.get_credentials,
+        )
+        self.credential_manager.account = account
+        await account.relogin("micoapi")
+        await account.relogin("xiaomiio")
+        self.mina_service = MiNAService(account, self.device_registry)
+        self.miio_service = MiIOService(account, registry=self.device_registry)
 
     async def _init_data_hardware(self):
         if self.config.cookie:
             # if use cookie do not need init
             return
-        hardware_data = await self.mina_service.device_list()
+        hardware_data = await self.device_registry.mina_devices()
         # fix multi xiaoai problems we check did first
         # why we use this way to fix?
         # some videos and articles already in the Internet
@@ -216,7 +308,7 @@ class MiGPT:
                 f"we have no hardware: {self.config.hardware} please use `micli mina` to check"
             )
         if not self.config.mi_did:
-            devices = await self.miio_service.device_list()
+            devices = await self.device_registry.miio_devices()
             try:
                 self.config.mi_did = next(
                     d["did"]
@@ -231,21 +323,17 @@ class MiGPT:
 
     def get_cookie(self, device_id):
         if self.config.cookie:
-            cookie_jar = parse_cookie_string(self.config.cookie)
             # set attr from cookie fix #134
-            cookie_dict = cookie_jar.get_dict()
             # 暂时注释
             # self.device_id = cookie_dict["deviceId"]
-            return cookie_jar
+            return self.config_cookie
         else:
-            with open(self.mi_token_home) as f:
-                user_data = json.loads(f.read())
-            user_id = user_data.get("userId")
-            service_token = user_data.get("micoapi")[1]
-            cookie_string = COOKIE_TEMPLATE.format(
-                device_id=device_id, service_token=service_token, user_id=user_id
-            )
-            return parse_cookie_string(cookie_string)
+            # served from memory, the token file is only re-read when it changes
+            return self.token_store.device_cookies(device_id)
+
+    @functools.cached_property
+    def config_cookie(self) -> dict:
+        return parse_cookie_string(self.config.cookie).get_dict()
 
     @functools.cached_property
     def chatbot(self):
@@ -266,12 +354,12 @@ class MiGPT:
 
         return data
 
-    def need_ask_gpt(self, record):
+    def need_ask_gpt(self, record, state: SpeakerTurnState | None = None):
         if not record:
             return False
         query = record.get("query", "")
         return (
-            self.in_conversation
+            (state or self.default_turn_state).in_conversation
             and not query.startswith(WAKEUP_KEYWORD)
             or query.lower().startswith(tuple(w.lower() for w in self.config.keyword))
         )
@@ -289,7 +377,7 @@ class MiGPT:
         self.config.prompt = new_prompt
         self.chatbot.change_prompt(new_prompt)
 
-    async def get_latest_ask_from_xiaoai(self, session: ClientSession) -> dict | None:
+    async def get_latest_ask_from_xiaoai(self, session: MiSessionPool) -> dict | None:
         if not self.speaker_list or not isinstance(self.speaker_list, list):
             return None
         for speaker in self.speaker_list:
@@ -297,8 +385,8 @@ class MiGPT:
                 device_id = speaker["deviceID"]
                 hardware = speaker["hardware"]
 
-                self.mi_session.cookie_jar.update_cookies(self.get_cookie(device_id))
-                self.cookie_jar = self.mi_session.cookie_jar
+                if self.config.adaptive_polling and not self.poll_scheduler.allow(device_id):
+                    continue
 
                 retries = 3
                 for i in range(retries):
@@ -309,9 +397,12 @@ class MiGPT:
                                 hardware=hardware,
                                 timestamp=str(int(time.time() * 1000)),
                             ),
+                            # per request cookies, no update of the shared jar on every poll
+                            cookies=self.get_cookie(device_id),
                             timeout=timeout,
                         )
                     except Exception as e:
+                        self.poll_scheduler.record_request(device_id, ok=False)
                         self.log.warning(
                             "Execption when get latest ask from xiaoai: %s", str(e)
                         )
@@ -319,38 +410,149 @@ class MiGPT:
                     try:
                         data = await r.json()
                     except Exception:
+                        self.poll_scheduler.record_request(device_id, ok=False)
                         self.log.warning("get latest ask from xiaoai error, retry")
                         if i == 1:
                             # tricky way to fix #282 #272 # if it is the third time we re init all data
                             print("Maybe outof date trying to re init it")
                             await self._retry()
                     else:
-                        record = self._get_last_query(data)
+                        self.poll_scheduler.record_request(device_id)
+                        record = self._get_last_query(data, device_id=device_id)
                         print(f"record--------------------{record}")
                         if record:
-                            self.current_speaker = speaker
-                            self.device_id = speaker["deviceID"]
-                            self.config.mi_did = speaker["miotDID"]
-                            self.config.hardware = speaker["hardware"]
+                            self._set_current_speaker(speaker)
                             return record
                         else:
                             break
         return None
 
-    async def _retry(self):
-        await self.init_all_data()
+    def _set_current_speaker(self, speaker):
+        self.current_speaker = speaker
+        self.device_id = speaker["deviceID"]
+        self.config.mi_did = speaker["miotDID"]
+        self.config.hardware = speaker["hardware"]
+
+    async def get_latest_ask_from_xiaoai_concurrently(self, session: MiSessionPool) -> dict | None:
+        """Poll all involved speakers at once and return the first new record.
 
-    def _get_last_query(self, data: dict) -> dict | None:
+        Every speaker is polled by its own task with its own timestamp and backoff,
+        a speaker whose request is still in flight is not polled again, so a slow
+        speaker never holds back the others.
+        """
+        if not self.speaker_list or not isinstance(self.speaker_list, list):
+            return None
+        now = time.monotonic()
+        for speaker in self.speaker_list:
+            if not ("involve" in speaker and speaker["involve"]):
+                continue
+            device_id = speaker["deviceID"]
+            state = self.speaker_states.get(device_id)
+            if state is None:
+                state = self.speaker_states[device_id] = SpeakerPollState(
+                    device_id, last_timestamp=self.last_timestamp
+                )
+            if self.config.adaptive_polling and not self.poll_scheduler.allow(device_id):
+                continue
+            if state.ready(now):
+                state.task = asyncio.create_task(self._poll_speaker(session, speaker, state))
+
+        tasks = [state.task for state in self.speaker_states.values() if state.task is not None]
+        if not tasks:
+            return None
+        # wait one poll interval at most, slow tasks keep running and are
+        # collected by a later call
+        await asyncio.wait(
+            tasks, timeout=self._poll_wait_timeout(), return_when=asyncio.FIRST_COMPLETED
+        )
+        record = None
+        for state in self.speaker_states.values():
+            task = state.task
+            if task is None or not task.done():
+                continue
+            state.task = None
+            if task.cancelled():
+                continue
+            if (e := task.exception()) is not None:
+                self.log.warning("poll xiaoai %s error: %s", state.device_id, e)
+                continue
+            if (result := task.result()) is None:
+                continue
+            data, speaker = result
+            # the record is queued here and not in the task, so the current
+            # speaker is set together with it and matches the record returned
+            new_record = self._get_last_query(data, state)
+            if new_record and record is None:
+                self._set_current_speaker(speaker)
+                record = new_record
+        return record
+
+    def _poll_wait_timeout(self) -> float:
+        if not self.config.adaptive_polling:
+            return 1
+        return self.poll_scheduler.interval
+
+    async def _poll_speaker(
+        self, session: MiSessionPool, speaker: dict, state: SpeakerPollState
+    ) -> tuple[dict, dict] | None:
+        """Return the latest ask data with its speaker, shared state is left to the caller."""
+        hardware = speaker["hardware"]
+        retries = 3
+        for i in range(retries):
+            try:
+                async with self.poll_semaphore:
+                    r = await session.get(
+                        LATEST_ASK_API.format(
+                            hardware=hardware,
+                            timestamp=str(int(time.time() * 1000)),
+                        ),
+                        # per request cookies, the shared jar can only hold one deviceId
+                        cookies=self.get_cookie(state.device_id),
+                        timeout=ClientTimeout(total=15),
+                    )
+                    data = await r.json()
+            except Exception as e:
+                self.poll_scheduler.record_request(state.device_id, ok=False)
+                self.log.warning(
+                    "Execption when get latest ask from xiaoai %s: %s", state.device_id, str(e)
+                )
+                await asyncio.sleep(state.base_backoff * 2**i)
+                continue
+            self.poll_scheduler.record_request(state.device_id)
+            state.record_success()
+            return data, speaker
+        delay = state.record_failure()
+        self.log.warning(
+            "get latest ask from xiaoai %s failed, backoff %.1fs", state.device_id, delay
+        )
+        if state.failures == retries:
+            # same tricky way as the sequential polling, re init all data once
+            await self._retry()
+        return None
+
+    async def _retry(self):
+        # several failing speakers may ask at once, re init all data only once
+        if self._retry_task is None or self._retry_task.done():
+            self.device_registry.invalidate()
+            self._retry_task = asyncio.create_task(self.init_all_data())
+        await asyncio.shield(self._retry_task)
+
+    def _get_last_query(
+        self, data: dict, state: SpeakerPollState | None = None, device_id: str = ""
+    ) -> dict | None:
         if d := data.get("data"):
             records = json.loads(d).get("records")
             if not records:
                 return None
             last_record = records[0]
             timestamp = last_record.get("time")
-            if timestamp > self.last_timestamp:
+            last_timestamp = state.last_timestamp if state else self.last_timestamp
+            if timestamp > last_timestamp:
                 try:
-                    self.last_record.put_nowait(last_record)
-                    self.last_timestamp = timestamp
+                    self.record_queue(state.device_id if state else device_id).put_nowait(last_record)
+                    if state:
+                        state.last_timestamp = timestamp
+                    self.last_timestamp = max(self.last_timestamp, timestamp)
                     return last_record
                 except asyncio.QueueFull:
                     pass
@@ -369,12 +571,16 @@ class MiGPT:
                 f"{tts_command} {value}",
             )
 
+    @functools.cached_property
+    def audio_server(self) -> AudioServer:
+        return AudioServer()
+
     @functools.cached_property
     def tts(self) -> TTS:
         if self.config.tts == "mi":
             return MiTTS(self.config)
         else:
-            return TetosTTS(self.config)
+            return TetosTTS(self.config, self.audio_server)
 
     async def wait_for_tts_finish(self):
         while True:
@@ -393,10 +599,10 @@ class MiGPT:
     async def string_to_async_iterator(self, text: str) -> AsyncIterator[str]:
         yield text
 
-    async def speak_text(self, text: str):
+    async def speak_text(self, text: str, speaker: dict | None = None):
         text_stream = self.string_to_async_iterator(text)
 
-        await self.speak(text_stream)
+        await self.speak(text_stream, speaker)
 
     async def ask_gpt(self, query: str) -> AsyncIterator[str]:
         if not self.config.stream:
@@ -449,100 +655,121 @@ class MiGPT:
         )
         return is_playing
 
-    async def mute_xiaoai(self, miio_service, mi_did, tts_command):
-        if self.current_speaker and self.current_speaker["use_command"]:
+    def _speaker_commands(self, speaker: dict | None) -> tuple[str, str, str]:
+        """Return ``(mi_did, tts_command, wakeup_command)`` of ``speaker``."""
+        if not speaker:
+            return self.config.mi_did, self.config.tts_command, self.config.wakeup_command
+        tts_command, wakeup_command = self.device_registry.device_commands(speaker.get("hardware"))
+        return (
+            speaker["miotDID"],
+            speaker.get("tts_command") or tts_command,
+            speaker.get("wakeup_command") or wakeup_command,
+        )
+
+    async def mute_xiaoai(self, speaker: dict | None = None):
+        speaker = speaker or self.current_speaker
+        if speaker and speaker["use_command"]:
+            mi_did, tts_command, _ = self._speaker_commands(speaker)
             await miio_command(
-                miio_service,
+                self.miio_service,
                 mi_did,
                 f"{tts_command} '_'",
             )
         else:
-            # 获取本机ip
-            await self.mina_service.play_by_url(self.device_id, "http://localhost/silent.MP3", 2)
+            device_id = speaker["deviceID"] if speaker else self.device_id
+            await self.mina_service.play_by_url(device_id, self.audio_server.silent_url, 2)
 
     # 播放静音字符以便能够mute小爱音箱的原声，并判断是否完全没想要超过1分钟，超过的话就退出智能模式
-    async def stop_if_xiaoai_is_playing(self):
-        if self.get_xiaoai_mute():
-            await self.mute_xiaoai(self.miio_service, self.config.mi_did, self.config.tts_command)
-            print(f"------{self.i}:{self.xiaoai_mute},mi_did:{self.config.mi_did}")
+    async def stop_if_xiaoai_is_playing(self, speaker: dict | None = None):
+        if speaker is None and self.config.concurrent_turns:
+            # 并发对话时每个音箱各自静音和退出智能模式
+            for speaker in self.speaker_list or []:
+                if speaker.get("involve"):
+                    await self._stop_if_xiaoai_is_playing(speaker)
+            return
+        await self._stop_if_xiaoai_is_playing(speaker or self.current_speaker)
+
+    async def _stop_if_xiaoai_is_playing(self, speaker: dict | None):
+        state = self.turn_state(speaker)
+        if self.get_xiaoai_mute(state):
+            await self.mute_xiaoai(speaker)
+            mi_did, _, _ = self._speaker_commands(speaker)
+            print(f"------{self.i}:{state.xiaoai_mute},mi_did:{mi_did}")
             self.i += 1
             now = datetime.now()
-            if abs(now - self.smart_mode_start_time) >= timedelta(seconds=30):
-                self.smart_mode = False
-                self.set_xiaoai_mute(False)
+            if abs(now - state.smart_mode_start_time) >= timedelta(seconds=30):
+                state.smart_mode = False
+                self.set_xiaoai_mute(False, state)
                 # text_stream = self.string_to_async_iterator(f"现在退出智能模式了，用{'/'.join(self.config.keyword)}[/]字开头来唤醒我，重新进入智能模式吧")
-                await self.speak_text(f"现在退出智能模式了，用{'/'.join(self.config.keyword)}[/]字开头来唤醒我，重新进入智能模式吧")
+                await self.speak_text(f"现在退出智能模式了，用{'/'.join(self.config.keyword)}[/]字开头来唤醒我，重新进入智能模式吧", speaker)
 
-    async def wakeup_xiaoai(self):
+    async def wakeup_xiaoai(self, speaker: dict | None = None):
+        mi_did, _, wakeup_command = self._speaker_commands(speaker or self.current_speaker)
         return await miio_command(
             self.miio_service,
-            self.config.mi_did,
-            f"{self.config.wakeup_command} {WAKEUP_KEYWORD} 0",
+            mi_did,
+            f"{wakeup_command} {WAKEUP_KEYWORD} 0",
         )
 
     async def update_mi_token(self):
-        # 找到home assistant下配置的小米auth文件，并解析token和ssecurity
-        directory = self.config.ha_miot_auth_directory
-        pattern_micoapi = 'auth-*cn-micoapi.json'
-        pattern_xiaomiio = 'auth-*cn.json'
-        for root, dirs, files in os.walk(directory):
-            for filename in fnmatch.filter(files, pattern_micoapi):
-                full_path = os.path.join(root, filename)
-                try:
-                    async with aiofiles.open(full_path, 'r', encoding='utf-8') as file:
-                        content = await file.read()
-                        xiaomi_auth_data = json.loads(content)
-                        self.xiaomi_user_id_micoapi = xiaomi_auth_data["data"]["user_id"]
-                        self.xiaomi_sid_micoapi = xiaomi_auth_data["data"]["sid"]
-                        self.xiaomi_service_token_micoapi = xiaomi_auth_data["data"]["service_token"]
-                        self.xiaomi_ssecurity_micoapi = xiaomi_auth_data["data"]["ssecurity"]
-                        break
-                except Exception as e:
-                    print(f"无法读取文件 {full_path}: {e}")
-                    return None
-            for filename in fnmatch.filter(files, pattern_xiaomiio):
-                full_path = os.path.join(root, filename)
-                try:
-                    async with aiofiles.open(full_path, 'r', encoding='utf-8') as file:
-                        content = await file.read()
-                        xiaomi_auth_data = json.loads(content)
-                        self.xiaomi_user_id_miio = xiaomi_auth_data["data"]["user_id"]
-                        self.xiaomi_sid_miio = xiaomi_auth_data["data"]["sid"]
-                        self.xiaomi_service_token_miio = xiaomi_auth_data["data"]["service_token"]
-                        self.xiaomi_ssecurity_miio = xiaomi_auth_data["data"]["ssecurity"]
-                        break
-                except Exception as e:
-                    print(f"无法读取文件 {full_path}: {e}")
-                    return None
-        return self.xiaomi_user_id_micoapi, self.xiaomi_sid_micoapi, self.xiaomi_service_token_micoapi, self.xiaomi_ssecurity_micoapi, self.xiaomi_user_id_miio, self.xiaomi_sid_miio, self.xiaomi_service_token_miio, self.xiaomi_ssecurity_miio
-
-    def schedule_task(self):
-        # 计划任务每天早上8点执行
-        schedule.every().day.at("08:00").do(self.update_mi_token)
+        # 找到home assistant下配置的小米auth文件，并解析token和ssecurity，只重新读取有变化的文件
+        credentials = await self.credential_manager.refresh_from_files()
+        if "micoapi" in credentials:
+            (
+                self.xiaomi_user_id_micoapi,
+                self.xiaomi_service_token_micoapi,
+                self.xiaomi_ssecurity_micoapi,
+            ) = credentials["micoapi"]
+            self.xiaomi_sid_micoapi = "micoapi"
+        if "xiaomiio" in credentials:
+            (
+                self.xiaomi_user_id_miio,
+                self.xiaomi_service_token_miio,
+                self.xiaomi_ssecurity_miio,
+            ) = credentials["xiaomiio"]
+            self.xiaomi_sid_miio = "xiaomiio"
+        if "micoapi" in credentials and "xiaomiio" in credentials:
+            return self.xiaomi_user_id_micoapi, self.xiaomi_sid_micoapi, self.xiaomi_service_token_micoapi, self.xiaomi_ssecurity_micoapi, self.xiaomi_user_id_miio, self.xiaomi_sid_miio, self.xiaomi_service_token_miio, self.xiaomi_ssecurity_miio
+        return None
+
+    async def schedule_task(self):
+        # 计划任务每天早上8点执行，在事件循环中等待而不是阻塞线程
+        schedule.every().day.at("08:00").do(
+            lambda: asyncio.create_task(self.update_mi_token())
+        )
 
         while True:
-            now = datetime.now()
-            # 找到下一个调度的任务时间
-            next_run = schedule.next_run()
-            if next_run:
-                sleep_time = (next_run - now).total_seconds()
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-                schedule.run_pending()
-            else:
-                # 如果没有计划任务，则检查间隔可以稍微大一些
-                time.sleep(60)
+            idle_seconds = schedule.idle_seconds()
+            # 如果没有计划任务，则检查间隔可以稍微大一些
+            await asyncio.sleep(60 if idle_seconds is None else max(idle_seconds, 0))
+            schedule.run_pending()
 
     async def run_forever(self, driver):
         await self.init_all_data()
 
-        self.speaker_list = await self.mina_service.device_list()
+        self.speaker_list = await self.device_registry.mina_devices()
+        # refresh service tokens before they expire, off the polling path
+        credential_task = asyncio.create_task(self.credential_manager.run())
+        assert credential_task is not None  # keep the reference to task
         # 初始化HA设置
         ha_address = self.config.ha_address
         ha_port = "8123"
         ha_token = self.config.ha_token
-        ha_storage = HaStorage()
+        ha_storage = HaStorage(self.config.ha_storage_dir, self.config.ha_shared_storage_dir)
         ha_storage.init_data(ha_address, ha_port, ha_token, self.speaker_list, force=True)
+        self.ha_client = HaClient.acquire(ha_address, ha_port, ha_token)
+        if self.config.ha_state_mirror:
+            # 通过 websocket 维护实体状态的内存镜像，读取状态不再访问 HA
+            self.state_mirror = HaStateMirror.acquire(ha_address, ha_port, ha_token)
+            self.state_mirror.start()
+            ha_storage.state_mirror = self.state_mirror
+        if self.config.ha_history_cache:
+            # 历史状态缓存在本地，查询时只请求新的部分
+            HaHistoryStore.shared(
+                ha_address, ha_port, ha_token,
+                str(Path(ha_storage.storage_dir) / "history"),
+                max_points=self.config.ha_history_max_points,
+            )
 
         browser = BrowserConfig()
         web_browser_engine = WebBrowserEngine.from_browser_config(
@@ -550,109 +777,179 @@ class MiGPT:
             browse_func=self.browse_func,
         )
 
-        self.team = Team()
-        self.team.hire(
-            [
-                Judger(),
-                Actuator(self.speak_text, None, ha_address, ha_port, ha_token, driver),
-                Interpreter(self.speak_text, None, ha_storage, driver),
-                Doorman(ha_storage),
-            ]
+        # 简单的控制和查询由本地路由处理，各个 Team 共用
+        self.intent_router = (
+            IntentRouter(ha_storage, self.config.intent_router_threshold)
+            if self.config.intent_router
+            else None
         )
+        # 按 token 预算选择提示词中的设备实体
+        self.entity_catalog = EntityCatalog(ha_storage, self.config.entity_catalog_token_budget)
         task = asyncio.create_task(self.poll_latest_ask())
         assert task is not None  # to keep the reference to task, do not remove this
         print(
             f"Running xiaogpt now, 用[green]{'/'.join(self.config.keyword)}[/]来进入智能模式"
         )
         print(f"或用[green]{self.config.start_conversation}[/]开始持续对话")
+        if self.config.concurrent_turns:
+            # 每个音箱一个队列和一个 Team，不同房间的问题并发处理
+            self.polling_event.set()
+            workers = [
+                asyncio.create_task(
+                    self._speaker_turns(
+                        speaker,
+                        self._hire_team(ha_address, ha_port, ha_token, ha_storage, driver, speaker),
+                    )
+                )
+                for speaker in self.speaker_list
+                if speaker.get("involve")
+            ]
+            await asyncio.gather(*workers)
+            return
+        # 依次处理问题时只需要一个 Team
+        self.team = self._hire_team(ha_address, ha_port, ha_token, ha_storage, driver)
         while True:
             self.polling_event.set()
             new_record = await self.last_record.get()
             self.polling_event.clear()  # stop polling when processing the question
-            query = new_record.get("query", "").strip()
-
-            if query == self.config.start_conversation:
-                if not self.in_conversation:
-                    print("开始对话")
-                    self.in_conversation = True
-                    await self.wakeup_xiaoai()
-                await self.stop_if_xiaoai_is_playing()
-                continue
-            elif query == self.config.end_conversation:
-                if self.in_conversation:
-                    print("结束对话")
-                    self.in_conversation = False
-                await self.stop_if_xiaoai_is_playing()
-                continue
+            await self._handle_record(new_record, self.team, self.current_speaker)
 
-            if self.smart_mode:
-                print("-" * 20)
-                print("问题：" + query + "？")
+    def _hire_team(self, ha_address, ha_port, ha_token, ha_storage, driver, speaker=None) -> Team:
+        speak_text = (
+            functools.partial(self.speak_text, speaker=speaker) if speaker else self.speak_text
+        )
+        # L1 分类的同时推测执行 L2 分类，Doorman 和 Interpreter 共用
+        speculator = (
+            Speculator(ha_storage, self.entity_catalog)
+            if self.config.speculative_classification
+            else None
+        )
+        # 选出的区域和实体每个 Team 一份，并发的对话互不影响
+        turn_context = TurnContext()
+        team = Team()
+        team.hire(
+            [
+                Judger(),
+                Actuator(speak_text, None, ha_address, ha_port, ha_token, driver),
+                Interpreter(speak_text, None, ha_storage, driver, self.entity_catalog, speculator, turn_context),
+                Doorman(ha_storage, self.intent_router, speculator, turn_context),
+            ]
+        )
+        return team
 
-                self.set_xiaoai_mute(False)
+    async def _speaker_turns(self, speaker: dict, team: Team):
+        queue = self.record_queue(speaker["deviceID"])
+        while True:
+            new_record = await queue.get()
+            try:
+                await self._handle_record(new_record, team, speaker)
+            except Exception as e:
+                self.log.exception("处理 %s 的问题出错: %s", speaker.get("name"), e)
+
+    def record_queue(self, device_id: str) -> asyncio.Queue:
+        """The queue new records of ``device_id`` are put in."""
+        if not self.config.concurrent_turns:
+            return self.last_record
+        queue = self.speaker_queues.get(device_id)
+        if queue is None:
+            queue = self.speaker_queues[device_id] = asyncio.Queue(1)
+        return queue
+
+    async def _run_team(self, team: Team, query: str, speaker: dict):
+        input = {
+            "user": query,
+            "current_area": speaker["area_name"]
+        }
+        # LLM 和 HA 由所有房间共用，限制同时处理的问题数
+        async with self.turn_semaphore:
+            team.invest(investment=100)
+            team.run_project(json.dumps(input, ensure_ascii=False))
+            await team.run(
+                n_round=self.config.team_max_rounds,
+                stop_when_idle=self.config.team_stop_when_idle,
+                timeout=self.config.team_turn_timeout or None,
+            )
+        run = team.last_run
+        if run:
+            self.log.info(
+                "本轮用了 %d 轮，省去 %d 个空闲轮%s",
+                run["rounds"],
+                run["max_rounds"] - run["rounds"] if run["idle"] else 0,
+                "，超时结束" if run["timed_out"] else "",
+            )
 
-                input = {
-                    "user": query,
-                    "current_area": self.current_speaker["area_name"]
-                }
+    async def _handle_record(self, new_record: dict, team: Team, speaker: dict):
+        query = new_record.get("query", "").strip()
+        state = self.turn_state(speaker)
 
-                try:
-                    # await self.speak(self.ask_gpt(query))
-                    self.team.invest(investment=100)
-                    self.team.run_project(json.dumps(input, ensure_ascii=False))
-                    await self.team.run(n_round=20)
-                except Exception as e:
-                    print(f"{self.chatbot.name} 回答出错 {str(e)}")
-                # else:
-                #     print("回答完毕")
-                if self.in_conversation:
-                    print(f"继续对话, 或用`{self.config.end_conversation}`结束对话")
-                    await self.wakeup_xiaoai()
-
-                self.set_xiaoai_mute(True)
-                self.smart_mode_start_time = datetime.now()
-            elif self.need_ask_gpt(new_record):
-                await self.mute_xiaoai(self.miio_service, self.config.mi_did, self.config.tts_command)
-                self.smart_mode = True
-
-                query = re.sub(rf"^({'|'.join(self.config.keyword)})", "", query)
-                print("-" * 20)
-                print("问题：" + query + "？")
-
-                self.set_xiaoai_mute(False)
-
-                input = {
-                    "user": query,
-                    "current_area": self.current_speaker["area_name"]
-                }
+        if query == self.config.start_conversation:
+            if not state.in_conversation:
+                print("开始对话")
+                state.in_conversation = True
+                await self.wakeup_xiaoai(speaker)
+            await self.stop_if_xiaoai_is_playing(speaker)
+            return
+        elif query == self.config.end_conversation:
+            if state.in_conversation:
+                print("结束对话")
+                state.in_conversation = False
+            await self.stop_if_xiaoai_is_playing(speaker)
+            return
 
-                try:
-                    # await self.speak(self.ask_gpt(query))
-                    self.team.invest(investment=100)
-                    self.team.run_project(json.dumps(input, ensure_ascii=False))
-                    await self.team.run(n_round=20)
-                except Exception as e:
-                    print(f"{self.chatbot.name} 回答出错 {str(e)}")
-                else:
-                    print("回答完毕")
-                if self.in_conversation:
-                    print(f"继续对话, 或用`{self.config.end_conversation}`结束对话")
-                    await self.wakeup_xiaoai()
+        if state.smart_mode:
+            print("-" * 20)
+            print("问题：" + query + "？")
 
-                self.set_xiaoai_mute(True)
-                self.smart_mode_start_time = datetime.now()
-                continue
+            self.set_xiaoai_mute(False, state)
+
+            try:
+                # await self.speak(self.ask_gpt(query))
+                await self._run_team(team, query, speaker)
+            except Exception as e:
+                print(f"{self.chatbot.name} 回答出错 {str(e)}")
+            # else:
+            #     print("回答完毕")
+            if state.in_conversation:
+                print(f"继续对话, 或用`{self.config.end_conversation}`结束对话")
+                await self.wakeup_xiaoai(speaker)
+
+            self.set_xiaoai_mute(True, state)
+            state.smart_mode_start_time = datetime.now()
+        elif self.need_ask_gpt(new_record, state):
+            await self.mute_xiaoai(speaker)
+            state.smart_mode = True
+
+            query = re.sub(rf"^({'|'.join(self.config.keyword)})", "", query)
+            print("-" * 20)
+            print("问题：" + query + "？")
+
+            self.set_xiaoai_mute(False, state)
+
+            try:
+                # await self.speak(self.ask_gpt(query))
+                await self._run_team(team, query, speaker)
+            except Exception as e:
+                print(f"{self.chatbot.name} 回答出错 {str(e)}")
+            else:
+                print("回答完毕")
+            if state.in_conversation:
+                print(f"继续对话, 或用`{self.config.end_conversation}`结束对话")
+                await self.wakeup_xiaoai(speaker)
+
+            self.set_xiaoai_mute(True, state)
+            state.smart_mode_start_time = datetime.now()
 
-    async def speak(self, text_stream: AsyncIterator[str]) -> None:
+    async def speak(self, text_stream: AsyncIterator[str], speaker: dict | None = None) -> None:
+        speaker = speaker or self.current_speaker
         first_chunk = await text_stream.__anext__()
         # Detect the language from the first chunk
         # Add suffix '-' because tetos expects it to exist when selecting voices
         # however, the nation code is never used.
-        lang = detect_language(first_chunk) + "-"
+        lang = detect_language(first_chunk, tuple(self.config.detect_languages)) + "-"
 
         async def gen():  # reconstruct the generator
             yield first_chunk
             async for text in text_stream:
                 yield text
 
-        await self.tts.synthesize(lang, gen(), self.mina_service, self.miio_service, self.current_speaker["use_command"], self.current_speaker["deviceID"], self.current_speaker["miotDID"], self.current_speaker["tts_command"])
+        await self.tts.synthesize(lang, gen(), self.mina_service, self.miio_service, speaker["use_command"], speaker["deviceID"], speaker["miotDID"], speaker["tts_command"])
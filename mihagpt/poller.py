@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+@dataclass
+class SpeakerPollState:
+    """Per-speaker polling state used by the concurrent poller.
+
+    Every involved speaker keeps its own ``last_timestamp`` and its own
+    retry/backoff bookkeeping, so one slow or failing speaker never delays
+    the others.
+    """
+
+    device_id: str
+    last_timestamp: int = field(default_factory=_now_ms)
+    failures: int = 0
+    next_attempt: float = 0.0
+    task: asyncio.Task | None = None
+
+    base_backoff: float = 1.0
+    max_backoff: float = 30.0
+
+    def ready(self, now: float | None = None) -> bool:
+        """Return True if the speaker may be polled now."""
+        if self.task is not None and not self.task.done():
+            return False
+        return (time.monotonic() if now is None else now) >= self.next_attempt
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def record_failure(self) -> float:
+        """Register a failed poll and return the backoff delay in seconds."""
+        self.failures += 1
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+        # add some jitter so failing speakers do not retry in lockstep
+        delay *= random.uniform(0.8, 1.2)
+        self.next_attempt = time.monotonic() + delay
+        return delay
+
+
+class PollScheduler:
+    """Decide how often to poll the conversation API.
+
+    The scheduler switches between three modes:
+
+    - ``idle``: nothing is going on, poll slowly to save API calls.
+    - ``burst``: right after a keyword hit, or while smart mode / a conversation
+      is active, poll fast to keep wake latency low.
+    - ``backoff``: consecutive errors on every speaker, back off exponentially.
+
+    It also rate limits each speaker, backs off a failing speaker on its own
+    and keeps simple metrics about the current mode, the effective request
+    rate and the observed wake latency.
+    """
+
+    IDLE = "idle"
+    BURST = "burst"
+    BACKOFF = "backoff"
+
+    def __init__(
+        self,
+        idle_interval: float = 3.0,
+        burst_interval: float = 0.5,
+        burst_duration: float = 30.0,
+        max_backoff: float = 30.0,
+        speaker_min_interval: float = 0.5,
+        window: float = 60.0,
+    ) -> None:
+        self.idle_interval = idle_interval
+        self.burst_interval = burst_interval
+        self.burst_duration = burst_duration
+        self.max_backoff = max_backoff
+        self.speaker_min_interval = speaker_min_interval
+        self.window = window
+
+        self.mode = self.IDLE
+        self.interval = idle_interval
+        self.burst_until = 0.0
+        self.total_requests = 0
+        self.total_errors = 0
+        self.wake_latency: float | None = None
+        self._last_request: dict[str, float] = {}
+        # consecutive errors and the earliest next poll of each failing speaker
+        self._errors: dict[str, int] = {}
+        self._retry_at: dict[str, float] = {}
+        self._requests: deque[float] = deque()
+
+    @classmethod
+    def from_config(cls, config) -> PollScheduler:
+        return cls(
+            idle_interval=config.poll_idle_interval,
+            burst_interval=config.poll_burst_interval,
+            burst_duration=config.poll_burst_duration,
+            max_backoff=config.poll_max_backoff,
+            speaker_min_interval=config.poll_speaker_min_interval,
+        )
+
+    def allow(self, device_id: str) -> bool:
+        """Per speaker rate limit, return False if polled too recently or backing off."""
+        now = time.monotonic()
+        if now < self._retry_at.get(device_id, 0.0):
+            return False
+        last = self._last_request.get(device_id)
+        return last is None or now - last >= self.speaker_min_interval
+
+    def record_request(self, device_id: str, ok: bool = True) -> None:
+        now = time.monotonic()
+        self._last_request[device_id] = now
+        self._requests.append(now)
+        self._trim(now)
+        self.total_requests += 1
+        if ok:
+            self._errors.pop(device_id, None)
+            self._retry_at.pop(device_id, None)
+        else:
+            errors = self._errors[device_id] = self._errors.get(device_id, 0) + 1
+            self._retry_at[device_id] = now + min(
+                self.max_backoff, self.burst_interval * 2**errors
+            )
+            self.total_errors += 1
+
+    @property
+    def errors(self) -> int:
+        """Consecutive errors shared by all speakers, 0 while any speaker works."""
+        if not self._last_request:
+            return 0
+        return min(self._errors.get(device_id, 0) for device_id in self._last_request)
+
+    def _trim(self, now: float) -> None:
+        cutoff = now - self.window
+        while self._requests and self._requests[0] < cutoff:
+            self._requests.popleft()
+
+    def on_keyword_hit(self, record_time: int | None = None) -> None:
+        """Enter burst mode, ``record_time`` is the record time in ms."""
+        self.burst_until = time.monotonic() + self.burst_duration
+        if record_time:
+            latency = max(0.0, time.time() - record_time / 1000)
+            # exponential moving average of the delay between speaking and detecting
+            self.wake_latency = (
+                latency
+                if self.wake_latency is None
+                else 0.8 * self.wake_latency + 0.2 * latency
+            )
+
+    def next_interval(self, active: bool = False) -> float:
+        """Return the delay before the next poll and update the current mode."""
+        if self.errors:
+            self.mode = self.BACKOFF
+            base = self.burst_interval if active else self.idle_interval
+            self.interval = min(self.max_backoff, base * 2**self.errors)
+        elif active or time.monotonic() < self.burst_until:
+            self.mode = self.BURST
+            self.interval = self.burst_interval
+        else:
+            self.mode = self.IDLE
+            self.interval = self.idle_interval
+        return self.interval
+
+    @property
+    def request_rate(self) -> float:
+        """Requests per second over the sliding window."""
+        self._trim(time.monotonic())
+        return len(self._requests) / self.window
+
+    def metrics(self) -> dict:
+        return {
+            "mode": self.mode,
+            "interval": self.interval,
+            "request_rate": round(self.request_rate, 3),
+            "total_requests": self.total_requests,
+            "total_errors": self.total_errors,
+            "speaker_errors": dict(self._errors),
+            "wake_latency": None
+            if self.wake_latency is None
+            else round(self.wake_latency, 3),
+        }
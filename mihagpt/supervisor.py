@@ -0,0 +1,94 @@
+"""Run several homes (Xiaomi accounts / Home Assistant instances) in one process.
+
+Every home has its own config file and keeps its own MiGPT state, while the
+audio server, the Firefox drivers, the miot spec data and the language
+detector are shared:
+
+    python -m mihagpt.supervisor --config home1.yaml --config home2.yaml
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+
+from mihagpt.audio_server import AudioServer
+from mihagpt.cli import create_driver, mute_xiaoai
+from mihagpt.config import Config
+from mihagpt.mihagpt import MiGPT
+
+logger = logging.getLogger("xiaogpt")
+
+
+async def run_home(miboy: MiGPT, driver) -> None:
+    run_forever_task = asyncio.create_task(miboy.run_forever(driver))
+    # 确保在 run_forever() 已经启动之后再启动其他任务
+    await asyncio.sleep(5)
+    mute_xiaoai_task = asyncio.create_task(mute_xiaoai(miboy))
+    try:
+        await run_forever_task
+    finally:
+        await miboy.close()
+        mute_xiaoai_task.cancel()
+        try:
+            await mute_xiaoai_task
+        except asyncio.CancelledError:
+            pass
+
+
+async def run_home_isolated(miboy: MiGPT, driver) -> None:
+    """Run one home, an error only stops this home and not the others."""
+    try:
+        await run_home(miboy, driver)
+    except Exception:
+        logger.exception("home %s stopped with an error", miboy.config.account)
+
+
+async def run_homes(configs: list[Config], browsers: int = 1) -> None:
+    audio_server = AudioServer()
+    await audio_server.start()
+    # the drivers are shared by the homes round robin
+    drivers = [create_driver(configs[0].debug_mode) for _ in range(max(1, browsers))]
+    homes = [MiGPT(config, audio_server=audio_server) for config in configs]
+    try:
+        await asyncio.gather(
+            *(
+                run_home_isolated(miboy, driver)
+                for miboy, driver in zip(homes, itertools.cycle(drivers))
+            )
+        )
+    finally:
+        for driver in drivers:
+            driver.quit()
+        await audio_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config",
+        dest="configs",
+        action="append",
+        required=True,
+        help="config file of a home, repeat it for every home",
+    )
+    parser.add_argument(
+        "--browsers",
+        type=int,
+        default=1,
+        help="number of Firefox drivers shared by the homes",
+    )
+    options = parser.parse_args()
+    configs = [
+        Config.from_options(argparse.Namespace(config=path)) for path in options.configs
+    ]
+    if len(configs) > 1:
+        for key in ("mi_token_path", "ha_storage_dir"):
+            values = [getattr(config, key) for config in configs]
+            if len(set(values)) != len(values):
+                parser.error(f"every home needs its own {key}")
+
+    asyncio.run(run_homes(configs, options.browsers))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,18 @@ from __future__ import annotations
 
 import abc
 import asyncio
-import functools
 import json
 import logging
-import os
-import random
-import socket
 import tempfile
-import threading
-from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import time
+import uuid
 from pathlib import Path
-from typing import TYPE_CHECKING, AsyncIterator
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable
 
-from mihagpt.utils import get_hostname
+from miservice import mp3_file_duration
+
+from mihagpt.audio_server import AudioServer
+from mihagpt.tts.cache import PARTIAL_PREFIX, AudioCache, audio_cache_key
 
 if TYPE_CHECKING:
     from typing import TypeVar
@@ -27,6 +26,11 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# seconds between status calls while the speaker is still playing
+STATUS_POLL_INTERVAL = 0.3
+# share of the estimated playback time waited before the first status call
+EARLY_CHECK = 0.8
+
 
 class TTS(abc.ABC):
     """An abstract base class for Text-to-Speech models."""
@@ -36,13 +40,41 @@ class TTS(abc.ABC):
     ) -> None:
         self.config = config
 
-    async def wait_for_duration(self, mina_service, duration: float, device_id: str) -> None:
-        """Wait for the specified duration."""
+    async def wait_for_duration(self, mina_service, duration: float, device_id: str) -> float:
+        """Wait for the specified duration, then confirm the speaker stopped playing.
+
+        The speaker is only polled further if it is still playing after
+        ``duration``. Return the seconds it kept playing after ``duration``.
+        """
         await asyncio.sleep(duration)
+        if not await self.get_if_xiaoai_is_playing(mina_service, device_id):
+            return 0.0
+        start = time.perf_counter()
         while True:
+            await asyncio.sleep(STATUS_POLL_INTERVAL)
             if not await self.get_if_xiaoai_is_playing(mina_service, device_id):
-                break
-            await asyncio.sleep(1)
+                return time.perf_counter() - start
+
+    async def wait_for_playback_end(self, mina_service, duration: float, device_id: str) -> float:
+        """Wait until the speaker stops playing, return how long it played.
+
+        The first status call is made shortly before ``duration`` runs out, so
+        an end earlier than expected is seen too. Each status is taken to be
+        from the middle of its request, the end from between the last sample
+        still playing and the first one stopped.
+        """
+        start = time.perf_counter()
+        await asyncio.sleep(duration * EARLY_CHECK)
+        last_playing = None
+        while True:
+            sent = time.perf_counter()
+            playing = await self.get_if_xiaoai_is_playing(mina_service, device_id)
+            seen = (sent + time.perf_counter()) / 2 - start
+            if not playing:
+                # stopped before the first call, only known to be no later than that
+                return seen if last_playing is None else (last_playing + seen) / 2
+            last_playing = seen
+            await asyncio.sleep(STATUS_POLL_INTERVAL)
 
     async def get_if_xiaoai_is_playing(self, mina_service, device_id: str):
         playing_info = await mina_service.player_get_status(device_id)
@@ -59,80 +91,158 @@ class TTS(abc.ABC):
         raise NotImplementedError
 
 
-class HTTPRequestHandler(SimpleHTTPRequestHandler):
-    def log_message(self, format, *args):
-        logger.debug(f"{self.address_string()} - {format}", *args)
-
-    def log_error(self, format, *args):
-        logger.error(f"{self.address_string()} - {format}", *args)
-
-    def copyfile(self, source, outputfile):
-        try:
-            super().copyfile(source, outputfile)
-        except (socket.error, ConnectionResetError, BrokenPipeError):
-            # ignore this or TODO find out why the error later
-            pass
-
-
 class AudioFileTTS(TTS):
     """A TTS model that generates audio files locally and plays them via URL."""
 
     def __init__(
-        self, config: Config
+        self, config: Config, audio_server: AudioServer | None = None
     ) -> None:
         super().__init__(config)
         self.dirname = tempfile.TemporaryDirectory(prefix="xiaogpt-tts-")
-        self._start_http_server()
+        # synthesized files live in the cache, in the temp dir unless tts_cache_dir is set
+        self.cache = AudioCache(
+            config.tts_cache_dir or self.dirname.name, config.tts_cache_size
+        )
+        self.audio_dir = self.cache.directory
+        self.audio_server = audio_server or AudioServer()
+        self.audio_server.add_directory(self.audio_dir)
 
     @abc.abstractmethod
-    async def make_audio_file(self, lang: str, text: str) -> tuple[Path, float]:
-        """Synthesize speech from text and save it to a file.
-        Return the file path and the duration of the audio in seconds.
-        The file path must be relative to the self.dirname.
+    async def make_audio_file(self, lang: str, text: str, path: Path) -> float:
+        """Synthesize speech from text and write it to ``path``.
+        Return the duration of the audio in seconds.
         """
         raise NotImplementedError
 
-    async def synthesize(self, lang: str, text_stream: AsyncIterator[str], mina_service, miio_service, use_command: bool, device_id: str, mi_did: str, tts_command: str) -> None:
-        queue: asyncio.Queue[tuple[str, float]] = asyncio.Queue()
-        finished = asyncio.Event()
+    def cache_identity(self) -> tuple[str, dict]:
+        """The engine and voice options the audio depends on."""
+        return self.config.tts, self.config.tts_options
 
-        async def worker():
-            async for text in text_stream:
-                path, duration = await self.make_audio_file(lang, text)
-                url = f"http://{self.hostname}:{self.port}/{path.name}"
-                await queue.put((url, duration))
-            finished.set()
-
-        task = asyncio.create_task(worker())
+    async def prepare_audio(
+        self, lang: str, text: str
+    ) -> tuple[str, Awaitable[tuple[float, float]]]:
+        """Return the URL of the audio of ``text`` and an awaitable of (duration, synth seconds).
 
-        while True:
+        Cached sentences resolve at once. Otherwise the audio is synthesized into
+        the cache; with ``tts_stream_playback`` the URL is returned as soon as the
+        first bytes are written and the file is streamed while it grows.
+        """
+        t0 = time.perf_counter()
+        key = audio_cache_key(*self.cache_identity(), lang, text)
+        if cached := self.cache.get(key):
+            logger.debug("TTS cache hit: %s", text)
+            path, duration = cached
+            return self.audio_server.url(path.name), _resolved((duration, 0.0))
+
+        path = self.audio_dir / f"{PARTIAL_PREFIX}{uuid.uuid4().hex}.mp3"
+        stream = self.config.tts_stream_playback
+        if stream:
+            self.audio_server.begin_stream(path)
+
+        async def make() -> tuple[Path, float, float]:
+            final_path = None
             try:
-                url, duration = queue.get_nowait()
-            except asyncio.QueueEmpty:
-                if finished.is_set():
+                duration = await self.make_audio_file(lang, text, path)
+                # engines report estimates, the frame headers tell the real length
+                duration = await asyncio.to_thread(mp3_file_duration, path) or duration
+                final_path = self.cache.put(key, path, duration)
+            except BaseException:
+                path.unlink(missing_ok=True)
+                raise
+            finally:
+                # only after the move, so the partial URL keeps resolving
+                self.audio_server.end_stream(path, final_path)
+            return final_path, duration, time.perf_counter() - t0
+
+        task = asyncio.create_task(make())
+        if stream:
+            first_bytes = asyncio.ensure_future(self.audio_server.wait_for_data(path))
+            await asyncio.wait([first_bytes, task], return_when=asyncio.FIRST_COMPLETED)
+            first_bytes.cancel()
+            if not task.done():
+                return self.audio_server.url(path.name), _audio_info(task)
+        final_path, duration, synth_time = await task
+        return self.audio_server.url(final_path.name), _resolved((duration, synth_time))
+
+    async def synthesize(self, lang: str, text_stream: AsyncIterator[str], mina_service, miio_service, use_command: bool, device_id: str, mi_did: str, tts_command: str) -> None:
+        """Play the sentences of ``text_stream`` while the next ones are synthesized.
+
+        Synthesis runs up to ``config.tts_lookahead`` sentences ahead of playback,
+        the sentences are still played in order.
+        """
+        await self.audio_server.start()
+        lookahead = max(1, self.config.tts_lookahead)
+        # holds the synthesis tasks in sentence order, None marks the end of the stream
+        queue: asyncio.Queue[asyncio.Task | None] = asyncio.Queue()
+        # a slot is taken before a synthesis starts and freed when it is taken for playback
+        slots = asyncio.Semaphore(lookahead)
+        start = time.perf_counter()
+
+        async def producer():
+            async for text in text_stream:
+                # blocks while `lookahead` sentences are already waiting to be played
+                await slots.acquire()
+                queue.put_nowait(asyncio.create_task(self.prepare_audio(lang, text)))
+            queue.put_nowait(None)
+
+        async def wait_for_audio(audio, play_start: float) -> None:
+            duration, _ = await audio
+            # a streamed file may have been playing for a while already
+            elapsed = time.perf_counter() - play_start
+            await self.wait_for_duration(mina_service, max(0.0, duration - elapsed), device_id)
+
+        producer_task = asyncio.create_task(producer())
+        stats = []
+        last_end = None
+        try:
+            while True:
+                get_task = asyncio.ensure_future(queue.get())
+                await asyncio.wait(
+                    [get_task, producer_task], return_when=asyncio.FIRST_COMPLETED
+                )
+                if not get_task.done():
+                    # producer failed before queueing anything else
+                    get_task.cancel()
+                    producer_task.result()
                     break
-                else:
-                    await asyncio.sleep(0.1)
-                    continue
-            logger.debug("Playing URL %s (%s seconds)", url, duration)
-            await asyncio.gather(
-                mina_service.play_by_url(device_id, url, _type=1),
-                self.wait_for_duration(mina_service, duration, device_id),
+                item = get_task.result()
+                if item is None:
+                    break
+                slots.release()
+                url, audio = await item
+                audio = asyncio.ensure_future(audio)
+                play_start = time.perf_counter()
+                gap = play_start - (start if last_end is None else last_end)
+                logger.debug("Playing URL %s, gap %.2fs", url, gap)
+                await asyncio.gather(
+                    mina_service.play_by_url(device_id, url, _type=1),
+                    wait_for_audio(audio, play_start),
+                )
+                duration, synth_time = audio.result()
+                stats.append((synth_time, gap))
+                logger.debug(
+                    "Played URL %s (%s seconds), synth %.2fs", url, duration, synth_time
+                )
+                last_end = time.perf_counter()
+        finally:
+            producer_task.cancel()
+            while not queue.empty():
+                if (item := queue.get_nowait()) is not None:
+                    item.cancel()
+        if stats:
+            logger.info(
+                "TTS %d sentences, time to first audio %.2fs, synth avg %.2fs, gap avg %.2fs",
+                len(stats),
+                stats[0][1],
+                sum(s[0] for s in stats) / len(stats),
+                sum(s[1] for s in stats[1:]) / max(1, len(stats) - 1),
             )
-        await task
-
-    def _start_http_server(self):
-        # set the port range
-        port_range = range(8050, 8090)
-        # get a random port from the range
-        self.port = int(os.getenv("XIAOGPT_PORT", random.choice(port_range)))
-        # create the server
-        handler = functools.partial(HTTPRequestHandler, directory=self.dirname.name)
-        httpd = ThreadingHTTPServer(("", self.port), handler)
-        # start the server in a new thread
-        server_thread = threading.Thread(target=httpd.serve_forever)
-        server_thread.daemon = True
-        server_thread.start()
-
-        self.hostname = get_hostname()
-        logger.info(f"Serving on {self.hostname}:{self.port}")
+
+
+async def _resolved(value):
+    return value
+
+
+async def _audio_info(task: asyncio.Task) -> tuple[float, float]:
+    _, duration, synth_time = await task
+    return duration, synth_time
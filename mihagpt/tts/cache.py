@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "index.json"
+# prefix of the files engines write to before they are moved into the cache
+PARTIAL_PREFIX = ".partial-"
+
+
+def audio_cache_key(engine: str, options: dict[str, Any], lang: str, text: str) -> str:
+    """Content address of a synthesized sentence."""
+    raw = json.dumps([engine, options, lang, text], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AudioCache:
+    """LRU on-disk cache of synthesized audio files.
+
+    Files are stored as ``<key><suffix>`` in ``directory`` and the index
+    (key -> file, duration, size) is persisted next to them, so cached
+    sentences survive restarts with their durations. The least recently used
+    files are deleted once the total size exceeds ``max_bytes``.
+    """
+
+    def __init__(self, directory: str | Path, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._size = 0
+        self._load()
+
+    @property
+    def index_path(self) -> Path:
+        return self.directory / INDEX_FILE
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = []
+        except Exception as e:
+            logger.warning(f"Failed to load tts cache index: {e}")
+            entries = []
+        for key, entry in entries:
+            if (self.directory / entry["file"]).is_file():
+                self._entries[key] = entry
+                self._size += entry["size"]
+        # audio files left behind without an index entry, e.g. after a crash
+        known = {entry["file"] for entry in self._entries.values()}
+        for path in self.directory.iterdir():
+            if path.name in known or not path.is_file():
+                continue
+            if path.name.startswith(PARTIAL_PREFIX) or len(path.stem) == 64:
+                path.unlink(missing_ok=True)
+        self._evict()
+
+    def _save(self) -> None:
+        tmp_path = self.index_path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self._entries.items()), f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.warning(f"Failed to save tts cache index: {e}")
+
+    def get(self, key: str) -> tuple[Path, float] | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        path = self.directory / entry["file"]
+        if not path.is_file():
+            self._size -= self._entries.pop(key)["size"]
+            return None
+        self._entries.move_to_end(key)
+        return path, entry["duration"]
+
+    def put(self, key: str, path: Path, duration: float) -> Path:
+        """Move the synthesized ``path`` into the cache and return its new path."""
+        target = self.directory / f"{key}{path.suffix}"
+        if path != target:
+            shutil.move(path, target)
+        if key in self._entries:
+            self._size -= self._entries.pop(key)["size"]
+        size = target.stat().st_size
+        self._entries[key] = {"file": target.name, "duration": duration, "size": size}
+        self._size += size
+        self._evict()
+        self._save()
+        return target
+
+    def _evict(self) -> None:
+        # never evict the newest entry, it is about to be played
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, entry = self._entries.popitem(last=False)
+            self._size -= entry["size"]
+            (self.directory / entry["file"]).unlink(missing_ok=True)
+            logger.debug("Evicted tts cache entry %s", entry["file"])
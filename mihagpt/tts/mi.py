@@ -4,7 +4,38 @@ from miservice import MiIOService, MiNAService, miio_command
 
 from mihagpt.config import Config
 from mihagpt.tts.base import TTS
-from mihagpt.utils import calculate_tts_elapse
+from mihagpt.utils import calculate_tts_elapse, tts_char_count
+
+
+class SpeechRateModel:
+    """Characters per second of the speaker's own TTS, learned from playback.
+
+    Rates are kept per device and per hardware model, so a new speaker of a
+    known model starts from what was learned on the others.
+    """
+
+    def __init__(self, default: float = 4.5, alpha: float = 0.3) -> None:
+        self.default = default
+        self.alpha = alpha
+        self.rates: dict[str, float] = {}
+
+    def rate(self, *keys: str) -> float:
+        for key in keys:
+            if key in self.rates:
+                return self.rates[key]
+        return self.default
+
+    def estimate(self, text: str, *keys: str) -> float:
+        return calculate_tts_elapse(text, self.rate(*keys))
+
+    def observe(self, text: str, elapsed: float, *keys: str) -> None:
+        chars = tts_char_count(text)
+        if not chars or elapsed <= 0:
+            return
+        sample = chars / elapsed
+        for key in keys:
+            rate = self.rates.get(key, self.default)
+            self.rates[key] = rate + self.alpha * (sample - rate)
 
 
 class MiTTS(TTS):
@@ -12,6 +43,7 @@ class MiTTS(TTS):
         self, config: Config
     ) -> None:
         super().__init__(config)
+        self.rate_model = SpeechRateModel()
 
     async def say(self, text: str, mina_service, miio_service, use_command: bool, device_id: str, mi_did: str, tts_command: str) -> None:
         if not use_command:
@@ -27,6 +59,9 @@ class MiTTS(TTS):
             )
 
     async def synthesize(self, lang: str, text_stream: AsyncIterator[str], mina_service, miio_service, use_command: bool, device_id: str, mi_did: str, tts_command: str) -> None:
+        keys = (device_id, "hardware:" + await mina_service.registry.hardware(device_id))
         async for text in text_stream:
+            estimate = self.rate_model.estimate(text, *keys)
             await self.say(text, mina_service, miio_service, use_command, device_id, mi_did, tts_command)
-            await self.wait_for_duration(mina_service, calculate_tts_elapse(text), device_id)
+            elapsed = await self.wait_for_playback_end(mina_service, estimate, device_id)
+            self.rate_model.observe(text, elapsed, *keys)
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import functools
 import os
 import re
 import socket
 from http.cookies import SimpleCookie
-from typing import TYPE_CHECKING, AsyncIterator
+from typing import TYPE_CHECKING, AsyncIterator, Iterable
 from urllib.parse import urlparse
 
 from requests.utils import cookiejar_from_dict
@@ -25,11 +26,14 @@ def parse_cookie_string(cookie_string):
 _no_elapse_chars = re.compile(r"([「」『』《》“”'\"()（）]|(?<!-)-(?!-))", re.UNICODE)
 
 
-def calculate_tts_elapse(text: str) -> float:
-    # for simplicity, we use a fixed speed
-    speed = 4.5  # this value is picked by trial and error
+def tts_char_count(text: str) -> int:
     # Exclude quotes and brackets that do not affect the total elapsed time
-    return len(_no_elapse_chars.sub("", text)) / speed
+    return len(_no_elapse_chars.sub("", text))
+
+
+def calculate_tts_elapse(text: str, speed: float = 4.5) -> float:
+    # the default speed is picked by trial and error
+    return tts_char_count(text) / speed
 
 
 _ending_punctuations = ("。", "？", "！", "；", "\n", "?", "!", ";")
@@ -65,6 +69,33 @@ def validate_proxy(proxy_str: str) -> bool:
     return True
 
 
+def validate_detect_languages(languages: Iterable[str]) -> list[str]:
+    """Check the ISO 639-1 codes for language detection, return them lowercased."""
+
+    try:
+        from lingua import IsoCode639_1
+    except ImportError:
+        IsoCode639_1 = None
+    codes = []
+    for code in languages:
+        if not isinstance(code, str) or not code.strip():
+            raise ValueError(f"Invalid detect_languages entry: {code!r}")
+        code = code.strip().lower()
+        if IsoCode639_1 is not None:
+            known = hasattr(IsoCode639_1, code.upper())
+        else:
+            known = len(code) == 2 and code.isalpha()
+        if not known:
+            raise ValueError(
+                f"Unknown language code {code!r} in detect_languages, "
+                "use ISO 639-1 codes like zh, en, ja"
+            )
+        codes.append(code)
+    if not codes:
+        raise ValueError("detect_languages must not be empty")
+    return codes
+
+
 def get_hostname() -> str:
     if "XIAOGPT_HOSTNAME" in os.environ:
         return os.environ["XIAOGPT_HOSTNAME"]
@@ -74,19 +105,49 @@ def get_hostname() -> str:
         return s.getsockname()[0]
 
 
-def _get_detector() -> LanguageDetector | None:
+# scripts that identify the language without running the model,
+# kana before han since Japanese text mixes both
+_SCRIPT_LANGUAGES = (
+    (re.compile(r"[\u3040-\u30ff]"), "ja"),
+    (re.compile(r"[\uac00-\ud7af]"), "ko"),
+    (re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff]"), "zh"),
+)
+_CJK_LANGUAGES = {"zh", "ja", "ko"}
+_letters = re.compile(r"[^\W\d_]")
+
+
+@functools.lru_cache(maxsize=4)
+def _get_detector(languages: tuple[str, ...]) -> LanguageDetector | None:
     try:
-        from lingua import LanguageDetectorBuilder
+        from lingua import IsoCode639_1, LanguageDetectorBuilder
     except ImportError:
         return None
-    return LanguageDetectorBuilder.from_all_spoken_languages().build()
-
-
-_detector = _get_detector()
-
-
-def detect_language(text: str) -> str:
-    if _detector is None:
-        return "zh"  # default to Chinese if langdetect module is not available
-    lang = _detector.detect_language_of(text)
+    codes = [getattr(IsoCode639_1, code.upper()) for code in languages]
+    return LanguageDetectorBuilder.from_iso_codes_639_1(*codes).build()
+
+
+@functools.lru_cache(maxsize=256)
+def detect_language(text: str, languages: tuple[str, ...] = ("zh", "en")) -> str:
+    """Detect the language of ``text`` among ``languages``, "zh" when unsure.
+
+    The script of the text decides in the common cases, the lingua model,
+    restricted to ``languages``, is only loaded for the rest.
+    """
+    cjk = [lang for pattern, lang in _SCRIPT_LANGUAGES if pattern.search(text)]
+    for lang in cjk:
+        if lang in languages:
+            return lang
+    if cjk:
+        # e.g. kana when only Chinese is configured, still the closest voice
+        for lang in languages:
+            if lang in _CJK_LANGUAGES:
+                return lang
+    if not _letters.search(text):
+        return "zh"
+    candidates = [lang for lang in languages if lang not in _CJK_LANGUAGES]
+    if len(candidates) == 1:
+        return candidates[0]
+    if not candidates or (detector := _get_detector(tuple(candidates))) is None:
+        return "zh"  # default to Chinese if lingua module is not available
+    lang = detector.detect_language_of(text)
     return lang.iso_code_639_1.name.lower() if lang is not None else "zh"
@@ -1,4 +1,7 @@
 from .miaccount import MiAccount, MiTokenStore
 from .minaservice import MiNAService
 from .miioservice import MiIOService
+from .session import MiSessionPool
+from .registry import DeviceRegistry
+from .mp3 import mp3_duration, mp3_file_duration
 from .miiocommand import miio_command, miio_command_help
@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import hashlib
 import json
@@ -5,42 +6,106 @@ import logging
 import os
 import random
 import string
+import time
 from urllib import parse
 from aiohttp import ClientSession
 
+from .session import MiSessionPool
+
 _LOGGER = logging.getLogger(__package__)
 
 
+class MiAuthError(Exception):
+    """The account server rejected the login."""
+
+
 def get_random(length):
     return "".join(random.sample(string.ascii_letters + string.digits, length))
 
 
 class MiTokenStore:
-    def __init__(self, token_path):
+    """Token file store with an in-memory cache.
+
+    The parsed token and the per-device cookies built from it are kept in
+    memory. The file is only parsed again when its mtime changes (checked at
+    most every ``check_interval`` seconds) or when ``save_token`` writes it.
+    """
+
+    def __init__(self, token_path, check_interval=5):
         self.token_path = token_path
+        self.check_interval = check_interval
+        self._token = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self._cookies = {}
+
+    def _set_cached(self, token, mtime):
+        self._token = token
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
+        self._cookies.clear()
+
+    def _refresh(self, force=False):
+        if not force and time.monotonic() - self._checked_at < self.check_interval:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.token_path).st_mtime_ns
+        except OSError:
+            if self._mtime is not None:
+                self._set_cached(None, None)
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.token_path) as f:
+                self._set_cached(json.load(f), mtime)
+        except Exception:
+            _LOGGER.exception("Exception on load token from %s", self.token_path)
 
     def load_token(self):
-        if os.path.isfile(self.token_path):
-            try:
-                with open(self.token_path) as f:
-                    return json.load(f)
-            except Exception:
-                _LOGGER.exception("Exception on load token from %s", self.token_path)
-        return None
+        self._refresh(force=True)
+        # callers mutate the token they get, never hand out the cached dict
+        return dict(self._token) if self._token else None
 
     def save_token(self, token=None):
         if token:
             try:
                 with open(self.token_path, "w") as f:
                     json.dump(token, f, indent=2)
+                self._set_cached(dict(token), os.stat(self.token_path).st_mtime_ns)
             except Exception:
                 _LOGGER.exception("Exception on save token to %s", self.token_path)
-        elif os.path.isfile(self.token_path):
-            os.remove(self.token_path)
+        else:
+            if os.path.isfile(self.token_path):
+                os.remove(self.token_path)
+            self._set_cached(None, None)
+
+    def device_cookies(self, device_id, sid="micoapi"):
+        """Return the cookies for requests made on behalf of ``device_id``."""
+        self._refresh()
+        cookies = self._cookies.get((device_id, sid))
+        if cookies is None:
+            if not self._token or sid not in self._token:
+                return None
+            cookies = {
+                "deviceId": device_id,
+                "serviceToken": self._token[sid][1],
+                "userId": self._token.get("userId"),
+            }
+            self._cookies[(device_id, sid)] = cookies
+        return cookies
 
 
 class MiAccount:
-    def __init__(self, session: ClientSession, username, password, token_store=None):
+    def __init__(
+        self,
+        session: ClientSession | MiSessionPool,
+        username,
+        password,
+        token_store=None,
+        update_token_callback=None,
+    ):
         self.session = session
         self.username = username
         self.password = password
@@ -48,40 +113,77 @@ class MiAccount:
             MiTokenStore(token_store) if isinstance(token_store, str) else token_store
         )
         self.token = token_store is not None and self.token_store.load_token()
+        # async callable(sid) -> (user_id, service_token, ssecurity) or None,
+        # used instead of a password login, e.g. to reuse Home Assistant miot auth
+        self.update_token_callback = update_token_callback
+        # in-flight login per sid, concurrent relogins share it
+        self._login_tasks = {}
+        # monotonic time each sid was last refreshed in this process
+        self._token_time = {}
+        # called after a relogin caused by an auth error, e.g. to drop cached device lists
+        self.relogin_callbacks = []
+
+    def update_token(self, sid, user_id, service_token, ssecurity):
+        if not self.token:
+            self.token = {"deviceId": get_random(16).upper()}
+        self.token["userId"] = user_id
+        self.token[sid] = (ssecurity, service_token)
+        self._token_time[sid] = time.monotonic()
+        if self.token_store:
+            self.token_store.save_token(self.token)
+
+    async def _do_login(self, sid, refresh=False):
+        if self.update_token_callback:
+            credentials = await self.update_token_callback(sid)
+            if credentials:
+                self.update_token(sid, *credentials)
+                return True
+            if not self.password:
+                return False
+        return await self.login(sid, refresh=refresh)
+
+    async def relogin(self, sid, stale_token=None, refresh=False):
+        """Login again for ``sid``, coalescing concurrent callers into one login.
+
+        If ``stale_token`` is given and the current service token differs from
+        it, another caller already refreshed it and no login is made. With
+        ``refresh`` the current token is still valid and is kept unless the
+        account server rejects the login.
+        """
+        if (
+            stale_token is not None
+            and self.token
+            and sid in self.token
+            and self.token[sid][1] != stale_token
+        ):
+            return True
+        task = self._login_tasks.get(sid)
+        if task is None or task.done():
+            task = asyncio.ensure_future(self._do_login(sid, refresh))
+            self._login_tasks[sid] = task
+        # shield so one cancelled caller does not cancel the login of the others
+        return await asyncio.shield(task)
 
-    # def __init__(self, session: ClientSession, userId, sid, serviceToken, ssecurity, token_store='.mi.token', save_token=True, update_token_callback=None):
-    #     self.session = session
-    #     self.userId = userId
-    #     self.sid = sid
-    #     self.token_store = (
-    #         MiTokenStore(token_store) if isinstance(token_store, str) else token_store
-    #     )
-    #
-    #     self.token = token_store is not None and self.token_store.load_token()
-    #
-    #     self.update_token_callback = update_token_callback
-    #
-    #     if not self.token:
-    #         self.token = {"deviceId": get_random(16).upper()}
-    #
-    #     self.token = {'deviceId': get_random(16).upper()}
-    #     self.token['userId'] = userId
-    #     # self.token['passToken'] = passToken
-    #
-    #     self.token[sid] = (ssecurity, serviceToken)
-    #     if save_token:
-    #         self.token_store.save_token(self.token)
-
-    def update_token(self, serviceToken, ssecurity):
-        self.token = {'deviceId': get_random(16).upper()}
-        self.token['userId'] = self.userId
-        # self.token['passToken'] = passToken
-
-        self.token[self.sid] = (ssecurity, serviceToken)
-
-        self.token_store.save_token(self.token)
-
-    async def login(self, sid):
+    def token_age(self, sid):
+        """Seconds since ``sid`` was refreshed, None if never refreshed in this process."""
+        refreshed = self._token_time.get(sid)
+        return None if refreshed is None else time.monotonic() - refreshed
+
+    async def refresh_stale(self, max_age, sids=("micoapi", "xiaomiio")):
+        """Refresh the service tokens older than ``max_age`` seconds before they expire."""
+        for sid in sids:
+            if not (self.token and sid in self.token):
+                continue
+            age = self.token_age(sid)
+            if age is None:
+                # loaded from file, start counting from now
+                self._token_time[sid] = time.monotonic()
+            elif age >= max_age:
+                _LOGGER.info("Refresh %s token, %.0fs old", sid, age)
+                # on failure the old token is kept and retried on the next call
+                await self.relogin(sid, stale_token=self.token[sid][1], refresh=True)
+
+    async def login(self, sid, refresh=False):
         if not self.token:
             self.token = {"deviceId": get_random(16).upper()}
         try:
@@ -98,7 +200,7 @@ class MiAccount:
                 }
                 resp = await self._serviceLogin("serviceLoginAuth2", data)
                 if resp["code"] != 0:
-                    raise Exception(resp)
+                    raise MiAuthError(resp)
 
             self.token["userId"] = resp["userId"]
             self.token["passToken"] = resp["passToken"]
@@ -107,11 +209,16 @@ class MiAccount:
                 resp["location"], resp["nonce"], resp["ssecurity"]
             )
             self.token[sid] = (resp["ssecurity"], serviceToken)
+            self._token_time[sid] = time.monotonic()
             if self.token_store:
                 self.token_store.save_token(self.token)
             return True
 
         except Exception as e:
+            if refresh and not isinstance(e, MiAuthError):
+                # e.g. a network error, the old token is still valid
+                _LOGGER.warning("Refresh %s token of %s failed, keep the old one: %s", sid, self.username, e)
+                return False
             self.token = None
             if self.token_store:
                 self.token_store.save_token()
@@ -152,62 +259,34 @@ class MiAccount:
         return serviceToken
 
     async def mi_request(self, sid, url, data, headers, relogin=True):
-        if (self.token and sid in self.token):  # Ensure login
-            cookies = {
-                "userId": self.token["userId"],
-                "serviceToken": self.token[sid][1],
-            }
-            content = data(self.token, cookies) if callable(data) else data
-            method = "GET" if data is None else "POST"
-            _LOGGER.info("%s %s", url, content)
-            async with self.session.request(
-                method, url, data=content, cookies=cookies, headers=headers
-            ) as r:
-                status = r.status
-                if status == 200:
-                    resp = await r.json(content_type=None)
-                    code = resp["code"]
-                    if code == 0:
-                        return resp
-                    if "auth" in resp.get("message", "").lower():
-                        status = 401
-                else:
-                    resp = await r.text()
-            if status == 401 and relogin:
-                _LOGGER.warn("Auth error on request %s %s, relogin...", url, resp)
-                self.token = None  # Auth error, reset login
-                return await self.mi_request(sid, url, data, headers, False)
-        elif self.update_token_callback:
-            xiaomi_user_id_micoapi, xiaomi_sid_micoapi, xiaomi_service_token_micoapi, xiaomi_ssecurity_micoapi, xiaomi_user_id_miio, xiaomi_sid_miio, xiaomi_service_token_miio, xiaomi_ssecurity_miio = await self.update_token_callback()
-            if self.sid == xiaomi_sid_micoapi:
-                self.update_token(xiaomi_service_token_micoapi, xiaomi_ssecurity_micoapi)
-            elif self.sid == xiaomi_sid_miio:
-                self.update_token(xiaomi_service_token_miio, xiaomi_ssecurity_miio)
-
-            cookies = {
-                "userId": self.token["userId"],
-                "serviceToken": self.token[sid][1],
-            }
-            content = data(self.token, cookies) if callable(data) else data
-            method = "GET" if data is None else "POST"
-            _LOGGER.info("%s %s", url, content)
-            async with self.session.request(
-                    method, url, data=content, cookies=cookies, headers=headers
-            ) as r:
-                status = r.status
-                if status == 200:
-                    resp = await r.json(content_type=None)
-                    code = resp["code"]
-                    if code == 0:
-                        return resp
-                    if "auth" in resp.get("message", "").lower():
-                        status = 401
-                else:
-                    resp = await r.text()
-            if status == 401 and relogin:
-                _LOGGER.warn("Auth error on request %s %s, relogin...", url, resp)
-                self.token = None  # Auth error, reset login
+        if not (self.token and sid in self.token) and not await self.relogin(sid):
+            raise Exception(f"Error {url}: Login failed")
+        service_token = self.token[sid][1]
+        cookies = {
+            "userId": self.token["userId"],
+            "serviceToken": service_token,
+        }
+        content = data(self.token, cookies) if callable(data) else data
+        method = "GET" if data is None else "POST"
+        _LOGGER.info("%s %s", url, content)
+        async with self.session.request(
+            method, url, data=content, cookies=cookies, headers=headers
+        ) as r:
+            status = r.status
+            if status == 200:
+                resp = await r.json(content_type=None)
+                code = resp["code"]
+                if code == 0:
+                    return resp
+                if "auth" in resp.get("message", "").lower():
+                    status = 401
+            else:
+                resp = await r.text()
+        if status == 401 and relogin:
+            _LOGGER.warning("Auth error on request %s %s, relogin...", url, resp)
+            # only one relogin runs even if many requests fail at the same time
+            if await self.relogin(sid, stale_token=service_token):
+                for callback in self.relogin_callbacks:
+                    callback()
                 return await self.mi_request(sid, url, data, headers, False)
-        else:
-            resp = "Login failed"
         raise Exception(f"Error {url}: {resp}")
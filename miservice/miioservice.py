@@ -5,13 +5,17 @@ import hashlib
 import hmac
 import json
 from .miaccount import MiAccount
+from .registry import DeviceRegistry
 
 # REGIONS = ['cn', 'de', 'i2', 'ru', 'sg', 'us']
 
 
 class MiIOService:
-    def __init__(self, account: MiAccount, region=None):
+    def __init__(self, account: MiAccount, region=None, registry: DeviceRegistry = None):
         self.account = account
+        self.registry = registry
+        if registry is not None:
+            registry.miio_service = self
         self.server = (
             "https://"
             + ("" if region is None or region == "cn" else region + ".")
@@ -1,10 +1,9 @@
 import json
-import tempfile
 import logging
-from mutagen.mp3 import MP3
 
 from .miaccount import MiAccount, get_random
-import aiohttp
+from .mp3 import mp3_duration
+from .registry import DeviceRegistry
 
 _LOGGER = logging.getLogger(__package__)
 
@@ -20,22 +19,22 @@ _USE_PLAY_MUSIC_API = [
 
 
 class MiNAService:
-    def __init__(self, account: MiAccount):
+    def __init__(self, account: MiAccount, registry: DeviceRegistry = None):
         self.account = account
-        self.device2hardware = {}
-
-    async def _get_duration(self, url):
-        start = 0
-        end = 500
-        headers = {"Range": f"bytes={start}-{end}"}
-        response = aiohttp.get(self.url, headers=headers)
-        array_buffer = response.content
-        print(array_buffer)
-        with tempfile.NamedTemporaryFile() as tmp:
-            tmp.write(array_buffer)
-            m = MP3(tmp)
-            print(m.info.length)
-        return m.info.length
+        self.registry = registry or DeviceRegistry()
+        self.registry.mina_service = self
+        account.relogin_callbacks.append(self.registry.invalidate)
+
+    async def _get_duration(self, url, head_size=8192):
+        """Duration of the MP3 at ``url``, from the frame headers of its first bytes."""
+        headers = {"Range": f"bytes=0-{head_size - 1}"}
+        async with self.account.session.get(url, headers=headers) as response:
+            data = await response.read()
+            content_range = response.headers.get("Content-Range", "")
+        # without Content-Range the server ignored the range and sent the whole file
+        total_size = content_range.rpartition("/")[2]
+        total_size = int(total_size) if total_size.isdigit() else None
+        return mp3_duration(data, total_size)
 
     async def mina_request(self, uri, data=None):
         requestId = "app_ios_" + get_random(30)
@@ -56,10 +55,15 @@ class MiNAService:
 
     async def ubus_request(self, deviceId, method, path, message):
         message = json.dumps(message)
-        result = await self.mina_request(
-            "/remote/ubus",
-            {"deviceId": deviceId, "message": message, "method": method, "path": path},
-        )
+        try:
+            result = await self.mina_request(
+                "/remote/ubus",
+                {"deviceId": deviceId, "message": message, "method": method, "path": path},
+            )
+        except Exception:
+            # the device may be gone or renamed, fetch the device list again
+            self.registry.invalidate(self.registry.miss_refresh_interval)
+            raise
         return result
 
     async def text_to_speech(self, deviceId, text):
@@ -116,9 +120,7 @@ class MiNAService:
         )
 
     async def play_by_url(self, deviceId, url, _type=2):
-        if deviceId not in self.device2hardware:
-            await self._init_devices()
-        hardware = self.device2hardware[deviceId]
+        hardware = await self.registry.hardware(deviceId)
         if hardware in _USE_PLAY_MUSIC_API:
             return await self.play_by_music_url(deviceId, url, _type)
         else:
@@ -130,12 +132,7 @@ class MiNAService:
             )
 
     async def _init_devices(self):
-        hardware_data = await self.device_list()
-        for h in hardware_data:
-            deviceId = h.get("deviceID", "")
-            hardware = h.get("hardware", "")
-            if deviceId and hardware:
-                self.device2hardware[deviceId] = hardware
+        await self.registry.mina_devices(force=True)
 
     async def play_by_music_url(
         self, deviceId, url, _type=2, audio_id="1582971365183456177", id="355454500"
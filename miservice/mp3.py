@@ -0,0 +1,109 @@
+import struct
+
+# kbps, index 0 is "free" and 15 is invalid
+_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = [44100, 48000, 32000]
+
+
+def _parse_header(data, pos):
+    """Parse the MPEG audio layer III frame header at ``pos``."""
+    if pos + 4 > len(data):
+        return None
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    if data[pos] != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version_bits = (b1 >> 3) & 0x03  # 0: MPEG2.5, 2: MPEG2, 3: MPEG1
+    layer_bits = (b1 >> 1) & 0x03  # 1: layer III
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if (
+        version_bits == 1
+        or layer_bits != 1
+        or bitrate_index in (0, 15)
+        or sample_rate_index == 3
+    ):
+        return None
+    mpeg1 = version_bits == 3
+    bitrate = _BITRATES[1 if mpeg1 else 2][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[sample_rate_index] >> {3: 0, 2: 1, 0: 2}[version_bits]
+    samples = 1152 if mpeg1 else 576
+    padding = (b2 >> 1) & 0x01
+    mono = (b3 >> 6) == 3
+    return {
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "samples": samples,
+        "length": samples // 8 * bitrate // sample_rate + padding,
+        # side information size, the Xing header follows it
+        "side_info": (17 if mono else 32) if mpeg1 else (9 if mono else 17),
+    }
+
+
+def _skip_id3(data):
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _first_frame(data, pos):
+    while pos < len(data) - 4:
+        pos = data.find(b"\xff", pos)
+        if pos < 0:
+            return None, None
+        header = _parse_header(data, pos)
+        if header:
+            # make sure it is not a false sync, the next frame must follow
+            next_pos = pos + header["length"]
+            if next_pos + 4 > len(data) or _parse_header(data, next_pos):
+                return pos, header
+        pos += 1
+    return None, None
+
+
+def _vbr_frames(data, pos, header):
+    """Number of frames from a Xing/Info or VBRI header, None if there is none."""
+    xing = pos + 4 + header["side_info"]
+    if data[xing : xing + 4] in (b"Xing", b"Info") and len(data) >= xing + 12:
+        (flags,) = struct.unpack(">I", data[xing + 4 : xing + 8])
+        if flags & 0x01:
+            return struct.unpack(">I", data[xing + 8 : xing + 12])[0]
+    vbri = pos + 4 + 32
+    if data[vbri : vbri + 4] == b"VBRI" and len(data) >= vbri + 18:
+        return struct.unpack(">I", data[vbri + 14 : vbri + 18])[0]
+    return None
+
+
+def mp3_duration(data, total_size=None):
+    """Return the duration in seconds of the MP3 ``data``, None if it is not MP3.
+
+    ``data`` is the whole file, or only its head when ``total_size`` (the size
+    of the whole file) is given; without a VBR header the duration is then
+    estimated from the bitrate of the first frame.
+    """
+    data = bytes(data)
+    pos, header = _first_frame(data, _skip_id3(data))
+    if header is None:
+        return None
+    frames = _vbr_frames(data, pos, header)
+    if frames:
+        return frames * header["samples"] / header["sample_rate"]
+    if total_size is not None:
+        return (total_size - pos) * 8 / header["bitrate"]
+    duration = 0.0
+    while header:
+        duration += header["samples"] / header["sample_rate"]
+        pos += header["length"]
+        header = _parse_header(data, pos)
+    return duration
+
+
+def mp3_file_duration(path):
+    with open(path, "rb") as f:
+        return mp3_duration(f.read())
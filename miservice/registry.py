@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+
+_LOGGER = logging.getLogger(__package__)
+
+
+class DeviceRegistry:
+    """Shared, TTL-cached view of the account devices.
+
+    Caches ``MiNAService.device_list`` and ``MiIOService.device_list`` and maps
+    deviceID -> device (miotDID, hardware) and hardware -> (tts_command,
+    wakeup_command), so the lookups made on every play or TTS resolve from
+    memory. A list is fetched again only when the TTL expired or after
+    ``invalidate``; concurrent refreshes of the same list are coalesced.
+    Empty or failed fetches are not cached.
+    """
+
+    def __init__(
+        self,
+        mina_service=None,
+        miio_service=None,
+        ttl=600,
+        commands=None,
+        default_command=None,
+        miss_refresh_interval=30,
+    ):
+        self.mina_service = mina_service
+        self.miio_service = miio_service
+        self.ttl = ttl
+        self.commands = commands or {}
+        self.default_command = default_command
+        # minimum seconds between refreshes caused by an unknown deviceID
+        self.miss_refresh_interval = miss_refresh_interval
+
+        self._mina_devices = None
+        self._miio_devices = None
+        self._mina_time = 0.0
+        self._miio_time = 0.0
+        self._mina_lock = asyncio.Lock()
+        self._miio_lock = asyncio.Lock()
+
+        self._by_device_id = {}
+
+    def _expired(self, fetched_at):
+        return time.monotonic() - fetched_at >= self.ttl
+
+    def invalidate(self, min_age=0.0):
+        """Expire the cached lists, the next lookup fetches them again.
+
+        The old lists are still returned if that fetch fails. Lists fetched
+        less than ``min_age`` seconds ago are kept, so repeated errors do not
+        refetch them on every request.
+        """
+        now = time.monotonic()
+        if now - self._mina_time >= min_age:
+            self._mina_time = float("-inf")
+        if now - self._miio_time >= min_age:
+            self._miio_time = float("-inf")
+
+    async def mina_devices(self, force=False):
+        if force or self._mina_devices is None or self._expired(self._mina_time):
+            async with self._mina_lock:
+                # another caller may have refreshed while we waited for the lock
+                if force or self._mina_devices is None or self._expired(self._mina_time):
+                    _LOGGER.debug("Refresh mina device list")
+                    devices = await self.mina_service.device_list()
+                    if devices:
+                        self._set_mina_devices(devices)
+        # a failed fetch is not cached, the next call tries again
+        return [dict(d) for d in self._mina_devices or []]
+
+    async def miio_devices(self, force=False):
+        if force or self._miio_devices is None or self._expired(self._miio_time):
+            async with self._miio_lock:
+                if force or self._miio_devices is None or self._expired(self._miio_time):
+                    _LOGGER.debug("Refresh miio device list")
+                    devices = await self.miio_service.device_list()
+                    if devices:
+                        self._miio_devices = devices
+                        self._miio_time = time.monotonic()
+        return [dict(d) for d in self._miio_devices or []]
+
+    def _set_mina_devices(self, devices):
+        self._mina_devices = devices
+        self._mina_time = time.monotonic()
+        self._by_device_id = {d["deviceID"]: d for d in devices if d.get("deviceID")}
+
+    async def get_device(self, device_id):
+        """Return the mina device for ``device_id``, refreshing once if unknown."""
+        await self.mina_devices()
+        device = self._by_device_id.get(device_id)
+        if (
+            device is None
+            and time.monotonic() - self._mina_time >= self.miss_refresh_interval
+        ):
+            # a device added since the last refresh, fetch the list again once
+            await self.mina_devices(force=True)
+            device = self._by_device_id.get(device_id)
+        return device
+
+    async def hardware(self, device_id):
+        device = await self.get_device(device_id)
+        return device.get("hardware", "") if device else ""
+
+    def device_commands(self, hardware):
+        """Return ``(tts_command, wakeup_command)`` of ``hardware``."""
+        return self.commands.get(hardware, self.default_command)
@@ -0,0 +1,87 @@
+import logging
+from urllib.parse import urlsplit
+
+from aiohttp import ClientSession, ClientTimeout, CookieJar, TCPConnector
+
+_LOGGER = logging.getLogger(__package__)
+
+MI_HOSTS = (
+    "account.xiaomi.com",
+    "api2.mina.mi.com",
+    "api.io.mi.com",
+    "userprofile.mina.mi.com",
+)
+
+
+class MiSessionPool:
+    """Pooled HTTP client shared by MiAccount, MiNAService, MiIOService and the poller.
+
+    Every host gets its own ClientSession with a keep-alive connector, so
+    steady-state requests reuse warm TLS connections instead of opening new
+    ones. All sessions share one cookie jar. The pool can be used wherever a
+    ClientSession was used before, via ``request``/``get``/``post``.
+    """
+
+    def __init__(
+        self,
+        limit_per_host=8,
+        keepalive_timeout=60,
+        ttl_dns_cache=300,
+        timeout=15,
+        cookie_jar=None,
+    ):
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.timeout = ClientTimeout(total=timeout)
+        self.cookie_jar = cookie_jar if cookie_jar is not None else CookieJar()
+        self._sessions = {}
+
+    def session_for(self, url) -> ClientSession:
+        host = urlsplit(str(url)).hostname or ""
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            _LOGGER.debug("Create pooled session for %s", host)
+            connector = TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+                use_dns_cache=True,
+            )
+            session = ClientSession(
+                connector=connector,
+                cookie_jar=self.cookie_jar,
+                timeout=self.timeout,
+            )
+            self._sessions[host] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        return self.session_for(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def warm_up(self, hosts=MI_HOSTS):
+        """Create the sessions of the known Xiaomi hosts up front."""
+        for host in hosts:
+            self.session_for("https://" + host)
+
+    @property
+    def closed(self):
+        return all(session.closed for session in self._sessions.values())
+
+    async def close(self):
+        for session in self._sessions.values():
+            if not session.closed:
+                await session.close()
+        self._sessions.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -0,0 +1,67 @@
+"""The Doorman routes every new question through the local intent router, not only the first one."""
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("metagpt")
+ha_agent = pytest.importorskip("mihagpt.agents.ha_agent")
+
+from metagpt.team import Team  # noqa: E402
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class FakeStorage:
+    def get_all_areas(self):
+        return [{"area_id": "living_room", "name": "客厅"}]
+
+    def get_areas_by_id_list(self, area_id_list):
+        return [{"area_id": area_id} for area_id in area_id_list]
+
+    def get_simplified_devices_entities_with_description_list(self, area_id_list, entity_type):
+        return []
+
+    def get_simplified_device_list(self, area_id_list, entity_type):
+        return []
+
+
+class FakeRouter:
+    def __init__(self):
+        self.texts = []
+
+    def route(self, text, current_area=""):
+        self.texts.append(text)
+        return {
+            "next_step": 3,
+            "write_entity_list": [
+                {"device": "客厅灯", "entities": [{"entity_id": "light.living_room", "service": "turn_on", "option": ""}]}
+            ],
+            "question": "NA",
+            "result": "NA",
+        }
+
+    def selected_areas(self, route):
+        return ["living_room"], ["light"]
+
+
+def test_route_every_question_of_a_reused_team(monkeypatch):
+    # the llm configs are read relative to the repo root
+    monkeypatch.chdir(ROOT)
+    router = FakeRouter()
+    doorman = ha_agent.Doorman(FakeStorage(), router)
+    team = Team()
+    team.hire([doorman])
+
+    async def ask(query):
+        team.run_project(json.dumps({"user": query, "current_area": "客厅"}, ensure_ascii=False))
+        await team.run(n_round=1)
+
+    asyncio.run(ask("打开客厅灯"))
+    asyncio.run(ask("关闭客厅灯"))
+
+    assert router.texts == ["打开客厅灯", "关闭客厅灯"]
+    routed = [msg for msg in doorman.rc.memory.get() if msg.role == doorman.name]
+    assert len(routed) == 2
+    assert all("Classify_L2_W" in msg.cause_by for msg in routed)
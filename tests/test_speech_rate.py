@@ -0,0 +1,57 @@
+"""MiTTS learns the speaker's speech rate from the real end of each playback."""
+import asyncio
+import json
+import time
+
+import pytest
+
+pytest.importorskip("aiohttp")
+pytest.importorskip("yaml")
+
+from mihagpt.tts import base  # noqa: E402
+from mihagpt.tts.mi import MiTTS, SpeechRateModel  # noqa: E402
+
+DEVICE_ID = "speaker"
+
+
+class FakeRegistry:
+    async def hardware(self, device_id):
+        return "LX06"
+
+
+class FakeMinaService:
+    """Plays every text at ``rate`` characters per second, status calls take ``latency`` seconds."""
+
+    def __init__(self, rate, latency):
+        self.rate = rate
+        self.latency = latency
+        self.registry = FakeRegistry()
+        self.ends = 0.0
+
+    async def text_to_speech(self, device_id, text):
+        self.ends = time.perf_counter() + len(text) / self.rate
+
+    async def player_get_status(self, device_id):
+        await asyncio.sleep(self.latency / 2)
+        status = 1 if time.perf_counter() < self.ends else 0
+        await asyncio.sleep(self.latency / 2)
+        return {"data": {"info": json.dumps({"status": status})}}
+
+
+def test_estimate_converges_down_to_a_faster_speaker(monkeypatch):
+    monkeypatch.setattr(base, "STATUS_POLL_INTERVAL", 0.02)
+    tts = MiTTS.__new__(MiTTS)
+    tts.rate_model = SpeechRateModel(default=4.5)
+    mina = FakeMinaService(rate=6.0, latency=0.04)
+    text = "一二三"
+    seed = tts.rate_model.estimate(text, DEVICE_ID)
+
+    async def sentences():
+        for _ in range(12):
+            yield text
+
+    asyncio.run(tts.synthesize("zh", sentences(), mina, None, False, DEVICE_ID, "", ""))
+
+    estimate = tts.rate_model.estimate(text, DEVICE_ID)
+    assert estimate < seed
+    assert estimate == pytest.approx(len(text) / mina.rate, rel=0.15)